@@ -0,0 +1,496 @@
+"""
+OPlus ROM Converter - Conversion Backends
+The two heavy steps of a build are pluggable: decoding sparse images to raw
+(simg2img.exe or in-process) and assembling super.img (lpmake.exe or the
+native LP writer). When asked for 'auto', a short self-benchmark on a
+synthetic image picks the faster available backend for this machine; the
+result is cached in ~/.qflashforge/backends.json (QFF_BACKENDS_CACHE) until
+the machine or the tools change. QFF_DECODER / QFF_ASSEMBLER, or an
+explicit backend name, override the choice.
+
+New engines plug in with register_decoder() / register_assembler().
+
+Usage:
+    python backends.py             # show the selection (benchmarks if not cached)
+    python backends.py --rerun     # benchmark again
+"""
+import os
+import sys
+import json
+import time
+import struct
+import random
+import hashlib
+import argparse
+import platform
+import subprocess
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Dict, Optional, Callable, Tuple
+
+from buffer_pool import BufferPool, get_default_pool, copy_exact, write_fill
+from write_pipeline import PipelineOptions, WriteBehindPipeline, fadvise
+from sparse_image import (
+    SparseWriter, SPARSE_HEADER_MAGIC, SPARSE_HEADER_FORMAT, CHUNK_HEADER_FORMAT,
+    CHUNK_TYPE_RAW, CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32
+)
+from lp_metadata import LpMetadataError
+from lp_unpack import SuperSource
+from lp_builder import plan_super_layout, write_super_image, DEFAULT_METADATA_SIZE, DEFAULT_METADATA_SLOTS
+from io_schedule import SCHEDULE_AUTO
+from io_throttle import subprocess_creationflags
+from tracing import span, count, BYTES_READ, BYTES_WRITTEN
+
+MB = 1024 * 1024
+
+AUTO = 'auto'
+
+# Bump when the benchmark changes, so cached selections are redone
+BENCHMARK_VERSION = 1
+BENCHMARK_IMAGE_SIZE = 64 * MB
+BENCHMARK_ROUNDS = 2
+
+def get_tools_dir() -> Path:
+    """Get the tools directory (bundled or development)"""
+    if getattr(sys, 'frozen', False):
+        # Running as compiled exe
+        return Path(sys._MEIPASS) / 'tools'
+    else:
+        # Running in development
+        return Path(__file__).parent.parent / 'Tools'
+
+def convert_sparse_to_raw(
+    img_path: Path,
+    output_path: Path,
+    log_callback: Optional[Callable[[str], None]] = None
+) -> bool:
+    """Convert sparse image to raw using simg2img"""
+    tools_dir = get_tools_dir()
+    simg2img = tools_dir / 'simg2img.exe'
+    
+    if not simg2img.exists():
+        if log_callback:
+            log_callback(f"ERROR: simg2img.exe not found at {simg2img}")
+        return False
+    
+    if log_callback:
+        log_callback(f"Converting {img_path.name}...")
+    
+    try:
+        result = subprocess.run(
+            [str(simg2img), str(img_path), str(output_path)],
+            capture_output=True,
+            text=True,
+            timeout=600,  # 10 minutes timeout
+            creationflags=subprocess_creationflags()
+        )
+        
+        if result.returncode == 0:
+            count(BYTES_READ, img_path.stat().st_size)
+            count(BYTES_WRITTEN, output_path.stat().st_size)
+            if log_callback:
+                log_callback(f"Converted: {img_path.name} -> {output_path.name}")
+            return True
+        else:
+            if log_callback:
+                log_callback(f"ERROR: {result.stderr}")
+            return False
+    except subprocess.TimeoutExpired:
+        if log_callback:
+            log_callback(f"ERROR: Conversion timeout for {img_path.name}")
+        return False
+    except Exception as e:
+        if log_callback:
+            log_callback(f"ERROR: {str(e)}")
+        return False
+
+def convert_sparse_to_raw_native(
+    img_path: Path,
+    output_path: Path,
+    log_callback: Optional[Callable[[str], None]] = None,
+    pool: Optional[BufferPool] = None,
+    pipeline: Optional[WriteBehindPipeline] = None
+) -> bool:
+    """Convert sparse image to raw in-process (no simg2img needed)
+    
+    With a pipeline, writes are handed to its write-behind thread so
+    reading the next chunk overlaps with flushing the previous one. The
+    decode buffer never comes from the pipeline's own pool.
+    """
+    if log_callback:
+        log_callback(f"Converting {img_path.name} (native)...")
+    
+    pool = pool or get_default_pool()
+    try:
+        with open(img_path, 'rb') as src, \
+                (pipeline.open(output_path) if pipeline else open(output_path, 'wb')) as dst, \
+                pool.buffer() as buf:
+            if pipeline and pipeline.options.fadvise:
+                fadvise(src, 'POSIX_FADV_SEQUENTIAL')
+            header = src.read(struct.calcsize(SPARSE_HEADER_FORMAT))
+            if len(header) < struct.calcsize(SPARSE_HEADER_FORMAT):
+                raise ValueError(f"{img_path.name}: truncated sparse header")
+            (magic, _major, _minor, file_hdr_sz, chunk_hdr_sz,
+             blk_sz, total_blks, total_chunks, _checksum) = struct.unpack(SPARSE_HEADER_FORMAT, header)
+            if magic != SPARSE_HEADER_MAGIC:
+                if log_callback:
+                    log_callback(f"ERROR: {img_path.name} is not a sparse image")
+                return False
+            
+            src.seek(file_hdr_sz)
+            chunk_hdr_len = struct.calcsize(CHUNK_HEADER_FORMAT)
+            data_bytes = 0
+            
+            for index in range(total_chunks):
+                chunk_header = src.read(chunk_hdr_len)
+                if len(chunk_header) < chunk_hdr_len:
+                    raise ValueError(f"{img_path.name}: truncated at chunk {index} of {total_chunks}")
+                chunk_type, _reserved, chunk_sz, total_sz = struct.unpack(CHUNK_HEADER_FORMAT, chunk_header)
+                src.seek(chunk_hdr_sz - chunk_hdr_len, os.SEEK_CUR)
+                out_len = chunk_sz * blk_sz
+                
+                if chunk_type == CHUNK_TYPE_RAW:
+                    copy_exact(src, dst, out_len, buf)
+                    data_bytes += out_len
+                elif chunk_type == CHUNK_TYPE_FILL:
+                    # Zero fills become holes, others are tiled from one pool buffer
+                    write_fill(dst, src.read(4), out_len, buf)
+                    data_bytes += out_len
+                elif chunk_type == CHUNK_TYPE_DONT_CARE:
+                    dst.seek(out_len, os.SEEK_CUR)
+                elif chunk_type == CHUNK_TYPE_CRC32:
+                    src.seek(total_sz - chunk_hdr_sz, os.SEEK_CUR)
+                else:
+                    raise ValueError(f"Unknown chunk type 0x{chunk_type:04X}")
+            
+            # Trailing holes must still count towards the raw size
+            dst.truncate(blk_sz * total_blks)
+            if pipeline and pipeline.options.fadvise:
+                fadvise(src, 'POSIX_FADV_DONTNEED')
+            count(BYTES_READ, src.tell())
+            count(BYTES_WRITTEN, data_bytes)
+        
+        if log_callback:
+            log_callback(f"Converted: {img_path.name} -> {output_path.name}")
+        return True
+    except Exception as e:
+        if log_callback:
+            log_callback(f"ERROR: {str(e)}")
+        return False
+
+@dataclass
+class SuperLayout:
+    """Everything an assembler needs: device geometry, groups and partition images"""
+    device_size: int
+    alignment: int
+    block_size: int
+    groups: List[Tuple[str, int]]             # (name, maximum_size)
+    partitions: List[Tuple[str, str, Path]]   # (name, group, image)
+
+class DecodeBackend:
+    """Turns a sparse image into a raw file"""
+    name = ''
+    in_process = False  # Benefits from a write-behind pipeline
+
+    def check(self) -> Optional[str]:
+        """None when usable, otherwise why not"""
+        return None
+
+    def tool(self) -> Optional[Path]:
+        """External binary (part of the cache and benchmark identity), None if in-process"""
+        return None
+
+    def decode(self, img_path: Path, raw_path: Path, log_callback: Optional[Callable[[str], None]] = None,
+               pipeline: Optional[WriteBehindPipeline] = None) -> bool:
+        raise NotImplementedError
+
+class AssembleBackend:
+    """Writes super.img from partition images"""
+    name = ''
+    reads_sparse = False  # Takes sparse images as they are (no decode stage needed)
+
+    def check(self) -> Optional[str]:
+        return None
+
+    def tool(self) -> Optional[Path]:
+        return None
+
+    def assemble(self, layout: SuperLayout, output_path: Path,
+                 log_callback: Optional[Callable[[str], None]] = None,
+                 progress_callback: Optional[Callable[[int, int], None]] = None,
+                 io_schedule: str = SCHEDULE_AUTO) -> bool:
+        raise NotImplementedError
+
+class Simg2imgDecoder(DecodeBackend):
+    name = 'simg2img'
+
+    def tool(self) -> Optional[Path]:
+        return get_tools_dir() / 'simg2img.exe'
+
+    def check(self) -> Optional[str]:
+        return None if self.tool().exists() else f"simg2img.exe not found at {self.tool()}"
+
+    def decode(self, img_path, raw_path, log_callback=None, pipeline=None) -> bool:
+        return convert_sparse_to_raw(img_path, raw_path, log_callback)
+
+class NativeDecoder(DecodeBackend):
+    name = 'native'
+    in_process = True
+
+    def decode(self, img_path, raw_path, log_callback=None, pipeline=None) -> bool:
+        return convert_sparse_to_raw_native(img_path, raw_path, log_callback, pipeline=pipeline)
+
+class LpmakeAssembler(AssembleBackend):
+    name = 'lpmake'
+
+    def tool(self) -> Optional[Path]:
+        return get_tools_dir() / 'lpmake.exe'
+
+    def check(self) -> Optional[str]:
+        return None if self.tool().exists() else f"lpmake.exe not found at {self.tool()}"
+
+    def assemble(self, layout, output_path, log_callback=None, progress_callback=None,
+                 io_schedule=SCHEDULE_AUTO) -> bool:
+        cmd = [
+            str(self.tool()),
+            '--device-size', str(layout.device_size),
+            '--metadata-size', str(DEFAULT_METADATA_SIZE),
+            '--metadata-slots', str(DEFAULT_METADATA_SLOTS),
+            '--output', str(output_path)
+        ]
+        for group_name, max_size in layout.groups:
+            cmd.extend(['--group', f"{group_name}:{max_size}"])
+        for name, group_name, image in layout.partitions:
+            cmd.extend([
+                '--partition', f"{name}:readonly:{image.stat().st_size}:{group_name}",
+                '--image', f"{name}={image}"
+            ])
+        
+        if log_callback:
+            log_callback(f"Running lpmake with {len(layout.partitions)} partitions...")
+        try:
+            with span('lpmake', partitions=len(layout.partitions)):
+                result = subprocess.run(
+                    cmd,
+                    capture_output=True,
+                    text=True,
+                    timeout=1800,  # 30 minutes timeout
+                    creationflags=subprocess_creationflags()
+                )
+        except subprocess.TimeoutExpired:
+            if log_callback:
+                log_callback("ERROR: lpmake timeout (>30 min)")
+            return False
+        if result.returncode != 0:
+            if log_callback:
+                log_callback(f"ERROR: lpmake failed")
+                log_callback(result.stderr[:500] if result.stderr else "Unknown error")
+            return False
+        count(BYTES_WRITTEN, output_path.stat().st_size)
+        return True
+
+class NativeAssembler(AssembleBackend):
+    """Lays out like lpmake, writes extents in parallel, metadata last (see lp_builder)"""
+    name = 'native'
+    reads_sparse = True
+
+    def assemble(self, layout, output_path, log_callback=None, progress_callback=None,
+                 io_schedule=SCHEDULE_AUTO) -> bool:
+        try:
+            sizes = []
+            for name, group_name, image in layout.partitions:
+                with SuperSource(image) as src:
+                    sizes.append((name, group_name, src.size))
+            with span('layout', partitions=len(sizes)):
+                metadata = plan_super_layout(layout.device_size, layout.alignment, layout.block_size,
+                                             layout.groups, sizes)
+            with span('write:super', partitions=len(sizes)):
+                write_super_image(metadata, {name: image for name, _group, image in layout.partitions},
+                                  output_path, schedule=io_schedule,
+                                  log_callback=log_callback, progress_callback=progress_callback)
+        except LpMetadataError as e:
+            if log_callback:
+                log_callback(f"ERROR: {e}")
+            return False
+        return True
+
+DECODERS: Dict[str, DecodeBackend] = {}
+ASSEMBLERS: Dict[str, AssembleBackend] = {}
+
+def register_decoder(backend: DecodeBackend):
+    DECODERS[backend.name] = backend
+
+def register_assembler(backend: AssembleBackend):
+    ASSEMBLERS[backend.name] = backend
+
+# Order is the preference when the benchmark can't run: proven tools first
+for _backend in (Simg2imgDecoder(), NativeDecoder()):
+    register_decoder(_backend)
+for _backend in (LpmakeAssembler(), NativeAssembler()):
+    register_assembler(_backend)
+
+# --- Self-benchmark ---
+
+def _write_benchmark_image(path: Path, size: int, block_size: int = 4096):
+    """Synthetic sparse image: data, fill and don't-care runs like a real partition"""
+    rng = random.Random(0)
+    pool = rng.getrandbits(MB * 8).to_bytes(MB, 'little')
+    blocks = size // block_size
+    with open(path, 'wb') as f:
+        writer = SparseWriter(f, block_size)
+        done = 0
+        while done < blocks:
+            n = min(rng.randint(16, 256), blocks - done)
+            kind = rng.random()
+            if kind < 0.6:
+                start = rng.randrange(0, len(pool) - n * block_size + 1)
+                writer.write_raw(memoryview(pool)[start:start + n * block_size])
+            elif kind < 0.8:
+                writer.write_fill(struct.pack('<I', rng.getrandbits(32)), n)
+            else:
+                writer.skip(n)
+            done += n
+        writer.close()
+
+def _timed(func: Callable[[], bool], rounds: int = BENCHMARK_ROUNDS) -> Optional[float]:
+    """Best time of rounds runs, None if any run fails"""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        if not func():
+            return None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run_benchmark(log_callback: Optional[Callable[[str], None]] = None) -> Dict[str, Dict[str, float]]:
+    """Seconds per usable backend: {'decode': {name: s}, 'assemble': {name: s}}"""
+    results: Dict[str, Dict[str, float]] = {'decode': {}, 'assemble': {}}
+    with tempfile.TemporaryDirectory(prefix='qff_bench_') as tmp:
+        work = Path(tmp)
+        sparse = work / 'bench.img'
+        _write_benchmark_image(sparse, BENCHMARK_IMAGE_SIZE)
+        raw = work / 'bench.raw'
+        for name, backend in DECODERS.items():
+            if backend.check():
+                continue
+            def decode():
+                if backend.in_process:
+                    with WriteBehindPipeline(PipelineOptions()) as pipeline:
+                        return backend.decode(sparse, raw, pipeline=pipeline)
+                return backend.decode(sparse, raw)
+            seconds = _timed(decode)
+            if seconds is not None:
+                results['decode'][name] = seconds
+        if not raw.exists() and not NativeDecoder().decode(sparse, raw):
+            return results
+        layout = SuperLayout(4 * BENCHMARK_IMAGE_SIZE, MB, 4096, [('main', 3 * BENCHMARK_IMAGE_SIZE)],
+                             [('a', 'main', raw), ('b', 'main', raw)])
+        for name, backend in ASSEMBLERS.items():
+            if backend.check():
+                continue
+            seconds = _timed(lambda: backend.assemble(layout, work / f'super.{name}.img'))
+            if seconds is not None:
+                results['assemble'][name] = seconds
+    if log_callback:
+        for kind, timings in results.items():
+            for name, seconds in sorted(timings.items(), key=lambda kv: kv[1]):
+                log_callback(f"Benchmark {kind} {name}: {BENCHMARK_IMAGE_SIZE / MB / seconds:.0f} MB/s")
+    return results
+
+def machine_id() -> str:
+    """Identity of this machine and its tools; a different id invalidates the cached benchmark"""
+    tools = {}
+    for backend in list(DECODERS.values()) + list(ASSEMBLERS.values()):
+        tool = backend.tool()
+        if tool and tool.exists():
+            st = tool.stat()
+            tools[f'{backend.name}:{tool.name}'] = [st.st_size, st.st_mtime_ns]
+    data = {
+        'benchmark': BENCHMARK_VERSION,
+        'node': platform.node(), 'machine': platform.machine(), 'system': platform.system(),
+        'python': platform.python_version(), 'cpus': os.cpu_count(),
+        'decoders': sorted(DECODERS), 'assemblers': sorted(ASSEMBLERS), 'tools': tools,
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def default_cache_path() -> Path:
+    """QFF_BACKENDS_CACHE, else ~/.qflashforge/backends.json"""
+    env = os.environ.get('QFF_BACKENDS_CACHE')
+    return Path(env) if env else Path.home() / '.qflashforge' / 'backends.json'
+
+def cached_benchmark(cache_path: Optional[Path] = None, rerun: bool = False,
+                     log_callback: Optional[Callable[[str], None]] = None) -> Dict[str, Dict[str, float]]:
+    """Benchmark results for this machine, measured once and then read from the cache"""
+    cache_path = cache_path or default_cache_path()
+    ident = machine_id()
+    if not rerun:
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('machine_id') == ident:
+                return data['results']
+        except (OSError, ValueError, KeyError):
+            pass
+    if log_callback:
+        log_callback("Benchmarking conversion backends (once per machine)...")
+    results = run_benchmark(log_callback)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'machine_id': ident, 'measured': time.time(), 'results': results}, f, indent=2)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass  # Benchmark again next time
+    return results
+
+def _select(kind: str, registry: Dict, requested: Optional[str], env_name: str,
+            cache_path: Optional[Path], log_callback: Optional[Callable[[str], None]]):
+    if not requested or requested == AUTO:
+        requested = os.environ.get(env_name) or AUTO
+    if requested != AUTO:
+        if requested not in registry:
+            raise ValueError(f"Unknown {kind} backend '{requested}' (have: {', '.join(registry)})")
+        return registry[requested]
+    usable = [name for name, backend in registry.items() if not backend.check()]
+    if not usable:
+        return next(iter(registry.values()))  # Let the build report why it can't run
+    if len(usable) == 1:
+        return registry[usable[0]]
+    timings = cached_benchmark(cache_path, log_callback=log_callback).get(kind, {})
+    measured = [name for name in usable if name in timings]
+    return registry[min(measured, key=timings.get) if measured else usable[0]]
+
+def select_decoder(requested: Optional[str] = None, cache_path: Optional[Path] = None,
+                   log_callback: Optional[Callable[[str], None]] = None) -> DecodeBackend:
+    """Backend by name; for 'auto'/None QFF_DECODER, else the fastest usable one"""
+    return _select('decode', DECODERS, requested, 'QFF_DECODER', cache_path, log_callback)
+
+def select_assembler(requested: Optional[str] = None, cache_path: Optional[Path] = None,
+                     log_callback: Optional[Callable[[str], None]] = None) -> AssembleBackend:
+    """Backend by name; for 'auto'/None QFF_ASSEMBLER, else the fastest usable one"""
+    return _select('assemble', ASSEMBLERS, requested, 'QFF_ASSEMBLER', cache_path, log_callback)
+
+def add_backend_arguments(parser: argparse.ArgumentParser):
+    """--decoder/--assembler for the command-line tools"""
+    parser.add_argument('--decoder', choices=[AUTO] + list(DECODERS), default=None,
+                        help='sparse decoding backend (default QFF_DECODER, else auto)')
+    parser.add_argument('--assembler', choices=[AUTO] + list(ASSEMBLERS), default=None,
+                        help='super.img assembly backend (default QFF_ASSEMBLER, else auto)')
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark and select the conversion backends')
+    parser.add_argument('--rerun', action='store_true', help='ignore the cached benchmark')
+    parser.add_argument('--cache', type=Path, default=None, help='benchmark cache file')
+    args = parser.parse_args(argv)
+    cached_benchmark(args.cache, rerun=args.rerun, log_callback=print)
+    for kind, registry, select in (('decode', DECODERS, select_decoder), ('assemble', ASSEMBLERS, select_assembler)):
+        for name, backend in registry.items():
+            print(f"{kind:8} {name:10} {backend.check() or 'ok'}")
+        print(f"{kind:8} selected: {select(cache_path=args.cache).name}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+"""
+OPlus ROM Converter - Benchmark Suite
+Measures throughput (MB/s) and peak RSS of the conversion hot paths on
+synthetic data, fully offline.
+
+Usage:
+    python benchmark.py --profile small --output bench.json
+    python benchmark.py --profile medium --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import List, Dict, Optional
+
+from converter import (
+    CHUNK_TYPE_RAW, CHUNK_TYPE_FILL,
+    get_tools_dir, is_sparse_image, get_sparse_info, find_all_super_defs, parse_super_def,
+    convert_sparse_to_raw, convert_sparse_to_raw_native, create_super_image,
+    extract_rom_zip, clear_region_cache
+)
+from rom_generator import GeneratorConfig, ChunkSpec, generate_rom, write_rom_zip, write_sparse_image
+from buffer_pool import DEFAULT_BUDGET, configure_default_pool
+from write_pipeline import PipelineOptions, WriteBehindPipeline, pipeline_budget
+
+MB = 1024 * 1024
+
+# Results file layout version, bump when fields change meaning
+RESULTS_VERSION = 1
+
+# Allowed RSS growth on top of the buffer budget (interpreter noise, page cache refs)
+RSS_SLACK_KB = 8 * 1024
+
+PROFILES = {
+    'small': {'image_size': 32 * MB, 'images': 4, 'regions': 4, 'rounds': 50},
+    'medium': {'image_size': 256 * MB, 'images': 6, 'regions': 12, 'rounds': 20},
+    'large': {'image_size': 2048 * MB, 'images': 4, 'regions': 20, 'rounds': 5},
+}
+
+CASES = [
+    'sparse_info',
+    'decode_native',
+    'decode_large_chunks',
+    'decode_pipeline',
+    'decode_simg2img',
+    'super_assembly',
+    'super_lpmake',
+    'scan_super_defs',
+    'scan_super_defs_cached',
+    'zip_extract',
+]
+
+# --- Fixture ---
+
+def build_fixture(root: Path, profile: Dict) -> Path:
+    """Create a synthetic ROM folder (META + IMAGES) and a ZIP of it"""
+    config = GeneratorConfig(
+        partition_size=profile['image_size'],
+        dynamic_partitions=[f'part{i}' for i in range(profile['images'])],
+        region_partitions=[],
+        regions=profile['regions'],
+        seed=1,
+    )
+    rom = generate_rom(root / 'rom', config)
+    write_rom_zip(rom, root / 'rom.zip')
+    return rom
+
+def _write_large_chunk_image(path: Path, size: int):
+    """One FILL chunk of 4x size followed by one RAW chunk of size"""
+    rng = random.Random(2)
+    pool = rng.getrandbits(8 * MB * 8).to_bytes(8 * MB, 'little')
+    blocks = size // 4096
+    chunks = [ChunkSpec(CHUNK_TYPE_FILL, blocks * 4, b'\x5A\xA5\x5A\xA5'),
+              ChunkSpec(CHUNK_TYPE_RAW, blocks)]
+    write_sparse_image(path, chunks, 4096, pool, rng)
+
+# --- Cases (run inside a child process so peak RSS is per case) ---
+
+def _peak_rss_kb() -> Optional[int]:
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+def _sparse_images(rom: Path) -> List[Path]:
+    return sorted(p for p in (rom / 'IMAGES').glob('*.img') if is_sparse_image(p))
+
+def run_case(name: str, rom: Path, scratch: Path, rounds: int,
+             buffer_budget: int = DEFAULT_BUDGET) -> Dict:
+    """Run one benchmark case and return its raw measurements"""
+    scratch.mkdir(parents=True, exist_ok=True)
+    configure_default_pool(buffer_budget)
+    images = _sparse_images(rom)
+    if name == 'decode_large_chunks':
+        images = [rom.parent / 'large_chunks.img']
+    baseline_rss = _peak_rss_kb()
+    # Write-behind pipelines preallocate their own buffers on top of the shared pool
+    if name in ('decode_pipeline', 'super_assembly', 'super_lpmake'):
+        buffer_budget += pipeline_budget(PipelineOptions(queue_depth=8) if name == 'decode_pipeline' else None)
+    nbytes = 0
+    ops = 0
+
+    if name == 'sparse_info':
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for img in images:
+                nbytes += get_sparse_info(img)['raw_size']
+                ops += 1
+    elif name == 'decode_pipeline':
+        start = time.perf_counter()
+        with WriteBehindPipeline(PipelineOptions(queue_depth=8)) as pipeline:
+            for img in images:
+                out = scratch / f'{img.stem}.raw'
+                if not convert_sparse_to_raw_native(img, out, pipeline=pipeline):
+                    return {'error': f'conversion failed for {img.name}'}
+                nbytes += get_sparse_info(img)['raw_size']
+                ops += 1
+    elif name in ('decode_native', 'decode_large_chunks', 'decode_simg2img'):
+        if name == 'decode_simg2img':
+            if not (get_tools_dir() / 'simg2img.exe').exists():
+                return {'skipped': 'simg2img.exe not available'}
+            convert = convert_sparse_to_raw
+        else:
+            convert = convert_sparse_to_raw_native
+        start = time.perf_counter()
+        for img in images:
+            out = scratch / f'{img.stem}.raw'
+            if not convert(img, out):
+                return {'error': f'conversion failed for {img.name}'}
+            nbytes += out.stat().st_size
+            ops += 1
+    elif name in ('super_assembly', 'super_lpmake'):
+        assembler = 'lpmake' if name == 'super_lpmake' else 'native'
+        if assembler == 'lpmake' and not (get_tools_dir() / 'lpmake.exe').exists():
+            return {'skipped': 'lpmake.exe not available'}
+        config = parse_super_def(find_all_super_defs(rom)[0].config_path)
+        start = time.perf_counter()
+        if not create_super_image(config, rom, scratch / 'super.img', decoder='native', assembler=assembler):
+            return {'error': 'create_super_image failed'}
+        nbytes = (scratch / 'super.img').stat().st_size
+        ops = 1
+    elif name in ('scan_super_defs', 'scan_super_defs_cached'):
+        json_bytes = sum(f.stat().st_size for f in (rom / 'META').glob('super_def.*.json'))
+        cold = name == 'scan_super_defs'
+        find_all_super_defs(rom)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            if cold:
+                clear_region_cache()
+            ops += len(find_all_super_defs(rom))
+            nbytes += json_bytes
+    elif name == 'zip_extract':
+        zip_path = rom.parent / 'rom.zip'
+        with zipfile.ZipFile(zip_path) as zf:
+            nbytes = sum(i.file_size for i in zf.infolist())
+            ops = len(zf.infolist())
+        start = time.perf_counter()
+        if not extract_rom_zip(zip_path, scratch / 'extracted'):
+            return {'error': 'extract_rom_zip failed'}
+    else:
+        return {'error': f'unknown case {name}'}
+
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': seconds,
+        'bytes': nbytes,
+        'ops': ops,
+        'peak_rss_kb': _peak_rss_kb(),
+        'baseline_rss_kb': baseline_rss,
+        'buffer_budget': buffer_budget,
+    }
+
+def _run_case_subprocess(name: str, rom: Path, scratch: Path, profile: Dict,
+                         buffer_budget: int) -> Dict:
+    cmd = [sys.executable, str(Path(__file__).resolve()), '--run-case', name,
+           '--fixture', str(rom), '--scratch', str(scratch),
+           '--rounds', str(profile['rounds']), '--buffer-budget', str(buffer_budget)]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {'error': (result.stderr or 'child failed').strip()[-500:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+# --- Results ---
+
+def _git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=Path(__file__).parent, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except Exception:
+        return None
+
+def summarize(name: str, raw: Dict) -> Dict:
+    """Turn child measurements into a results entry"""
+    entry = {'case': name}
+    entry.update(raw)
+    if 'seconds' in raw:
+        seconds = max(raw['seconds'], 1e-9)
+        entry['mb_per_s'] = raw['bytes'] / MB / seconds
+        entry['ops_per_s'] = raw['ops'] / seconds
+    if raw.get('peak_rss_kb') and raw.get('baseline_rss_kb') is not None:
+        growth = raw['peak_rss_kb'] - raw['baseline_rss_kb']
+        entry['rss_growth_kb'] = growth
+        # Decoding must stay within the buffer budget whatever the image size
+        entry['rss_bounded'] = growth <= raw['buffer_budget'] // 1024 + RSS_SLACK_KB
+    return entry
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> bool:
+    """Print a per-case comparison, return False on a throughput regression"""
+    base = {r['case']: r for r in baseline.get('results', [])}
+    ok = True
+    print(f"\n{'case':<20}{'MB/s':>12}{'base':>12}{'delta':>9}{'RSS MB':>10}{'base':>10}")
+    for r in results['results']:
+        b = base.get(r['case'])
+        if 'mb_per_s' not in r or not b or 'mb_per_s' not in b:
+            continue
+        delta = (r['mb_per_s'] - b['mb_per_s']) / max(b['mb_per_s'], 1e-9)
+        flag = ''
+        if delta < -threshold:
+            flag = '  REGRESSION'
+            ok = False
+        rss = (r.get('peak_rss_kb') or 0) / 1024
+        base_rss = (b.get('peak_rss_kb') or 0) / 1024
+        print(f"{r['case']:<20}{r['mb_per_s']:>12.1f}{b['mb_per_s']:>12.1f}"
+              f"{delta * 100:>8.1f}%{rss:>10.1f}{base_rss:>10.1f}{flag}")
+    return ok
+
+def run_suite(profile_name: str, cases: List[str], workdir: Optional[Path], keep: bool,
+              buffer_budget: int = DEFAULT_BUDGET) -> Dict:
+    profile = PROFILES[profile_name]
+    root = Path(tempfile.mkdtemp(prefix='qff-bench-', dir=workdir))
+    try:
+        print(f"Building {profile_name} fixture in {root}...")
+        rom = build_fixture(root, profile)
+        if 'decode_large_chunks' in cases:
+            _write_large_chunk_image(root / 'large_chunks.img', profile['image_size'])
+        results = []
+        for name in cases:
+            scratch = root / f'scratch_{name}'
+            raw = _run_case_subprocess(name, rom, scratch, profile, buffer_budget)
+            shutil.rmtree(scratch, ignore_errors=True)
+            entry = summarize(name, raw)
+            results.append(entry)
+            if 'mb_per_s' in entry:
+                bound = '' if entry.get('rss_bounded', True) else '  (exceeds buffer budget!)'
+                print(f"  {name:<20}{entry['mb_per_s']:>10.1f} MB/s  "
+                      f"peak RSS {(entry['peak_rss_kb'] or 0) / 1024:.1f} MB{bound}")
+            else:
+                print(f"  {name:<20}{entry.get('skipped') or entry.get('error')}")
+    finally:
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        'version': RESULTS_VERSION,
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'profile': profile_name,
+        'profile_params': profile,
+        'buffer_budget': buffer_budget,
+        'results': results,
+    }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Q-Flash Forge benchmark suite')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='small')
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--output', type=Path, help='write results JSON here')
+    parser.add_argument('--compare', type=Path, help='baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed throughput drop before flagging (default 0.10)')
+    parser.add_argument('--workdir', type=Path, help='where to build fixtures (default: temp)')
+    parser.add_argument('--keep', action='store_true', help='keep fixture files')
+    parser.add_argument('--buffer-budget', type=int, default=DEFAULT_BUDGET,
+                        help=f'buffer pool budget in bytes (default {DEFAULT_BUDGET})')
+    # Internal: single case execution in a child process
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--fixture', type=Path, help=argparse.SUPPRESS)
+    parser.add_argument('--scratch', type=Path, help=argparse.SUPPRESS)
+    parser.add_argument('--rounds', type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.fixture, args.scratch, args.rounds,
+                                  args.buffer_budget)))
+        return 0
+
+    results = run_suite(args.profile, args.cases, args.workdir, args.keep, args.buffer_budget)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('profile') != results['profile']:
+            print(f"WARNING: comparing {results['profile']} against {baseline.get('profile')} profile")
+        if not compare(results, baseline, args.threshold):
+            return 1
+    if not all(r.get('rss_bounded', True) for r in results['results']):
+        return 1
+    failed = [r['case'] for r in results['results'] if 'error' in r]
+    if failed:
+        print(f"ERROR: failed cases: {', '.join(failed)}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
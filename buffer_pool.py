@@ -0,0 +1,140 @@
+"""
+OPlus ROM Converter - Buffer Pool
+Fixed set of preallocated buffers shared by the sparse decoder, raw copier
+and ZIP streaming, so memory stays flat regardless of image or chunk size.
+
+Nobody holds two buffers of the same pool at once (the write-behind
+pipeline has its own), so a waiting acquire() always ends when a holder
+finishes; there is no timeout by default.
+
+Two callers need larger contiguous buffers and allocate them outside the
+pool, once per call: ChunkStore.put (one max_chunk buffer) and the
+sequential schedule of lp_builder.write_super_image (one HDD_IO_SIZE buffer).
+"""
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional, List
+
+from io_throttle import throttle
+
+MB = 1024 * 1024
+
+# Defaults: 16 x 1 MiB buffers
+DEFAULT_BUFFER_SIZE = 1 * MB
+DEFAULT_BUDGET = 16 * MB
+
+class BufferPool:
+    """Preallocated bytearray blocks handed out as memoryviews"""
+
+    def __init__(self, budget: int = DEFAULT_BUDGET, buffer_size: int = DEFAULT_BUFFER_SIZE):
+        if buffer_size <= 0 or budget < buffer_size:
+            raise ValueError(f"Budget {budget} must hold at least one {buffer_size} byte buffer")
+        self.buffer_size = buffer_size
+        self.budget = budget
+        self._buffers: List[bytearray] = [bytearray(buffer_size) for _ in range(budget // buffer_size)]
+        self._free: List[bytearray] = list(self._buffers)
+        self._cond = threading.Condition()
+        self.in_use = 0
+        self.peak_in_use = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self._buffers)
+
+    def acquire(self, timeout: Optional[float] = None) -> memoryview:
+        """Take a buffer, waiting while all are in use (timeout None: forever)"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._free, timeout):
+                raise TimeoutError(f"No free buffer in pool after {timeout:g}s "
+                                   f"({self.capacity} buffers, all in use)")
+            buf = self._free.pop()
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return memoryview(buf)
+
+    def release(self, view: memoryview):
+        """Return a buffer obtained from acquire()"""
+        buf = view.obj
+        with self._cond:
+            self._free.append(buf)
+            self.in_use -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def buffer(self, timeout: Optional[float] = None):
+        view = self.acquire(timeout)
+        try:
+            yield view
+        finally:
+            self.release(view)
+
+_default_pool: Optional[BufferPool] = None
+_default_lock = threading.Lock()
+
+def configure_default_pool(budget: int = DEFAULT_BUDGET, buffer_size: int = DEFAULT_BUFFER_SIZE) -> BufferPool:
+    """Replace the process-wide pool (call before starting work)"""
+    global _default_pool
+    with _default_lock:
+        _default_pool = BufferPool(budget, buffer_size)
+        return _default_pool
+
+def get_default_pool() -> BufferPool:
+    """Process-wide pool, created on first use"""
+    global _default_pool
+    with _default_lock:
+        if _default_pool is None:
+            budget = int(os.environ.get('QFF_BUFFER_BUDGET', DEFAULT_BUDGET))
+            _default_pool = BufferPool(budget, min(DEFAULT_BUFFER_SIZE, budget))
+        return _default_pool
+
+# --- Streaming helpers (never allocate more than one buffer) ---
+
+def copy_exact(src, dst, length: int, buf: memoryview) -> int:
+    """Copy exactly `length` bytes from src to dst using readinto"""
+    remaining = length
+    while remaining > 0:
+        view = buf[:min(len(buf), remaining)]
+        n = src.readinto(view)
+        if not n:
+            raise EOFError(f"Unexpected end of input ({length - remaining}/{length} bytes)")
+        throttle(2 * n)  # Read + write
+        dst.write(view[:n])
+        remaining -= n
+    return length
+
+def copy_stream(src, dst, buf: memoryview) -> int:
+    """Copy src to dst until EOF using readinto"""
+    total = 0
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            return total
+        throttle(2 * n)
+        dst.write(buf[:n])
+        total += n
+
+def fill_buffer(buf: memoryview, pattern: bytes) -> int:
+    """Tile pattern over buf in place, return the usable (whole-pattern) length"""
+    usable = len(buf) - len(buf) % len(pattern)
+    buf[:len(pattern)] = pattern
+    filled = len(pattern)
+    while filled < usable:
+        n = min(filled, usable - filled)
+        buf[filled:filled + n] = buf[:n]
+        filled += n
+    return usable
+
+def write_fill(dst, pattern: bytes, length: int, buf: memoryview, skip_zeros: bool = True) -> int:
+    """Write `length` bytes of a repeated pattern; zero runs become holes when allowed"""
+    if skip_zeros and not any(pattern):
+        dst.seek(length, os.SEEK_CUR)
+        return length
+    usable = fill_buffer(buf, pattern)
+    remaining = length
+    while remaining > 0:
+        n = min(usable, remaining)
+        throttle(n)
+        dst.write(buf[:n])
+        remaining -= n
+    return length
@@ -0,0 +1,343 @@
+"""
+OPlus ROM Converter - Output Build Cache
+Finished super images stored under a deterministic build key (region
+config, engine/lpmake version, content hashes of the source images). A
+repeated build with the same key is served from the cache by hardlink,
+reflink or copy instead of being converted again. The cache is kept under
+a size limit by evicting least recently used entries.
+
+Layout:
+    <cache>/entries/<key>.img      cached image
+    <cache>/entries/<key>.json     metadata (size, region, last use)
+    <cache>/fingerprints.json      source hashes by (path, size, mtime)
+
+Usage:
+    python build_cache.py CACHE list | stats | evict [--max-gb N] | clear
+"""
+import os
+import sys
+import json
+import errno
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import List, Dict, Optional, Any
+
+from buffer_pool import get_default_pool, copy_exact
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# Bump when the engine starts producing different bytes for the same inputs
+ENGINE_VERSION = 1
+ENTRY_VERSION = 1
+FINGERPRINT_VERSION = 1
+
+DEFAULT_MAX_BYTES = 100 * GB
+HASH_WORKERS = 4
+
+# How a cached image was handed out
+METHOD_HARDLINK = 'hardlink'
+METHOD_REFLINK = 'reflink'
+METHOD_COPY = 'copy'
+
+FICLONE = 0x40049409  # Linux ioctl: share extents between two files (btrfs, XFS)
+
+@dataclass
+class CacheEntry:
+    """One cached build"""
+    key: str
+    size: int
+    created: float
+    last_used: float
+    nv_id: str = ''
+    rom: str = ''
+
+def _hash_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f, get_default_pool().buffer() as buf:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(buf[:n])
+    return h.hexdigest()
+
+def _allocated(path: Path) -> int:
+    st = path.stat()
+    blocks = getattr(st, 'st_blocks', None)
+    return min(st.st_size, blocks * 512) if blocks is not None else st.st_size
+
+def _reflink(src: Path, dst: Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        try:
+            dst.unlink()
+        except OSError:
+            pass
+        return False
+
+def _copy_sparse(src: Path, dst: Path):
+    """Copy src, skipping the holes the OS reports (SEEK_DATA/SEEK_HOLE)"""
+    size = src.stat().st_size
+    with open(src, 'rb') as s, open(dst, 'wb') as d, get_default_pool().buffer() as buf:
+        pos = 0
+        while pos < size:
+            end = size
+            if hasattr(os, 'SEEK_DATA'):
+                try:
+                    pos = os.lseek(s.fileno(), pos, os.SEEK_DATA)
+                    end = os.lseek(s.fileno(), pos, os.SEEK_HOLE)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        break  # Only a hole is left
+            s.seek(pos)
+            d.seek(pos)
+            copy_exact(s, d, end - pos, buf)
+            pos = end
+        d.truncate(size)
+
+class BuildCache:
+    """Local cache of finished super images keyed by build inputs"""
+
+    def __init__(self, root: Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        (self.root / 'entries').mkdir(parents=True, exist_ok=True)
+
+    # --- Keys ---
+
+    def _load_fingerprints(self) -> Dict[str, Dict]:
+        try:
+            with open(self.root / 'fingerprints.json', 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == FINGERPRINT_VERSION:
+                return data.get('files', {})
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def _save_fingerprints(self, files: Dict[str, Dict]):
+        tmp = self.root / f'fingerprints.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': FINGERPRINT_VERSION, 'files': files}, f)
+        os.replace(tmp, self.root / 'fingerprints.json')
+
+    def fingerprints(self, paths: List[Path]) -> Dict[str, str]:
+        """SHA-256 of each file; unchanged files (same size and mtime) are not re-read"""
+        with self._lock:
+            known = self._load_fingerprints()
+        result: Dict[str, str] = {}
+        todo = []
+        for path in paths:
+            st = path.stat()
+            cached = known.get(str(path.resolve()))
+            if cached and cached['size'] == st.st_size and cached['mtime_ns'] == st.st_mtime_ns:
+                result[str(path)] = cached['sha256']
+            else:
+                todo.append((path, st))
+        if todo:
+            with ThreadPoolExecutor(max_workers=min(HASH_WORKERS, len(todo))) as pool:
+                digests = list(pool.map(lambda item: _hash_file(item[0]), todo))
+            with self._lock:
+                known = self._load_fingerprints()
+                for (path, st), digest in zip(todo, digests):
+                    result[str(path)] = digest
+                    known[str(path.resolve())] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': digest}
+                self._save_fingerprints(known)
+        return result
+
+    def build_key(self, config: Any, rom_folder: Path, lpmake: Optional[Path] = None,
+                  options: Optional[Dict[str, Any]] = None) -> str:
+        """Deterministic key of a build: same key, same output bytes
+
+        Covers the region config (minus its file location), ENGINE_VERSION,
+        the lpmake binary, output-affecting options and the content of every
+        source image, so it matches across stations and extraction folders.
+        """
+        layout = asdict(config)
+        layout.pop('config_file', None)
+        sources = [Path(rom_folder) / p.path for p in config.partitions if p.path]
+        present = [p for p in sources if p.exists()]
+        digests = self.fingerprints(present)
+        inputs = {
+            'engine': ENGINE_VERSION,
+            'lpmake': self.fingerprints([lpmake])[str(lpmake)] if lpmake and lpmake.exists() else None,
+            'config': layout,
+            'options': options or {},
+            'sources': {p.name: digests.get(str(rom_folder / p.path)) for p in config.partitions if p.path},
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    # --- Entries ---
+
+    def _image_path(self, key: str) -> Path:
+        return self.root / 'entries' / f'{key}.img'
+
+    def _entry_path(self, key: str) -> Path:
+        return self.root / 'entries' / f'{key}.json'
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        try:
+            with open(self._entry_path(key), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.pop('version', None) != ENTRY_VERSION:
+                return None
+            entry = CacheEntry(**data)
+        except (OSError, ValueError, TypeError):
+            return None
+        try:
+            if self._image_path(key).stat().st_size != entry.size:
+                return None  # Image damaged or replaced
+        except OSError:
+            return None
+        return entry
+
+    def _write_entry(self, entry: CacheEntry):
+        tmp = self._entry_path(entry.key).with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': ENTRY_VERSION, **asdict(entry)}, f, indent=2)
+        os.replace(tmp, self._entry_path(entry.key))
+
+    def entries(self) -> List[CacheEntry]:
+        result = []
+        for path in (self.root / 'entries').glob('*.json'):
+            entry = self.get(path.stem)
+            if entry:
+                result.append(entry)
+        return sorted(result, key=lambda e: e.last_used)
+
+    def _place(self, src: Path, dst: Path) -> str:
+        """Make dst have src's content as cheaply as the filesystem allows"""
+        tmp = dst.with_name(f'.{dst.name}.{os.getpid()}.tmp')
+        try:
+            os.link(src, tmp)
+            method = METHOD_HARDLINK
+        except OSError:
+            if _reflink(src, tmp):
+                method = METHOD_REFLINK
+            else:
+                _copy_sparse(src, tmp)
+                method = METHOD_COPY
+        try:
+            os.replace(tmp, dst)
+        except OSError:
+            tmp.unlink()
+            raise
+        return method
+
+    def fetch(self, key: str, output_path: Path) -> Optional[str]:
+        """Put the cached image for key at output_path, return the method or None on a miss"""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        method = self._place(self._image_path(key), output_path)
+        entry.last_used = time.time()
+        self._write_entry(entry)
+        return method
+
+    def store(self, key: str, image_path: Path, nv_id: str = '', rom: str = '') -> str:
+        """Add a finished image (hardlinked when possible), then evict down to max_bytes"""
+        method = self._place(image_path, self._image_path(key))
+        now = time.time()
+        self._write_entry(CacheEntry(key=key, size=image_path.stat().st_size, created=now,
+                                     last_used=now, nv_id=nv_id, rom=rom))
+        self.evict(keep=key)
+        return method
+
+    def remove(self, key: str):
+        for path in (self._entry_path(key), self._image_path(key)):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def usage(self) -> int:
+        """Bytes the cached images occupy on disk"""
+        total = 0
+        for entry in self.entries():
+            try:
+                total += _allocated(self._image_path(entry.key))
+            except OSError:
+                pass
+        return total
+
+    def evict(self, keep: Optional[str] = None) -> List[str]:
+        """Remove least recently used entries until the cache fits max_bytes"""
+        removed = []
+        entries = self.entries()
+        sizes = {}
+        for entry in entries:
+            try:
+                sizes[entry.key] = _allocated(self._image_path(entry.key))
+            except OSError:
+                sizes[entry.key] = 0
+        total = sum(sizes.values())
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry.key == keep:
+                continue
+            self.remove(entry.key)
+            total -= sizes[entry.key]
+            removed.append(entry.key)
+        return removed
+
+    def clear(self):
+        for entry in self.entries():
+            self.remove(entry.key)
+
+def build_cache_from_env() -> Optional[BuildCache]:
+    """QFF_BUILD_CACHE=DIR enables the cache, QFF_BUILD_CACHE_GB sets its size limit"""
+    root = os.environ.get('QFF_BUILD_CACHE')
+    if not root:
+        return None
+    try:
+        max_bytes = int(float(os.environ.get('QFF_BUILD_CACHE_GB', '')) * GB)
+    except ValueError:
+        max_bytes = DEFAULT_MAX_BYTES
+    return BuildCache(Path(root), max_bytes)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Inspect and trim the super image build cache')
+    parser.add_argument('cache', type=Path)
+    parser.add_argument('--max-gb', type=float, default=DEFAULT_MAX_BYTES / GB, help='size limit for evict')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list')
+    sub.add_parser('stats')
+    sub.add_parser('evict', help='remove least recently used entries above --max-gb')
+    sub.add_parser('clear', help='remove every entry')
+    args = parser.parse_args(argv)
+
+    cache = BuildCache(args.cache, int(args.max_gb * GB))
+    if args.command == 'list':
+        for entry in reversed(cache.entries()):
+            used = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.last_used))
+            print(f"{entry.key[:16]}  {entry.size / GB:6.2f} GB  {used}  {entry.nv_id:10} {entry.rom}")
+    elif args.command == 'stats':
+        entries = cache.entries()
+        print(f"entries: {len(entries)}")
+        print(f"logical: {sum(e.size for e in entries) / GB:.2f} GB")
+        print(f"on disk: {cache.usage() / GB:.2f} GB")
+    elif args.command == 'evict':
+        removed = cache.evict()
+        print(f"Evicted {len(removed)} entries")
+    elif args.command == 'clear':
+        cache.clear()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""
+OPlus ROM Converter - Build History
+Every build run by the GUI, watch folder or job server is recorded in a
+local SQLite database: ROM, region, total/stage/partition durations,
+bytes, throughput, peak memory and outcome. The report shows daily trends
+and flags runs much slower than the median of builds of a similar size.
+
+Usage:
+    python build_history.py list [--last 20]
+    python build_history.py show ID
+    python build_history.py report [--days 30] [--factor 1.5]
+"""
+import os
+import sys
+import time
+import sqlite3
+import platform
+import argparse
+import statistics
+from contextlib import closing
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Dict, Optional, Any, Tuple
+
+from tracing import Tracer, BYTES_READ, BYTES_WRITTEN, CACHE_HIT
+
+MB = 1024 * 1024
+
+SCHEMA_VERSION = 1
+
+OUTCOME_OK = 'ok'
+OUTCOME_CACHED = 'cached'
+OUTCOME_FAILED = 'failed'
+
+# Slow-run detection: peers are successful builds whose input size is within
+# SIZE_TOLERANCE; a run needs MIN_PEERS of them to be judged
+SLOW_FACTOR = 1.5
+SIZE_TOLERANCE = 0.2
+MIN_PEERS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    rom TEXT, nv_id TEXT, region TEXT, host TEXT,
+    input_bytes INTEGER, output_bytes INTEGER,
+    bytes_read INTEGER, bytes_written INTEGER,
+    peak_rss_kb INTEGER,
+    outcome TEXT NOT NULL, error TEXT
+);
+CREATE TABLE IF NOT EXISTS stages (
+    build_id INTEGER NOT NULL REFERENCES builds(id) ON DELETE CASCADE,
+    name TEXT NOT NULL, duration REAL NOT NULL, calls INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS partitions (
+    build_id INTEGER NOT NULL REFERENCES builds(id) ON DELETE CASCADE,
+    name TEXT NOT NULL, duration REAL NOT NULL, bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS builds_started ON builds(started);
+"""
+
+@dataclass
+class BuildRun:
+    """One recorded create_super_image run"""
+    started: float
+    duration: float
+    rom: str
+    nv_id: str
+    region: str
+    outcome: str
+    input_bytes: int = 0
+    output_bytes: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    peak_rss_kb: Optional[int] = None
+    error: Optional[str] = None
+    host: str = field(default_factory=platform.node)
+    stages: Dict[str, Tuple[float, int]] = field(default_factory=dict)       # name -> (seconds, calls)
+    partitions: Dict[str, Tuple[float, int]] = field(default_factory=dict)   # name -> (seconds, bytes)
+    id: Optional[int] = None
+
+    @property
+    def mb_per_s(self) -> float:
+        """Source data processed per second"""
+        return self.input_bytes / MB / self.duration if self.duration > 0 else 0.0
+
+def peak_rss_kb() -> Optional[int]:
+    """Peak resident memory of this process (None where unsupported)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss  # macOS reports bytes
+
+def run_from_trace(tracer: Tracer, config: Any, rom_folder: Path, output_path: Path,
+                   started: float, ok: bool, error: Optional[str] = None) -> BuildRun:
+    """Turn the spans/counters collected during a build into a BuildRun"""
+    stages: Dict[str, List[float]] = {}
+    partitions: Dict[str, float] = {}
+    extents: Dict[str, float] = {}
+    total = 0.0
+    for event in tracer.events:
+        if event['ph'] != 'X':
+            continue
+        seconds = event['dur'] / 1e6
+        if event['name'] == 'build':
+            total = max(total, seconds)
+            continue
+        stage = stages.setdefault(event['cat'], [0.0, 0])
+        stage[0] += seconds
+        stage[1] += 1
+        if event['name'].startswith('decode:'):
+            partitions[event['name'][len('decode:'):]] = seconds
+        elif event['name'].startswith('extent:'):
+            name = event['name'][len('extent:'):]
+            extents[name] = extents.get(name, 0.0) + seconds
+    # Native writer reading sparse images directly: time summed over its parallel pieces
+    partitions = partitions or extents
+
+    sizes = {}
+    for p in config.partitions:
+        if p.path:
+            try:
+                sizes[p.name] = (Path(rom_folder) / p.path).stat().st_size
+            except OSError:
+                sizes[p.name] = 0
+    cached = ok and tracer.counters.get(CACHE_HIT, 0) > 0
+    try:
+        output_bytes = output_path.stat().st_size if ok else 0
+    except OSError:
+        output_bytes = 0
+    return BuildRun(
+        started=started, duration=total or (time.time() - started),
+        rom=Path(rom_folder).name, nv_id=config.nv_id, region=config.nv_text,
+        outcome=OUTCOME_CACHED if cached else (OUTCOME_OK if ok else OUTCOME_FAILED),
+        input_bytes=sum(sizes.values()), output_bytes=output_bytes,
+        bytes_read=tracer.counters.get(BYTES_READ, 0), bytes_written=tracer.counters.get(BYTES_WRITTEN, 0),
+        peak_rss_kb=peak_rss_kb(), error=error,
+        stages={k: (v[0], v[1]) for k, v in stages.items()},
+        partitions={k: (v, sizes.get(k, 0)) for k, v in partitions.items()},
+    )
+
+class BuildHistory:
+    """SQLite store of BuildRuns"""
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.executescript(SCHEMA)
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # One short-lived connection per call: builds record from several threads
+        db = sqlite3.connect(str(self.db_path), timeout=30)
+        db.execute("PRAGMA foreign_keys = ON")
+        return db
+
+    def add(self, run: BuildRun) -> int:
+        with closing(self._connect()) as db, db:
+            cur = db.execute(
+                "INSERT INTO builds (started, duration, rom, nv_id, region, host, input_bytes, output_bytes, "
+                "bytes_read, bytes_written, peak_rss_kb, outcome, error) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                (run.started, run.duration, run.rom, run.nv_id, run.region, run.host, run.input_bytes,
+                 run.output_bytes, run.bytes_read, run.bytes_written, run.peak_rss_kb, run.outcome, run.error))
+            run.id = cur.lastrowid
+            db.executemany("INSERT INTO stages VALUES (?,?,?,?)",
+                           [(run.id, name, d, calls) for name, (d, calls) in run.stages.items()])
+            db.executemany("INSERT INTO partitions VALUES (?,?,?,?)",
+                           [(run.id, name, d, n) for name, (d, n) in run.partitions.items()])
+        return run.id
+
+    def _select(self, where: str = '', params: Tuple = (), limit: Optional[int] = None) -> List[BuildRun]:
+        query = ("SELECT id, started, duration, rom, nv_id, region, host, input_bytes, output_bytes, "
+                 "bytes_read, bytes_written, peak_rss_kb, outcome, error FROM builds")
+        if where:
+            query += f" WHERE {where}"
+        query += " ORDER BY started DESC"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        with closing(self._connect()) as db:
+            rows = db.execute(query, params).fetchall()
+        return [BuildRun(id=r[0], started=r[1], duration=r[2], rom=r[3], nv_id=r[4], region=r[5], host=r[6],
+                         input_bytes=r[7], output_bytes=r[8], bytes_read=r[9], bytes_written=r[10],
+                         peak_rss_kb=r[11], outcome=r[12], error=r[13]) for r in rows]
+
+    def runs(self, limit: Optional[int] = None, since: Optional[float] = None) -> List[BuildRun]:
+        """Most recent runs first (stages/partitions not loaded)"""
+        if since is not None:
+            return self._select("started >= ?", (since,), limit)
+        return self._select(limit=limit)
+
+    def get(self, build_id: int) -> Optional[BuildRun]:
+        """One run with its stage and partition breakdown"""
+        found = self._select("id = ?", (build_id,))
+        if not found:
+            return None
+        run = found[0]
+        with closing(self._connect()) as db:
+            stages = db.execute("SELECT name, duration, calls FROM stages WHERE build_id = ?", (build_id,)).fetchall()
+            parts = db.execute("SELECT name, duration, bytes FROM partitions WHERE build_id = ?", (build_id,)).fetchall()
+        run.stages = {name: (d, calls) for name, d, calls in stages}
+        run.partitions = {name: (d, n) for name, d, n in parts}
+        return run
+
+def slow_runs(runs: List[BuildRun], factor: float = SLOW_FACTOR) -> List[Tuple[BuildRun, float]]:
+    """Successful runs slower than factor x the median of similar-size builds, with that median"""
+    built = [r for r in runs if r.outcome == OUTCOME_OK and r.input_bytes]
+    flagged = []
+    for run in built:
+        peers = [p.duration for p in built if p is not run
+                 and abs(p.input_bytes - run.input_bytes) <= SIZE_TOLERANCE * run.input_bytes]
+        if len(peers) < MIN_PEERS:
+            continue
+        median = statistics.median(peers)
+        if run.duration > factor * median:
+            flagged.append((run, median))
+    return flagged
+
+def daily_trend(runs: List[BuildRun]) -> List[Tuple[str, int, int, float, float]]:
+    """(day, builds, failures, median seconds, median MB/s) of the built (non-cached) runs"""
+    days: Dict[str, List[BuildRun]] = {}
+    for run in runs:
+        days.setdefault(time.strftime('%Y-%m-%d', time.localtime(run.started)), []).append(run)
+    trend = []
+    for day, day_runs in sorted(days.items()):
+        built = [r for r in day_runs if r.outcome == OUTCOME_OK]
+        failed = sum(1 for r in day_runs if r.outcome == OUTCOME_FAILED)
+        trend.append((day, len(day_runs), failed,
+                      statistics.median(r.duration for r in built) if built else 0.0,
+                      statistics.median(r.mb_per_s for r in built) if built else 0.0))
+    return trend
+
+def default_db_path() -> Path:
+    """QFF_HISTORY_DB, else ~/.qflashforge/build_history.sqlite"""
+    env = os.environ.get('QFF_HISTORY_DB')
+    return Path(env) if env else Path.home() / '.qflashforge' / 'build_history.sqlite'
+
+def default_history() -> Optional[BuildHistory]:
+    """History used by the front ends (QFF_HISTORY=0 turns recording off)"""
+    if os.environ.get('QFF_HISTORY', '1') == '0':
+        return None
+    try:
+        return BuildHistory(default_db_path())
+    except (OSError, sqlite3.Error):
+        return None
+
+def _format_run(run: BuildRun) -> str:
+    when = time.strftime('%Y-%m-%d %H:%M', time.localtime(run.started))
+    rate = f"{run.mb_per_s:7.1f} MB/s" if run.outcome == OUTCOME_OK else ''
+    return (f"{run.id:>5}  {when}  {run.rom[:28]:28} {run.nv_id:10} {run.outcome:7}"
+            f"{run.duration:8.1f}s {run.input_bytes / MB:8.0f} MB {rate}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Query the build history database')
+    parser.add_argument('--db', type=Path, default=None, help='database (default QFF_HISTORY_DB or ~/.qflashforge)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('list', help='recent builds')
+    p.add_argument('--last', type=int, default=20)
+    p = sub.add_parser('show', help='stage and partition breakdown of one build')
+    p.add_argument('id', type=int)
+    p = sub.add_parser('report', help='daily trend and unusually slow builds')
+    p.add_argument('--days', type=int, default=30)
+    p.add_argument('--factor', type=float, default=SLOW_FACTOR, help='slow if > FACTOR x peer median')
+    args = parser.parse_args(argv)
+
+    history = BuildHistory(args.db or default_db_path())
+    if args.command == 'list':
+        for run in history.runs(args.last):
+            print(_format_run(run))
+    elif args.command == 'show':
+        run = history.get(args.id)
+        if run is None:
+            print(f"ERROR: no build {args.id}")
+            return 1
+        print(_format_run(run))
+        if run.error:
+            print(f"  error: {run.error}")
+        print(f"  read {run.bytes_read / MB:.0f} MB, wrote {run.bytes_written / MB:.0f} MB, "
+              f"output {run.output_bytes / MB:.0f} MB, peak RSS {(run.peak_rss_kb or 0) / 1024:.0f} MB, host {run.host}")
+        for name, (d, calls) in sorted(run.stages.items(), key=lambda kv: kv[1][0], reverse=True):
+            print(f"  stage {name:20} {d:8.2f}s  ({calls}x)")
+        for name, (d, n) in sorted(run.partitions.items(), key=lambda kv: kv[1][0], reverse=True):
+            rate = n / MB / d if d > 0 else 0.0
+            print(f"  part  {name:20} {d:8.2f}s  {n / MB:8.0f} MB  {rate:7.1f} MB/s")
+    elif args.command == 'report':
+        runs = history.runs(since=time.time() - args.days * 86400)
+        print(f"{'day':12}{'builds':>7}{'failed':>7}{'median s':>10}{'MB/s':>8}")
+        for day, count, failed, median_s, rate in daily_trend(runs):
+            print(f"{day:12}{count:>7}{failed:>7}{median_s:>10.1f}{rate:>8.1f}")
+        flagged = slow_runs(runs, args.factor)
+        print(f"\n{len(flagged)} slow builds (> {args.factor:g}x median of similar-size builds)")
+        for run, median in flagged:
+            print(f"{_format_run(run)}  median {median:.1f}s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
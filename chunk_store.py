@@ -0,0 +1,346 @@
+"""
+OPlus ROM Converter - Content-Addressed Chunk Store
+Dedupes decoded partition data across ROM releases: images are split into
+fixed or content-defined chunks keyed by SHA-256, every unique chunk is
+stored once, and partitions (or super extents) are rebuilt from manifests.
+
+Layout:
+    <store>/chunks/ab/abcdef...   chunk data, named by hash
+    <store>/manifests/<name>.json ordered chunk list of one image
+
+Usage:
+    python chunk_store.py STORE put IMAGE NAME
+    python chunk_store.py STORE restore NAME OUTPUT
+    python chunk_store.py STORE list | stats | gc | remove NAME
+"""
+import os
+import sys
+import json
+import zlib
+import hashlib
+import argparse
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Dict, Optional, Callable, Tuple
+
+from buffer_pool import get_default_pool, copy_stream, write_fill
+from sparse_image import SparseFile, is_sparse_file
+
+MB = 1024 * 1024
+
+CHUNKING_FIXED = 'fixed'
+CHUNKING_CDC = 'cdc'
+
+# Content-defined chunking cuts on block boundaries (filesystem images shift by
+# whole blocks), so per-block CRC32 is enough and keeps scanning at C speed.
+CDC_BLOCK_SIZE = 4096
+
+MANIFEST_VERSION = 1
+
+@dataclass
+class Manifest:
+    """Ordered chunk list of one stored image; a None digest is an all-zero chunk"""
+    name: str
+    size: int
+    sha256: str
+    chunking: str
+    chunks: List[Tuple[Optional[str], int]] = field(default_factory=list)
+    source: Dict = field(default_factory=dict)
+
+@dataclass
+class IngestStats:
+    """What one put() added to the store"""
+    logical_bytes: int = 0
+    new_bytes: int = 0
+    zero_bytes: int = 0
+    chunks: int = 0
+    new_chunks: int = 0
+
+class ChunkStore:
+    """Local content-addressed store of image chunks"""
+
+    def __init__(self, root: Path, chunking: str = CHUNKING_FIXED,
+                 chunk_size: int = 4 * MB, min_chunk: int = 1 * MB, max_chunk: int = 16 * MB):
+        if chunking not in (CHUNKING_FIXED, CHUNKING_CDC):
+            raise ValueError(f"Unknown chunking: {chunking}")
+        self.root = Path(root)
+        self.chunking = chunking
+        self.chunk_size = chunk_size
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk if chunking == CHUNKING_CDC else chunk_size
+        # Average CDC chunk is ~chunk_size: cut when the low bits of a block CRC are all ones
+        self._cdc_mask = (1 << max(0, (chunk_size // CDC_BLOCK_SIZE).bit_length() - 1)) - 1
+        self._zero_digests: Dict[int, str] = {}
+        (self.root / 'chunks').mkdir(parents=True, exist_ok=True)
+        (self.root / 'manifests').mkdir(parents=True, exist_ok=True)
+
+    # --- Paths ---
+
+    def _chunk_path(self, digest: str) -> Path:
+        return self.root / 'chunks' / digest[:2] / digest
+
+    def _manifest_path(self, name: str) -> Path:
+        safe = name.replace('\\', '/').strip('/')
+        if not safe or '..' in safe.split('/'):
+            raise ValueError(f"Invalid manifest name: {name}")
+        return self.root / 'manifests' / f'{safe}.json'
+
+    def _is_zero(self, digest: str, length: int) -> bool:
+        zero = self._zero_digests.get(length)
+        if zero is None:
+            zero = self._zero_digests[length] = hashlib.sha256(bytes(length)).hexdigest()
+        return digest == zero
+
+    # --- Chunking ---
+
+    def _iter_chunks(self, f, buf: memoryview):
+        """Yield memoryviews of consecutive chunks read from f (valid until the next yield)"""
+        if self.chunking == CHUNKING_FIXED:
+            while True:
+                n = f.readinto(buf[:self.chunk_size])
+                if not n:
+                    return
+                # readinto may return short reads on pipes; fill the chunk up
+                while n < self.chunk_size:
+                    m = f.readinto(buf[n:self.chunk_size])
+                    if not m:
+                        break
+                    n += m
+                yield buf[:n]
+            return
+
+        filled = 0
+        eof = False
+        while True:
+            if not eof and filled < self.max_chunk:
+                n = f.readinto(buf[filled:self.max_chunk])
+                if n:
+                    filled += n
+                    continue
+                eof = True
+            if filled == 0:
+                return
+            cut = filled if eof else self.max_chunk
+            pos = self.min_chunk
+            while pos + CDC_BLOCK_SIZE <= filled:
+                if zlib.crc32(buf[pos:pos + CDC_BLOCK_SIZE]) & self._cdc_mask == self._cdc_mask:
+                    cut = pos + CDC_BLOCK_SIZE
+                    break
+                pos += CDC_BLOCK_SIZE
+            cut = min(cut, filled)
+            yield buf[:cut]
+            # Shift the remainder to the front for the next chunk
+            rest = filled - cut
+            buf[:rest] = buf[cut:filled]
+            filled = rest
+
+    # --- Store / restore ---
+
+    def put(self, image_path: Path, name: str, source: Optional[Dict] = None,
+            progress_callback: Optional[Callable[[int, int], None]] = None) -> Tuple[Manifest, IngestStats]:
+        """Split an image into chunks, store the new ones and write its manifest
+
+        A sparse image is stored as its expanded (raw) content. Holds one
+        max_chunk sized buffer (16 MB for CDC) outside the buffer pool.
+        """
+        sparse = is_sparse_file(image_path)
+        stats = IngestStats()
+        whole = hashlib.sha256()
+        chunks = []
+        # Bounded exception to the buffer pool: a chunk is hashed whole before it
+        # is stored, so this takes one max_chunk buffer per put() call
+        buf = memoryview(bytearray(self.max_chunk))
+        with (SparseFile(image_path) if sparse else open(image_path, 'rb')) as f:
+            total = f.size if sparse else os.fstat(f.fileno()).st_size
+            for chunk in self._iter_chunks(f, buf):
+                whole.update(chunk)
+                digest = hashlib.sha256(chunk).hexdigest()
+                length = len(chunk)
+                stats.chunks += 1
+                stats.logical_bytes += length
+                if self._is_zero(digest, length):
+                    chunks.append((None, length))
+                    stats.zero_bytes += length
+                else:
+                    chunks.append((digest, length))
+                    if self._write_chunk(digest, chunk):
+                        stats.new_chunks += 1
+                        stats.new_bytes += length
+                if progress_callback:
+                    progress_callback(stats.logical_bytes, total)
+
+        manifest = Manifest(name=name, size=stats.logical_bytes, sha256=whole.hexdigest(),
+                            chunking=self.chunking, chunks=chunks, source=source or {})
+        self._write_manifest(manifest)
+        return manifest, stats
+
+    def _write_chunk(self, digest: str, data: memoryview) -> bool:
+        path = self._chunk_path(digest)
+        if path.exists():
+            return False
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=f'{digest}.', suffix='.tmp', dir=path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        return True
+
+    def _write_manifest(self, manifest: Manifest):
+        path = self._manifest_path(manifest.name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=f'{path.stem}.', suffix='.tmp', dir=path.parent)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'version': MANIFEST_VERSION, 'name': manifest.name, 'size': manifest.size,
+                           'sha256': manifest.sha256, 'chunking': manifest.chunking,
+                           'source': manifest.source, 'chunks': manifest.chunks}, f)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def lookup(self, name: str, source: Dict) -> Optional[Manifest]:
+        """The manifest stored under name if it was made from this source, None otherwise"""
+        try:
+            manifest = self.get(name)
+        except (OSError, ValueError):
+            return None
+        if manifest is None or manifest.source != source:
+            return None
+        return manifest
+
+    def get(self, name: str) -> Optional[Manifest]:
+        """Load a manifest, None if the name is unknown"""
+        try:
+            with open(self._manifest_path(name), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        return Manifest(name=data['name'], size=data['size'], sha256=data['sha256'],
+                        chunking=data['chunking'], source=data.get('source', {}),
+                        chunks=[(d, n) for d, n in data['chunks']])
+
+    def write_to(self, manifest: Manifest, dst, holes: bool = True) -> int:
+        """Write a manifest's data at dst's current position
+
+        dst may be a fresh raw file (zero chunks become holes) or an open
+        super.img positioned at a partition extent (pass holes=False if the
+        region may hold stale data).
+        """
+        pool = get_default_pool()
+        with pool.buffer() as buf:
+            for digest, length in manifest.chunks:
+                if digest is None:
+                    write_fill(dst, b'\x00\x00\x00\x00', length, buf, skip_zeros=holes)
+                    continue
+                with open(self._chunk_path(digest), 'rb') as src:
+                    if copy_stream(src, dst, buf) != length:
+                        raise IOError(f"Chunk {digest} is corrupt (size mismatch)")
+        return manifest.size
+
+    def restore(self, name: str, output_path: Path) -> bool:
+        """Rebuild a raw image from its manifest"""
+        manifest = self.get(name)
+        if manifest is None:
+            return False
+        with open(output_path, 'wb') as f:
+            self.write_to(manifest, f)
+            f.truncate(manifest.size)
+        return True
+
+    # --- Maintenance ---
+
+    def names(self) -> List[str]:
+        base = self.root / 'manifests'
+        return sorted(p.relative_to(base).as_posix()[:-len('.json')] for p in base.rglob('*.json'))
+
+    def remove(self, name: str) -> bool:
+        """Drop a manifest (run gc() afterwards to free unreferenced chunks)"""
+        try:
+            self._manifest_path(name).unlink()
+            return True
+        except FileNotFoundError:
+            return False
+
+    def gc(self) -> Tuple[int, int]:
+        """Delete chunks no manifest refers to, return (chunks, bytes) freed"""
+        referenced = set()
+        for name in self.names():
+            referenced.update(d for d, _ in self.get(name).chunks if d)
+        freed = freed_bytes = 0
+        for path in (self.root / 'chunks').glob('*/*'):
+            if path.name not in referenced:
+                freed_bytes += path.stat().st_size
+                path.unlink()
+                freed += 1
+        return freed, freed_bytes
+
+    def stats(self) -> Dict:
+        """Logical vs stored size across all manifests"""
+        logical = 0
+        for name in self.names():
+            logical += self.get(name).size
+        stored = chunks = 0
+        for path in (self.root / 'chunks').glob('*/*'):
+            stored += path.stat().st_size
+            chunks += 1
+        return {'manifests': len(self.names()), 'chunks': chunks, 'logical_bytes': logical,
+                'stored_bytes': stored, 'dedupe_ratio': logical / stored if stored else 0.0}
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Content-addressed chunk store for decoded partitions')
+    parser.add_argument('store', type=Path)
+    parser.add_argument('--chunking', choices=(CHUNKING_FIXED, CHUNKING_CDC), default=CHUNKING_FIXED)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('put', help='store a raw image under NAME')
+    p.add_argument('image', type=Path)
+    p.add_argument('name')
+    p = sub.add_parser('restore', help='rebuild a raw image from NAME')
+    p.add_argument('name')
+    p.add_argument('output', type=Path)
+    p = sub.add_parser('remove', help='drop a manifest')
+    p.add_argument('name')
+    sub.add_parser('list')
+    sub.add_parser('stats')
+    sub.add_parser('gc', help='delete unreferenced chunks')
+    args = parser.parse_args(argv)
+
+    store = ChunkStore(args.store, args.chunking)
+    if args.command == 'put':
+        manifest, stats = store.put(args.image, args.name)
+        print(f"{manifest.name}: {stats.chunks} chunks, {stats.new_bytes / MB:.1f} MB new, "
+              f"{(stats.logical_bytes - stats.new_bytes - stats.zero_bytes) / MB:.1f} MB deduped, "
+              f"{stats.zero_bytes / MB:.1f} MB zero")
+    elif args.command == 'restore':
+        if not store.restore(args.name, args.output):
+            print(f"ERROR: {args.name} not in store")
+            return 1
+        print(f"Restored {args.name} -> {args.output}")
+    elif args.command == 'remove':
+        if not store.remove(args.name):
+            print(f"ERROR: {args.name} not in store")
+            return 1
+    elif args.command == 'list':
+        for name in store.names():
+            print(name)
+    elif args.command == 'stats':
+        for key, value in store.stats().items():
+            print(f"{key}: {value}")
+    elif args.command == 'gc':
+        freed, freed_bytes = store.gc()
+        print(f"Freed {freed} chunks ({freed_bytes / MB:.1f} MB)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,18 +4,59 @@ Handles sparse image conversion and super partition creation
 Supports multiple region/NV configurations
 """
 import os
-import sys
 import json
-import subprocess
+import time
+import sqlite3
 import xml.etree.ElementTree as ET
-from dataclasses import dataclass
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, asdict, replace
 from typing import List, Dict, Optional, Callable, Tuple
 from pathlib import Path
 import struct
 import shutil
 
-# Sparse image magic
-SPARSE_HEADER_MAGIC = 0xED26FF3A
+from buffer_pool import BufferPool, get_default_pool, copy_stream
+from write_pipeline import PipelineOptions, WriteBehindPipeline
+from chunk_store import ChunkStore
+from parallel_compress import compress_file, archive_path
+from fs_size import read_filesystem_info, trimmed_size
+from sparse_image import (
+    SPARSE_HEADER_MAGIC, SPARSE_HEADER_FORMAT, CHUNK_HEADER_FORMAT,
+    CHUNK_TYPE_RAW, CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE,
+    SEGMENT_HOLE, encode_raw_to_sparse
+)
+from lp_metadata import LpMetadataError
+from lp_unpack import unpack_super, SuperSource
+from lp_metadata import read_metadata, LpPartition, LP_TARGET_TYPE_ZERO
+from scratch_plan import estimate_need, plan_scratch, scratch_dirs_from_env
+from tracing import span, traced, count, collect, BYTES_READ, BYTES_WRITTEN, CACHE_HIT
+from build_cache import BuildCache
+from build_history import BuildHistory, run_from_trace
+from backends import (
+    get_tools_dir, convert_sparse_to_raw, convert_sparse_to_raw_native,
+    SuperLayout, select_decoder, select_assembler, AUTO
+)
+from io_schedule import SCHEDULE_AUTO, SCHEDULE_SEQUENTIAL, physical_order, resolve_schedule
+from io_throttle import job_activity
+from zip_verify import verify_zip
+from extract_index import ExtractIndex, extract_member, DEDUP_MIN_SIZE
+from file_io import zip_member_target, unshare
+
+# Region scanning: parallel super_def parsing and its (optional) on-disk cache
+SCAN_WORKERS = 8
+SUPER_DEF_CACHE_NAME = '.super_def_cache.json'
+SUPER_DEF_CACHE_VERSION = 1
+
+# Concurrent header probes for the partition table
+PROBE_WORKERS = 8
+
+# ZipExtFile reads are fastest in small slices; larger requests just concatenate
+ZIP_STREAM_CHUNK = 64 * 1024
+
+# Read size when comparing super contents against the source images
+VERIFY_CHUNK = 1024 * 1024
 
 @dataclass
 class PartitionInfo:
@@ -46,6 +87,25 @@ class RegionInfo:
     config_path: Path
     used_size: int
     partition_count: int
+    config: Optional[SuperConfig] = field(default=None, repr=False, compare=False)
+
+@dataclass
+class ImageProbe:
+    """Stat + header probe of one partition image"""
+    path: Path
+    exists: bool
+    is_sparse: bool = False
+    file_size: int = 0
+    raw_size: int = 0  # Decoded size (file size for raw images)
+    
+    @property
+    def sparse_ratio(self) -> float:
+        """Bytes on disk per decoded byte"""
+        return self.file_size / self.raw_size if self.raw_size else 1.0
+    
+    def fits(self, partition: PartitionInfo) -> bool:
+        """Decoded image fits the partition size from super_def"""
+        return self.exists and self.raw_size <= partition.size
 
 @dataclass
 class RawprogramEntry:
@@ -58,14 +118,13 @@ class RawprogramEntry:
     sector_size: int
     sparse: bool
 
-def get_tools_dir() -> Path:
-    """Get the tools directory (bundled or development)"""
-    if getattr(sys, 'frozen', False):
-        # Running as compiled exe
-        return Path(sys._MEIPASS) / 'tools'
-    else:
-        # Running in development
-        return Path(__file__).parent.parent / 'Tools'
+# Parsed super_def cache: path -> (mtime_ns, size, RegionInfo)
+_region_cache: Dict[str, Tuple[int, int, RegionInfo]] = {}
+_region_cache_lock = threading.Lock()
+
+# Probed images: path -> (mtime_ns, size, ImageProbe)
+_probe_cache: Dict[str, Tuple[int, int, ImageProbe]] = {}
+_probe_cache_lock = threading.Lock()
 
 def is_sparse_image(img_path: Path) -> bool:
     """Check if an image file is sparse format"""
@@ -76,76 +135,79 @@ def is_sparse_image(img_path: Path) -> bool:
     except Exception:
         return False
 
+def _parse_sparse_header(header: bytes) -> Optional[Dict]:
+    """Decode the sparse file header, None if it is not a sparse image"""
+    if len(header) < struct.calcsize(SPARSE_HEADER_FORMAT):
+        return None
+    (magic, major_ver, minor_ver, file_hdr_sz, chunk_hdr_sz,
+     block_size, total_blocks, total_chunks, _checksum) = struct.unpack(
+        SPARSE_HEADER_FORMAT, header[:struct.calcsize(SPARSE_HEADER_FORMAT)])
+    if magic != SPARSE_HEADER_MAGIC:
+        return None
+    
+    return {
+        'version': f'{major_ver}.{minor_ver}',
+        'block_size': block_size,
+        'total_blocks': total_blocks,
+        'total_chunks': total_chunks,
+        'raw_size': block_size * total_blocks
+    }
+
 def get_sparse_info(img_path: Path) -> Optional[Dict]:
     """Get sparse image header info"""
     try:
         with open(img_path, 'rb') as f:
-            magic = struct.unpack('<I', f.read(4))[0]
-            if magic != SPARSE_HEADER_MAGIC:
-                return None
-            
-            major_ver = struct.unpack('<H', f.read(2))[0]
-            minor_ver = struct.unpack('<H', f.read(2))[0]
-            file_hdr_sz = struct.unpack('<H', f.read(2))[0]
-            chunk_hdr_sz = struct.unpack('<H', f.read(2))[0]
-            block_size = struct.unpack('<I', f.read(4))[0]
-            total_blocks = struct.unpack('<I', f.read(4))[0]
-            total_chunks = struct.unpack('<I', f.read(4))[0]
-            
-            return {
-                'version': f'{major_ver}.{minor_ver}',
-                'block_size': block_size,
-                'total_blocks': total_blocks,
-                'total_chunks': total_chunks,
-                'raw_size': block_size * total_blocks
-            }
+            return _parse_sparse_header(f.read(struct.calcsize(SPARSE_HEADER_FORMAT)))
     except Exception:
         return None
 
-def find_all_super_defs(rom_folder: Path) -> List[RegionInfo]:
-    """Find all super_def.*.json files and parse region info"""
-    meta_dir = rom_folder / 'META'
-    if not meta_dir.exists():
-        return []
+def probe_image(img_path: Path) -> ImageProbe:
+    """Stat an image and read its header in one go (cached by path + mtime)"""
+    try:
+        st = img_path.stat()
+    except OSError:
+        return ImageProbe(path=img_path, exists=False)
     
-    regions = []
-    for f in sorted(meta_dir.glob('super_def.*.json')):
-        try:
-            with open(f, 'r', encoding='utf-8') as fp:
-                data = json.load(fp)
-            
-            nv_id = data.get('nv_id', f.stem.split('.')[-1])
-            nv_text = data.get('nv_text', 'Unknown')
-            
-            # Get super device info
-            super_device = data.get('super_device', {})
-            used_size = int(super_device.get('used_size', 0))
-            
-            # Count partitions with data and calculate size if not provided
-            partitions_with_data = [p for p in data.get('partitions', []) if p.get('path')]
-            partition_count = len(partitions_with_data)
-            
-            # If used_size is 0, calculate from partition sizes
-            if used_size == 0:
-                used_size = sum(int(p.get('size', 0)) for p in partitions_with_data)
-            
-            regions.append(RegionInfo(
-                nv_id=nv_id,
-                nv_text=nv_text,
-                config_path=f,
-                used_size=used_size,
-                partition_count=partition_count
-            ))
-        except Exception:
-            continue
+    key = str(img_path)
+    with _probe_cache_lock:
+        cached = _probe_cache.get(key)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
     
-    return regions
+    probe = ImageProbe(path=img_path, exists=True, file_size=st.st_size, raw_size=st.st_size)
+    try:
+        with open(img_path, 'rb') as f:
+            info = _parse_sparse_header(f.read(struct.calcsize(SPARSE_HEADER_FORMAT)))
+        if info:
+            probe.is_sparse = True
+            probe.raw_size = info['raw_size']
+    except OSError:
+        pass
+    
+    with _probe_cache_lock:
+        _probe_cache[key] = (st.st_mtime_ns, st.st_size, probe)
+    return probe
 
-def parse_super_def(json_path: Path) -> SuperConfig:
-    """Parse super_def.json configuration"""
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+def probe_images(
+    paths: List[Path],
+    result_callback: Optional[Callable[[int, ImageProbe], None]] = None
+) -> List[ImageProbe]:
+    """Probe many images concurrently, reporting each (index, probe) as it completes"""
+    results: List[Optional[ImageProbe]] = [None] * len(paths)
+    if not paths:
+        return []
     
+    with ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(paths))) as pool:
+        futures = {pool.submit(probe_image, p): i for i, p in enumerate(paths)}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = future.result()
+            if result_callback:
+                result_callback(i, results[i])
+    return results
+
+def _config_from_data(data: Dict, json_path: Path) -> SuperConfig:
+    """Build a SuperConfig from loaded super_def.json data"""
     # Parse block devices
     block_dev = data.get('block_devices', [{}])[0]
     
@@ -172,6 +234,141 @@ def parse_super_def(json_path: Path) -> SuperConfig:
         config_file=str(json_path)
     )
 
+def _region_from_data(data: Dict, f: Path) -> RegionInfo:
+    """Build a RegionInfo (with its parsed SuperConfig) from super_def.json data"""
+    nv_id = data.get('nv_id', f.stem.split('.')[-1])
+    nv_text = data.get('nv_text', 'Unknown')
+    
+    # Get super device info
+    super_device = data.get('super_device', {})
+    used_size = int(super_device.get('used_size', 0))
+    
+    # Count partitions with data and calculate size if not provided
+    partitions_with_data = [p for p in data.get('partitions', []) if p.get('path')]
+    partition_count = len(partitions_with_data)
+    
+    # If used_size is 0, calculate from partition sizes
+    if used_size == 0:
+        used_size = sum(int(p.get('size', 0)) for p in partitions_with_data)
+    
+    return RegionInfo(
+        nv_id=nv_id,
+        nv_text=nv_text,
+        config_path=f,
+        used_size=used_size,
+        partition_count=partition_count,
+        config=_config_from_data(data, f)
+    )
+
+def clear_region_cache():
+    """Forget all parsed super_def files"""
+    with _region_cache_lock:
+        _region_cache.clear()
+
+def _cached_region(f: Path) -> Optional[RegionInfo]:
+    """Cached RegionInfo for f if the file is unchanged (same mtime and size)"""
+    try:
+        st = f.stat()
+    except OSError:
+        return None
+    with _region_cache_lock:
+        cached = _region_cache.get(str(f))
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    return None
+
+def _parse_region(f: Path) -> Optional[RegionInfo]:
+    """Parse one super_def file and cache the result"""
+    try:
+        st = f.stat()
+        with open(f, 'r', encoding='utf-8') as fp:
+            data = json.load(fp)
+        region = _region_from_data(data, f)
+        with _region_cache_lock:
+            _region_cache[str(f)] = (st.st_mtime_ns, st.st_size, region)
+        return region
+    except Exception:
+        return None
+
+def _load_persisted_regions(meta_dir: Path):
+    """Seed the in-memory cache from META/.super_def_cache.json"""
+    try:
+        with open(meta_dir / SUPER_DEF_CACHE_NAME, 'r', encoding='utf-8') as fp:
+            entries = json.load(fp)
+        if entries.get('version') != SUPER_DEF_CACHE_VERSION:
+            return
+        for name, e in entries.get('files', {}).items():
+            f = meta_dir / name
+            config = dict(e['config'])
+            config['partitions'] = [PartitionInfo(**p) for p in config['partitions']]
+            config['config_file'] = str(f)
+            region = RegionInfo(config_path=f, config=SuperConfig(**config), **e['region'])
+            with _region_cache_lock:
+                _region_cache.setdefault(str(f), (e['mtime_ns'], e['size'], region))
+    except Exception:
+        pass
+
+def _save_persisted_regions(meta_dir: Path, regions: List[RegionInfo]):
+    """Write parsed regions to META/.super_def_cache.json (best effort)"""
+    files = {}
+    with _region_cache_lock:
+        for region in regions:
+            mtime_ns, size, _ = _region_cache[str(region.config_path)]
+            config = asdict(region.config)
+            del config['config_file']
+            files[region.config_path.name] = {
+                'mtime_ns': mtime_ns,
+                'size': size,
+                'region': {'nv_id': region.nv_id, 'nv_text': region.nv_text,
+                           'used_size': region.used_size, 'partition_count': region.partition_count},
+                'config': config,
+            }
+    try:
+        tmp = meta_dir / (SUPER_DEF_CACHE_NAME + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump({'version': SUPER_DEF_CACHE_VERSION, 'files': files}, fp)
+        os.replace(tmp, meta_dir / SUPER_DEF_CACHE_NAME)
+    except OSError:
+        pass
+
+def find_all_super_defs(rom_folder: Path, persist_cache: bool = False) -> List[RegionInfo]:
+    """Find all super_def.*.json files and parse region info
+    
+    Files are parsed concurrently into full SuperConfig objects (RegionInfo.config)
+    and cached by path + mtime, so rescans and region switches don't re-parse.
+    With persist_cache the parsed data is also kept in META/.super_def_cache.json.
+    Returned objects are shared with the cache; treat them as read-only.
+    """
+    meta_dir = rom_folder / 'META'
+    if not meta_dir.exists():
+        return []
+    
+    files = sorted(meta_dir.glob('super_def.*.json'))
+    if not files:
+        return []
+    
+    if persist_cache:
+        _load_persisted_regions(meta_dir)
+    
+    results = {f: _cached_region(f) for f in files}
+    misses = [f for f, region in results.items() if region is None]
+    if misses:
+        with ThreadPoolExecutor(max_workers=min(SCAN_WORKERS, len(misses))) as pool:
+            results.update(zip(misses, pool.map(_parse_region, misses)))
+    regions = [results[f] for f in files if results[f] is not None]
+    
+    if persist_cache and misses and regions:
+        _save_persisted_regions(meta_dir, regions)
+    
+    return regions
+
+def parse_super_def(json_path: Path) -> SuperConfig:
+    """Parse super_def.json configuration"""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    
+    return _config_from_data(data, json_path)
+
 def find_super_def(rom_folder: Path) -> Optional[Path]:
     """Find first super_def.json in META folder (legacy compatibility)"""
     meta_dir = rom_folder / 'META'
@@ -221,43 +418,21 @@ def find_rawprogram_xmls(rom_folder: Path) -> List[Path]:
     
     return sorted(xmls)
 
-def convert_sparse_to_raw(
-    img_path: Path,
+def convert_raw_to_sparse(
+    raw_path: Path,
     output_path: Path,
-    log_callback: Optional[Callable[[str], None]] = None
+    log_callback: Optional[Callable[[str], None]] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None
 ) -> bool:
-    """Convert sparse image to raw using simg2img"""
-    tools_dir = get_tools_dir()
-    simg2img = tools_dir / 'simg2img.exe'
-    
-    if not simg2img.exists():
-        if log_callback:
-            log_callback(f"ERROR: simg2img.exe not found at {simg2img}")
-        return False
-    
-    if log_callback:
-        log_callback(f"Converting {img_path.name}...")
-    
+    """Convert raw image to sparse in-process (img2simg equivalent)"""
     try:
-        result = subprocess.run(
-            [str(simg2img), str(img_path), str(output_path)],
-            capture_output=True,
-            text=True,
-            timeout=600  # 10 minutes timeout
-        )
-        
-        if result.returncode == 0:
-            if log_callback:
-                log_callback(f"Converted: {img_path.name} -> {output_path.name}")
-            return True
-        else:
-            if log_callback:
-                log_callback(f"ERROR: {result.stderr}")
-            return False
-    except subprocess.TimeoutExpired:
         if log_callback:
-            log_callback(f"ERROR: Conversion timeout for {img_path.name}")
-        return False
+            log_callback(f"Encoding: {raw_path.name} -> {output_path.name}")
+        stats = encode_raw_to_sparse(raw_path, output_path, progress_callback=progress_callback)
+        if log_callback:
+            log_callback(f"Sparse: {stats.raw_size/(1024**2):.0f} MB -> "
+                         f"{stats.sparse_size/(1024**2):.0f} MB ({stats.chunks} chunks)")
+        return True
     except Exception as e:
         if log_callback:
             log_callback(f"ERROR: {str(e)}")
@@ -268,145 +443,485 @@ def create_super_image(
     rom_folder: Path,
     output_path: Path,
     log_callback: Optional[Callable[[str], None]] = None,
-    progress_callback: Optional[Callable[[int, int], None]] = None
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    pipeline_options: Optional[PipelineOptions] = None,
+    chunk_store: Optional[ChunkStore] = None,
+    archive_format: Optional[str] = None,
+    trim_to_filesystem: bool = False,
+    scratch_dirs: Optional[List[Path]] = None,
+    build_cache: Optional[BuildCache] = None,
+    history: Optional[BuildHistory] = None,
+    io_schedule: str = SCHEDULE_AUTO,
+    decoder: str = AUTO,
+    assembler: str = AUTO
 ) -> bool:
-    """Create super.img from partitions using lpmake"""
-    tools_dir = get_tools_dir()
-    lpmake = tools_dir / 'lpmake.exe'
+    """Create super.img from partitions using lpmake (or another assembler backend)
     
-    if not lpmake.exists():
+    decoder / assembler name the backends (see backends): 'simg2img' or
+    'native' for decoding, 'lpmake' or 'native' for assembly, 'auto' for the
+    fastest on this machine (the default; QFF_DECODER / QFF_ASSEMBLER
+    override it).
+    With pipeline_options, stage 1 decodes in-process and overlaps reading
+    the ROM with writing the raw files (write-behind thread).
+    With chunk_store, every partition is also deduplicated into the store as
+    "<rom folder>/<partition>" so it can be rebuilt later. Partitions whose
+    source is unchanged since they were stored are not stored again, and
+    are restored from the store instead of decoded when a raw copy is needed.
+    With archive_format ('gzip' or 'xz'), the finished image is additionally
+    compressed block-parallel next to it (super.img.gz / super.img.xz).
+    With trim_to_filesystem, decoded ext4/EROFS images are cut to the end of
+    their filesystem (rounded up to the block size) and sized accordingly.
+    Decoded raw files go to scratch_dirs (default QFF_SCRATCH_DIRS, then the
+    output folder); space is planned up front and the build refuses to
+    start if the raw files and output can't fit.
+    With build_cache, a build whose inputs match a cached one is served from
+    the cache (hardlink/reflink/copy) and new outputs are added to it.
+    With history, the run (stage/partition timings, bytes, outcome) is
+    recorded in the build history database.
+    The native assembler lays super.img out in-process: extents are
+    preallocated and filled in parallel (sparse images straight from the ROM
+    unless trimming needs decoded files), and the LP
+    metadata is written last.
+    io_schedule ('auto', 'parallel' or 'sequential') picks the I/O order;
+    auto goes sequential when the ROM or output is on a rotational disk:
+    images are decoded in their on-disk order with read-ahead hints and the
+    native writer fills super.img front to back with one large stream.
+    Every build is announced via job_activity, so background-mode builds
+    (see io_throttle) back off while it runs.
+    """
+    options = dict(pipeline_options=pipeline_options, chunk_store=chunk_store, archive_format=archive_format,
+                   trim_to_filesystem=trim_to_filesystem, scratch_dirs=scratch_dirs, build_cache=build_cache,
+                   io_schedule=io_schedule, decoder=decoder, assembler=assembler)
+    with job_activity('build'):
+        if history is None:
+            return _create_super_image(config, rom_folder, output_path, log_callback, progress_callback, **options)
+        return _create_recorded(config, rom_folder, output_path, log_callback, progress_callback, history, options)
+
+def _create_recorded(
+    config: SuperConfig,
+    rom_folder: Path,
+    output_path: Path,
+    log_callback: Optional[Callable[[str], None]],
+    progress_callback: Optional[Callable[[int, int], None]],
+    history: BuildHistory,
+    options: Dict
+) -> bool:
+    """_create_super_image with its run recorded in the build history"""
+    errors = []
+    def log(msg: str):
+        if msg.startswith('ERROR'):
+            errors.append(msg)
+        if log_callback:
+            log_callback(msg)
+    
+    started = time.time()
+    ok = False
+    with collect() as tracer:
+        try:
+            ok = _create_super_image(config, rom_folder, output_path, log, progress_callback, **options)
+        finally:
+            try:
+                run = run_from_trace(tracer, config, rom_folder, output_path, started, ok,
+                                     errors[-1] if errors else None)
+                history.add(run)
+            except (OSError, sqlite3.Error) as e:
+                if log_callback:
+                    log_callback(f"WARNING: Could not record build history: {e}")
+    return ok
+
+@traced('build')
+def _create_super_image(
+    config: SuperConfig,
+    rom_folder: Path,
+    output_path: Path,
+    log_callback: Optional[Callable[[str], None]] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    pipeline_options: Optional[PipelineOptions] = None,
+    chunk_store: Optional[ChunkStore] = None,
+    archive_format: Optional[str] = None,
+    trim_to_filesystem: bool = False,
+    scratch_dirs: Optional[List[Path]] = None,
+    build_cache: Optional[BuildCache] = None,
+    io_schedule: str = SCHEDULE_AUTO,
+    decoder: str = AUTO,
+    assembler: str = AUTO
+) -> bool:
+    """create_super_image without history recording"""
+    try:
+        decode_backend = select_decoder(decoder or AUTO, log_callback=log_callback)
+        assemble_backend = select_assembler(assembler or AUTO, log_callback=log_callback)
+    except ValueError as e:
+        if log_callback:
+            log_callback(f"ERROR: {e}")
+        return False
+    problem = assemble_backend.check()
+    if problem:
         if log_callback:
-            log_callback(f"ERROR: lpmake.exe not found at {lpmake}")
+            log_callback(f"ERROR: {problem}")
         return False
+    if decode_backend.in_process and pipeline_options is None:
+        pipeline_options = PipelineOptions()
     
-    # Prepare temporary raw files directory
-    temp_dir = output_path.parent / '_temp_raw'
-    temp_dir.mkdir(exist_ok=True)
+    # A hardlinked output shares its data with a cache entry: never rewrite it in place
+    unshare(output_path)
+    
+    cache_key = None
+    if build_cache:
+        try:
+            with span('cache:lookup'):
+                key_options = {'trim_to_filesystem': trim_to_filesystem}
+                if assemble_backend.name != 'lpmake':
+                    key_options['assembler'] = assemble_backend.name  # Layouts may differ
+                cache_key = build_cache.build_key(config, rom_folder, assemble_backend.tool(), key_options)
+                method = build_cache.fetch(cache_key, output_path)
+        except OSError as e:
+            method = None
+            if log_callback:
+                log_callback(f"WARNING: Build cache unavailable: {e}")
+        if method:
+            count(CACHE_HIT)
+            if log_callback:
+                log_callback(f"Build cache hit ({method}): {output_path.name}, key {cache_key[:16]}")
+            if archive_format and not archive_super_image(output_path, archive_format, log_callback,
+                                                          _known_zero_ranges(output_path, rom_folder, config)):
+                return False
+            if progress_callback:
+                progress_callback(1, 1)
+            return True
     
     # Get partitions with actual data (have path)
     data_partitions = [p for p in config.partitions if p.path]
     total = len(data_partitions)
     
+    # The native writer reads sparse images directly unless a decoded copy is needed anyway
+    direct = assemble_backend.reads_sparse and not trim_to_filesystem
+    
+    # Partitions already in the chunk store from this very source image
+    stored = {}
+    if chunk_store:
+        for partition in data_partitions:
+            source = _chunk_source(rom_folder, partition)
+            manifest = source and chunk_store.lookup(f"{rom_folder.name}/{partition.name}", source)
+            if manifest:
+                stored[partition.name] = manifest
+    
+    # Plan scratch space for the decoded images before writing anything
+    needs = []
+    for partition in data_partitions if not direct else []:
+        try:
+            need = estimate_need(partition.name, rom_folder / partition.path, holes=decode_backend.in_process)
+        except (OSError, ValueError):
+            need = None  # Missing or damaged: reported in stage 1
+        if need:
+            needs.append(need)
+    if scratch_dirs is None:
+        scratch_dirs = scratch_dirs_from_env()
+    output_bytes = config.super_size
+    if output_path.exists():
+        output_bytes -= min(output_bytes, output_path.stat().st_size)  # Overwritten in place
+    with span('plan:scratch', partitions=len(needs)):
+        plan = plan_scratch(needs, output_path.parent, output_bytes, scratch_dirs)
+    if not plan.ok:
+        if log_callback:
+            log_callback(f"ERROR: {plan.message}")
+        return False
+    if log_callback and needs:
+        log_callback(plan.message)
+    
+    # Prepare temporary raw files directories
+    temp_dirs = {}
+    for scratch in set(plan.placements.values()) | {output_path.parent}:
+        temp_dirs[scratch] = scratch / '_temp_raw'
+        temp_dirs[scratch].mkdir(parents=True, exist_ok=True)
+    
+    # Only the read order changes; the super layout stays in super_def order
+    decode_order = data_partitions
+    io_schedule = resolve_schedule(io_schedule, [rom_folder, output_path.parent] + list(plan.placements.values()))
+    if io_schedule == SCHEDULE_SEQUENTIAL:
+        # Spinning disk: read the images where they lie instead of in super_def order
+        sources = [rom_folder / p.path for p in data_partitions]
+        decode_order = [data_partitions[i] for i in physical_order(sources)]
+        if pipeline_options:
+            pipeline_options = replace(pipeline_options, fadvise=True)
+        if log_callback:
+            log_callback("Rotational disk: using the sequential I/O schedule")
+    
     if log_callback:
+        log_callback(f"Backends: decode={decode_backend.name}, assemble={assemble_backend.name}")
         log_callback(f"Stage 1: Converting {total} images to raw...")
         log_callback(f"Region: {config.nv_text} (NV ID: {config.nv_id})")
     
     raw_files = {}
     converted = 0
+    pipeline = WriteBehindPipeline(pipeline_options) if decode_backend.in_process else None
     
-    for i, partition in enumerate(data_partitions):
-        if progress_callback:
-            progress_callback(i, total * 2)  # *2 for two stages
-        
-        img_path = rom_folder / partition.path
-        if not img_path.exists():
-            if log_callback:
-                log_callback(f"WARNING: {partition.path} not found, skipping")
-            continue
-        
-        # Check if sparse
-        if is_sparse_image(img_path):
-            raw_path = temp_dir / f"{partition.name}.raw"
-            if convert_sparse_to_raw(img_path, raw_path, log_callback):
-                raw_files[partition.name] = raw_path
+    try:
+        for i, partition in enumerate(decode_order):
+            if progress_callback:
+                progress_callback(i, total * 2)  # *2 for two stages
+            
+            img_path = rom_folder / partition.path
+            if not img_path.exists():
+                if log_callback:
+                    log_callback(f"WARNING: {partition.path} not found, skipping")
+                continue
+            
+            # Check if sparse
+            if is_sparse_image(img_path) and direct:
+                raw_files[partition.name] = img_path
                 converted += 1
-        else:
-            # Already raw, just use it
-            raw_files[partition.name] = img_path
-            converted += 1
-            if log_callback:
-                log_callback(f"Using raw: {img_path.name}")
+                if log_callback:
+                    log_callback(f"Using sparse: {img_path.name}")
+            elif is_sparse_image(img_path):
+                scratch = plan.placements.get(partition.name, output_path.parent)
+                raw_path = temp_dirs[scratch] / f"{partition.name}.raw"
+                ok = False
+                if partition.name in stored:
+                    try:
+                        with span(f'restore:{partition.name}'):
+                            ok = chunk_store.restore(f"{rom_folder.name}/{partition.name}", raw_path)
+                    except OSError as e:
+                        if log_callback:
+                            log_callback(f"WARNING: Could not restore {partition.name} from chunk store: {e}")
+                    if ok and log_callback:
+                        log_callback(f"Restored unchanged {partition.name} from chunk store")
+                if not ok:
+                    with span(f'decode:{partition.name}', backend=decode_backend.name):
+                        ok = decode_backend.decode(img_path, raw_path, log_callback, pipeline)
+                if ok:
+                    raw_files[partition.name] = raw_path
+                    converted += 1
+            else:
+                # Already raw, just use it
+                raw_files[partition.name] = img_path
+                converted += 1
+                if log_callback:
+                    log_callback(f"Using raw: {img_path.name}")
+    finally:
+        pipeline_error = None
+        if pipeline:
+            # The assembler must only see fully flushed raw files
+            try:
+                with span('write-behind:drain'):
+                    pipeline.close()
+            except IOError as e:
+                pipeline_error = e
+    
+    if pipeline_error:
+        if log_callback:
+            log_callback(f"ERROR: {pipeline_error}")
+        return False
     
     if converted == 0:
         if log_callback:
             log_callback("ERROR: No partition images found to merge")
         return False
     
-    if log_callback:
-        log_callback(f"Stage 2: Creating super.img with {converted} partitions...")
+    if chunk_store:
+        with span('store:chunks'):
+            store_partitions(chunk_store, rom_folder, [p for p in data_partitions if p.name not in stored],
+                             raw_files, log_callback)
+        if stored and log_callback:
+            log_callback(f"Chunk store: {len(stored)} unchanged partitions already stored")
     
-    # Build lpmake command
-    cmd = [
-        str(lpmake),
-        '--device-size', str(config.super_size),
-        '--metadata-size', '65536',
-        '--metadata-slots', '3',
-        '--output', str(output_path)
-    ]
-    
-    # Collect groups that have actual partitions with data
-    used_groups = set()
-    for partition in data_partitions:
-        if partition.name in raw_files:
-            used_groups.add(partition.group_name)
-    
-    # Add only groups that have partitions (skip empty groups like 'default')
-    added_groups = set()
-    for group in config.groups:
-        group_name = group.get('name', '')
-        # Skip if already added or if group has no partitions
-        if group_name in added_groups or group_name not in used_groups:
-            continue
-        max_size = group.get('maximum_size', '0')
-        cmd.extend(['--group', f"{group_name}:{max_size}"])
-        added_groups.add(group_name)
-        if log_callback:
-            log_callback(f"Added group: {group_name} (max: {int(max_size)/(1024**3):.2f} GB)")
-    
-    # Add partitions
-    for partition in data_partitions:
-        if partition.name in raw_files:
-            raw_path = raw_files[partition.name]
-            file_size = raw_path.stat().st_size
-            cmd.extend([
-                '--partition', f"{partition.name}:readonly:{file_size}:{partition.group_name}",
-                '--image', f"{partition.name}={raw_path}"
-            ])
+    if trim_to_filesystem:
+        with span('trim'):
+            trim_partitions(raw_files, list(temp_dirs.values()), config.block_size, log_callback)
     
     if log_callback:
-        log_callback(f"Running lpmake with {converted} partitions...")
+        log_callback(f"Stage 2: Creating super.img with {converted} partitions...")
     
     try:
         if progress_callback:
             progress_callback(total, total * 2)
+        groups = _used_groups(config, data_partitions, raw_files)
+        for group_name, max_size in groups:
+            if log_callback:
+                log_callback(f"Added group: {group_name} (max: {max_size/(1024**3):.2f} GB)")
+        layout = SuperLayout(config.super_size, config.alignment, config.block_size, groups,
+                             [(p.name, p.group_name, raw_files[p.name]) for p in data_partitions if p.name in raw_files])
         
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=1800  # 30 minutes timeout
-        )
+        def on_progress(done: int, written: int):
+            if progress_callback and written:
+                progress_callback(total + total * done // written, total * 2)
         
-        if result.returncode == 0:
-            size_gb = output_path.stat().st_size / (1024**3)
-            if log_callback:
-                log_callback(f"Super merge completed! Size: {size_gb:.2f} GB")
-                log_callback(f"Output: {output_path}")
-            
-            # Cleanup temp files
-            if log_callback:
-                log_callback("Cleaning up temporary files...")
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            
-            if progress_callback:
-                progress_callback(total * 2, total * 2)
-            
-            return True
-        else:
-            if log_callback:
-                log_callback(f"ERROR: lpmake failed")
-                log_callback(result.stderr[:500] if result.stderr else "Unknown error")
+        if not assemble_backend.assemble(layout, output_path, log_callback, on_progress, io_schedule):
             return False
-            
-    except subprocess.TimeoutExpired:
+        
+        size_gb = output_path.stat().st_size / (1024**3)
         if log_callback:
-            log_callback("ERROR: lpmake timeout (>30 min)")
-        return False
+            log_callback(f"Super merge completed! Size: {size_gb:.2f} GB")
+            log_callback(f"Output: {output_path}")
+        
+        # Cleanup temp files
+        if log_callback:
+            log_callback("Cleaning up temporary files...")
+        with span('cleanup'):
+            for temp_dir in temp_dirs.values():
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        
+        if build_cache and cache_key:
+            try:
+                with span('cache:store'):
+                    build_cache.store(cache_key, output_path, config.nv_id, rom_folder.name)
+                if log_callback:
+                    log_callback(f"Added to build cache (key {cache_key[:16]})")
+            except OSError as e:
+                if log_callback:
+                    log_callback(f"WARNING: Could not add to build cache: {e}")
+        
+        if archive_format and not archive_super_image(output_path, archive_format, log_callback,
+                                                      _known_zero_ranges(output_path, rom_folder, config)):
+            return False
+        
+        if progress_callback:
+            progress_callback(total * 2, total * 2)
+        
+        return True
     except Exception as e:
         if log_callback:
             log_callback(f"ERROR: {str(e)}")
         return False
 
+def _used_groups(config: SuperConfig, data_partitions: List[PartitionInfo],
+                 raw_files: Dict[str, Path]) -> List[Tuple[str, int]]:
+    """(name, maximum_size) of the groups that have partitions with data, in config order"""
+    used_groups = {p.group_name for p in data_partitions if p.name in raw_files}
+    groups = []
+    for group in config.groups:
+        group_name = group.get('name', '')
+        # Skip if already added or if group has no partitions (e.g. 'default')
+        if group_name in used_groups and group_name not in (g[0] for g in groups):
+            groups.append((group_name, int(group.get('maximum_size', '0'))))
+    return groups
+
+def trim_partitions(
+    raw_files: Dict[str, Path],
+    temp_dirs: List[Path],
+    block_size: int,
+    log_callback: Optional[Callable[[str], None]] = None
+) -> int:
+    """Truncate decoded images to their filesystem size, return bytes saved
+    
+    Only files in temp_dirs (our own decoded copies) are touched; raw images
+    taken straight from the ROM folder are left as they are.
+    """
+    saved = 0
+    for name, raw_path in raw_files.items():
+        if raw_path.parent not in temp_dirs:
+            continue
+        size = trimmed_size(raw_path, block_size)
+        if size is None:
+            continue
+        old_size = raw_path.stat().st_size
+        try:
+            with open(raw_path, 'r+b') as f:
+                f.truncate(size)
+        except OSError as e:
+            if log_callback:
+                log_callback(f"WARNING: Could not trim {name}: {e}")
+            continue
+        saved += old_size - size
+        if log_callback:
+            fs_type = read_filesystem_info(raw_path).fs_type
+            log_callback(f"Trimmed {name} ({fs_type}): {old_size/(1024**2):.0f} MB -> {size/(1024**2):.0f} MB")
+    if saved and log_callback:
+        log_callback(f"Filesystem trimming saved {saved/(1024**2):.0f} MB")
+    return saved
+
+def _chunk_source(rom_folder: Path, partition: PartitionInfo) -> Optional[Dict]:
+    """Source record kept in a partition's chunk store manifest, None if the image is missing"""
+    try:
+        st = (rom_folder / partition.path).stat()
+    except OSError:
+        return None
+    return {'path': partition.path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def store_partitions(
+    chunk_store: ChunkStore,
+    rom_folder: Path,
+    partitions: List[PartitionInfo],
+    raw_files: Dict[str, Path],
+    log_callback: Optional[Callable[[str], None]] = None
+):
+    """Deduplicate partitions into a chunk store (best effort; sparse images are expanded)"""
+    for partition in partitions:
+        raw_path = raw_files.get(partition.name)
+        if not raw_path:
+            continue
+        try:
+            manifest, stats = chunk_store.put(
+                raw_path, f"{rom_folder.name}/{partition.name}", source=_chunk_source(rom_folder, partition))
+            if log_callback:
+                log_callback(f"Stored {partition.name}: {stats.new_bytes/(1024**2):.1f} MB new of "
+                             f"{stats.logical_bytes/(1024**2):.1f} MB")
+        except Exception as e:
+            if log_callback:
+                log_callback(f"WARNING: Could not store {partition.name} in chunk store: {e}")
+
+def super_zero_ranges(super_path: Path, images: Dict[str, Path]) -> List[Tuple[int, int]]:
+    """(offset, length) regions of a built super.img that are known to be zero
+
+    Holes and zero fills of each partition's source image, plus the extent
+    space after the image, mapped through the LP metadata. A trimmed copy is
+    a prefix of its source, so the ROM images describe trimmed builds too.
+    """
+    with SuperSource(super_path) as src:
+        metadata = read_metadata(src.read_at)
+    ranges = []
+    for partition in metadata.partitions:
+        holes = []  # Partition coordinates
+        image_size = 0
+        if partition.name in images:
+            with SuperSource(images[partition.name]) as image:
+                image_size = image.size
+                holes = [(off, n) for kind, off, n, _ in image.segments(0, image.size) if kind == SEGMENT_HOLE]
+        if partition.size > image_size:
+            holes.append((image_size, partition.size - image_size))
+        pos = 0
+        for extent in partition.extents:
+            if extent.target_type != LP_TARGET_TYPE_ZERO:
+                for off, n in holes:
+                    start, end = max(off, pos), min(off + n, pos + extent.size)
+                    if start < end:
+                        ranges.append((extent.offset + start - pos, end - start))
+            pos += extent.size
+    return sorted(ranges)
+
+def _known_zero_ranges(super_path: Path, rom_folder: Path, config: SuperConfig) -> Optional[List[Tuple[int, int]]]:
+    """super_zero_ranges for a build of config, None if the images can't be read"""
+    images = {p.name: rom_folder / p.path for p in config.partitions if p.path}
+    try:
+        with span('archive:zero-ranges'):
+            return super_zero_ranges(super_path, {n: p for n, p in images.items() if p.exists()})
+    except (LpMetadataError, OSError, ValueError):
+        return None
+
+def archive_super_image(
+    image_path: Path,
+    archive_format: str,
+    log_callback: Optional[Callable[[str], None]] = None,
+    zero_ranges: Optional[List[Tuple[int, int]]] = None
+) -> bool:
+    """Compress a finished image block-parallel on all cores (image is kept)
+
+    zero_ranges (see super_zero_ranges) are skipped without being read.
+    """
+    out = archive_path(image_path, archive_format)
+    if log_callback:
+        log_callback(f"Archiving {image_path.name} -> {out.name}...")
+    try:
+        with span(f'archive:{archive_format}'):
+            stats = compress_file(image_path, out, archive_format, zero_ranges=zero_ranges)
+    except Exception as e:
+        if log_callback:
+            log_callback(f"ERROR: Archiving failed: {e}")
+        return False
+    if log_callback:
+        log_callback(f"Archived: {stats.bytes_out/(1024**3):.2f} GB "
+                     f"({stats.zero_blocks}/{stats.blocks} blocks empty)")
+    return True
+
 def check_super_exists(rom_folder: Path) -> bool:
     """Check if super.img already exists"""
     images_dir = rom_folder / 'IMAGES'
@@ -420,6 +935,166 @@ def get_super_path(rom_folder: Path, nv_id: Optional[str] = None) -> Path:
         return images_dir / f'super.{nv_id}.img'
     return images_dir / 'super.img'
 
+def unpack_super_image(
+    super_path: Path,
+    out_dir: Path,
+    partitions: Optional[List[str]] = None,
+    sparse_output: bool = False,
+    log_callback: Optional[Callable[[str], None]] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+) -> bool:
+    """Extract partitions from a raw or sparse super.img (all, or the named ones)"""
+    if log_callback:
+        log_callback(f"Unpacking {super_path.name} -> {out_dir}")
+    try:
+        outputs = unpack_super(super_path, out_dir, partitions, sparse_output,
+                               log_callback=log_callback, progress_callback=progress_callback)
+    except (LpMetadataError, OSError, ValueError) as e:
+        if log_callback:
+            log_callback(f"ERROR: Unpack failed: {e}")
+        return False
+    if log_callback:
+        log_callback(f"Unpacked {len(outputs)} partitions")
+    return True
+
+def _verify_partition(super_path: Path, lp_partition: LpPartition, img_path: Path) -> Optional[str]:
+    """Compare one partition in super with its source image, describe the first difference"""
+    with span(f'verify:{lp_partition.name}'), SuperSource(super_path) as sup, SuperSource(img_path) as src:
+        pos = 0
+        for extent in lp_partition.extents:
+            for delta in range(0, extent.size, VERIFY_CHUNK):
+                n = min(VERIFY_CHUNK, extent.size - delta)
+                # Source shorter than the partition: the rest must read as zeros
+                expected = src.read_at(pos, n) if pos < src.size else b''
+                expected += bytes(n - len(expected))
+                if extent.target_type == LP_TARGET_TYPE_ZERO:
+                    actual = bytes(n)
+                else:
+                    actual = sup.read_at(extent.offset + delta, n)
+                count(BYTES_READ, 2 * n)
+                if actual != expected:
+                    index = next(i for i in range(n) if actual[i] != expected[i])
+                    return f"differs at offset {pos + index}"
+                pos += n
+        # A source larger than the partition is only fine if the rest is padding
+        while pos < src.size:
+            n = min(VERIFY_CHUNK, src.size - pos)
+            if any(src.read_at(pos, n)):
+                return f"source has data past the partition end ({src.size} > {lp_partition.size})"
+            pos += n
+    return None
+
+@traced('verify')
+def verify_super_image(
+    config: SuperConfig,
+    rom_folder: Path,
+    super_path: Path,
+    log_callback: Optional[Callable[[str], None]] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+) -> bool:
+    """Check a built super.img: LP metadata is valid and every partition matches its image"""
+    try:
+        with SuperSource(super_path) as sup:
+            metadata = read_metadata(sup.read_at)
+    except (LpMetadataError, OSError, ValueError) as e:
+        if log_callback:
+            log_callback(f"ERROR: {super_path.name}: {e}")
+        return False
+    
+    jobs = []
+    ok = True
+    for partition in config.partitions:
+        if not partition.path:
+            continue
+        lp_partition = metadata.partition(partition.name)
+        if lp_partition is None:
+            if log_callback:
+                log_callback(f"ERROR: {partition.name} missing from {super_path.name}")
+            ok = False
+            continue
+        jobs.append((partition.name, lp_partition, rom_folder / partition.path))
+    
+    if log_callback:
+        log_callback(f"Verifying {len(jobs)} partitions in {super_path.name}...")
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(PROBE_WORKERS, len(jobs)))) as pool:
+        futures = {pool.submit(_verify_partition, super_path, lp, img): name for name, lp, img in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                problem = future.result()
+            except (LpMetadataError, OSError, ValueError) as e:
+                problem = str(e)
+            if problem:
+                ok = False
+                if log_callback:
+                    log_callback(f"ERROR: {name}: {problem}")
+            done += 1
+            if progress_callback:
+                progress_callback(done, len(jobs))
+    if log_callback:
+        log_callback("Verify OK" if ok else "Verify FAILED")
+    return ok
+
+@traced('extract')
+def extract_rom_zip(
+    zip_path: Path,
+    out_dir: Path,
+    log_callback: Optional[Callable[[str], None]] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    pool: Optional[BufferPool] = None,
+    verify: bool = False,
+    index: Optional[ExtractIndex] = None
+) -> bool:
+    """Extract a ROM archive into out_dir, streaming members through the buffer pool
+    
+    With verify, the archive is CRC-checked first (see zip_verify) and
+    nothing is extracted from a damaged one. With an index, large members
+    already extracted from another archive are linked instead (see extract_index).
+    """
+    pool = pool or get_default_pool()
+    if verify and not verify_zip(zip_path, log_callback=log_callback, progress_callback=progress_callback).ok:
+        return False
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zf, pool.buffer() as buf:
+            infos = zf.infolist()
+            total = sum(1 for x in infos if not x.is_dir())
+            current = 0
+            linked = linked_bytes = 0
+            
+            for info in infos:
+                if info.is_dir(): continue
+                target = zip_member_target(Path(out_dir), info.filename)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                if index and info.file_size >= DEDUP_MIN_SIZE:
+                    if index.link_known(zf, Path(zip_path), info, target):
+                        linked += 1
+                        linked_bytes += info.file_size
+                    else:
+                        unshare(target)
+                        with open(target, 'wb') as dst:
+                            sha256, packed = extract_member(zf, Path(zip_path), info, dst, buf[:ZIP_STREAM_CHUNK])
+                        index.record(info, target, sha256, packed)
+                        count(BYTES_READ, info.compress_size)
+                        count(BYTES_WRITTEN, info.file_size)
+                else:
+                    unshare(target)
+                    with zf.open(info) as src, open(target, 'wb') as dst:
+                        copy_stream(src, dst, buf[:ZIP_STREAM_CHUNK])
+                    count(BYTES_READ, info.compress_size)
+                    count(BYTES_WRITTEN, info.file_size)
+                current += 1
+                # Update every 5 files to reduce UI lag per file
+                if progress_callback and (current % 5 == 0 or current == total):
+                    progress_callback(current, total)
+        if linked and log_callback:
+            log_callback(f"Linked {linked} known members ({linked_bytes / (1024**3):.2f} GB) instead of extracting")
+        return True
+    except Exception as e:
+        if log_callback:
+            log_callback(f"Extraction Error: {e}")
+        return False
+
 def get_region_display_name(region: RegionInfo) -> str:
     """Get a display-friendly name for a region"""
     size_gb = region.used_size / (1024**3)
@@ -0,0 +1,357 @@
+"""
+OPlus ROM Converter - Deduplicated Extraction
+ROM versions kept side by side share most of their large IMAGES/* members
+byte for byte. The extract index, a local SQLite database, remembers the
+members extracted so far, keyed by (CRC-32, size) from the ZIP central
+directory. When an archive contains a known member, extraction reflinks
+(else hardlinks) the earlier file instead of decompressing it again.
+
+Before linking, a match is confirmed by hash. The SHA-256 of the member's
+compressed bytes is compared when both archives compressed it the same way,
+so nothing needs inflating. Otherwise the SHA-256 of its content is compared;
+that content is inflated but not written. The earlier file must also be
+unchanged since it was indexed: same size and mtime, or else the same
+SHA-256 when re-read.
+
+Usage:
+    python extract_index.py stats
+    python extract_index.py add ROM.zip ROM_FOLDER   # index an existing extraction
+    python extract_index.py prune                    # forget files that are gone or changed
+"""
+import os
+import sys
+import time
+import zlib
+import struct
+import sqlite3
+import hashlib
+import zipfile
+import argparse
+from contextlib import closing
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from build_cache import _reflink, METHOD_HARDLINK, METHOD_REFLINK
+from buffer_pool import copy_stream
+from file_io import zip_member_target
+from io_throttle import throttle
+from tracing import span
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+SCHEMA_VERSION = 1
+
+# Smaller members are cheaper to inflate than to look up and confirm
+DEDUP_MIN_SIZE = 1 * MB
+HASH_READ_SIZE = 4 * MB
+
+LOCAL_HEADER_FORMAT = '<4s2B4HL2L2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    crc INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    packed_sha256 TEXT,
+    method INTEGER,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    added REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS members_key ON members(crc, size);
+"""
+
+@dataclass
+class IndexedFile:
+    """An extracted member on disk"""
+    crc: int
+    size: int
+    sha256: str                     # Content
+    packed_sha256: Optional[str]    # Compressed bytes in the source archive
+    method: Optional[int]           # ZIP compression method of those bytes
+    path: str
+    mtime_ns: int
+
+class HashingWriter:
+    """File wrapper that hashes what is written through it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self, data) -> int:
+        self.hash.update(data)
+        return self.f.write(data)
+
+def _member_data_offset(f, info: zipfile.ZipInfo) -> int:
+    """Offset of a member's compressed bytes (after its local header)"""
+    f.seek(info.header_offset)
+    header = f.read(LOCAL_HEADER_SIZE)
+    if len(header) < LOCAL_HEADER_SIZE or header[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+    name_len, extra_len = struct.unpack(LOCAL_HEADER_FORMAT, header)[-2:]
+    return info.header_offset + LOCAL_HEADER_SIZE + name_len + extra_len
+
+def packed_sha256(zip_path: Path, info: zipfile.ZipInfo) -> str:
+    """SHA-256 of a member's compressed bytes, read straight from the archive"""
+    h = hashlib.sha256()
+    with open(zip_path, 'rb') as f:
+        f.seek(_member_data_offset(f, info))
+        left = info.compress_size
+        while left:
+            data = f.read(min(HASH_READ_SIZE, left))
+            if not data:
+                raise EOFError(f"Unexpected end of {Path(zip_path).name} in {info.filename}")
+            h.update(data)
+            left -= len(data)
+    return h.hexdigest()
+
+def extract_member(zf: zipfile.ZipFile, zip_path: Path, info: zipfile.ZipInfo, dst,
+                   buf: memoryview) -> Tuple[str, Optional[str]]:
+    """Extract a member into dst, return the SHA-256 of its content and of its compressed bytes
+
+    Stored and deflated members are inflated here from the raw archive bytes, so
+    both hashes come from a single read. Other methods go through zipfile and
+    have no compressed hash.
+    """
+    if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or info.flag_bits & 0x1:
+        writer = HashingWriter(dst)
+        with zf.open(info) as src:
+            copy_stream(src, writer, buf)
+        return writer.hash.hexdigest(), None
+    packed = hashlib.sha256()
+    content = hashlib.sha256()
+    crc = written = 0
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS) if info.compress_type == zipfile.ZIP_DEFLATED else None
+
+    def write(data: bytes):
+        nonlocal crc, written
+        content.update(data)
+        crc = zlib.crc32(data, crc)
+        written += len(data)
+        dst.write(data)
+
+    with open(zip_path, 'rb') as f:
+        f.seek(_member_data_offset(f, info))
+        left = info.compress_size
+        while left:
+            n = f.readinto(buf[:min(len(buf), left)])
+            if not n:
+                raise EOFError(f"Unexpected end of {Path(zip_path).name} in {info.filename}")
+            throttle(2 * n)
+            chunk = buf[:n]
+            packed.update(chunk)
+            left -= n
+            if inflater is None:
+                write(chunk)
+                continue
+            # Bounded output: zero-filled images inflate ~1000x
+            data = inflater.decompress(chunk, len(buf))
+            while data:
+                write(data)
+                data = inflater.decompress(inflater.unconsumed_tail, len(buf)) if inflater.unconsumed_tail else b''
+        if inflater is not None:
+            write(inflater.flush())
+    if crc != info.CRC or written != info.file_size:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+    return content.hexdigest(), packed.hexdigest()
+
+def content_sha256(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> str:
+    """SHA-256 of a member's content (inflated in memory, not written)"""
+    h = hashlib.sha256()
+    with zf.open(info) as src:
+        while True:
+            data = src.read(HASH_READ_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def _file_sha256_crc(path: Path) -> Tuple[str, int]:
+    h = hashlib.sha256()
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(HASH_READ_SIZE)
+            if not data:
+                break
+            h.update(data)
+            crc = zlib.crc32(data, crc)
+    return h.hexdigest(), crc
+
+def _link(src: Path, dst: Path) -> Optional[str]:
+    """Give dst src's content without copying: reflink (independent copy-on-write) or hardlink"""
+    tmp = dst.with_name(f'.{dst.name}.{os.getpid()}.tmp')
+    if _reflink(src, tmp):
+        method = METHOD_REFLINK
+    else:
+        try:
+            os.link(src, tmp)
+            method = METHOD_HARDLINK
+        except OSError:
+            return None  # Other filesystem: extract instead
+    try:
+        os.replace(tmp, dst)
+    except OSError:
+        tmp.unlink()
+        raise
+    return method
+
+class ExtractIndex:
+    """SQLite index of extracted ZIP members by (CRC-32, size)"""
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.executescript(SCHEMA)
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # One short-lived connection per call: extractions may run on several threads
+        return sqlite3.connect(str(self.db_path), timeout=30)
+
+    def add(self, entry: IndexedFile):
+        with closing(self._connect()) as db, db:
+            db.execute("INSERT OR REPLACE INTO members (crc, size, sha256, packed_sha256, method, path, "
+                       "mtime_ns, added) VALUES (?,?,?,?,?,?,?,?)",
+                       (entry.crc, entry.size, entry.sha256, entry.packed_sha256, entry.method,
+                        entry.path, entry.mtime_ns, time.time()))
+
+    def forget(self, path: str):
+        with closing(self._connect()) as db, db:
+            db.execute("DELETE FROM members WHERE path = ?", (path,))
+
+    def candidates(self, crc: int, size: int) -> List[IndexedFile]:
+        with closing(self._connect()) as db:
+            rows = db.execute("SELECT crc, size, sha256, packed_sha256, method, path, mtime_ns FROM members "
+                              "WHERE crc = ? AND size = ? ORDER BY added DESC", (crc, size)).fetchall()
+        return [IndexedFile(*row) for row in rows]
+
+    def entries(self) -> List[IndexedFile]:
+        with closing(self._connect()) as db:
+            rows = db.execute("SELECT crc, size, sha256, packed_sha256, method, path, mtime_ns FROM members").fetchall()
+        return [IndexedFile(*row) for row in rows]
+
+    def _unchanged(self, entry: IndexedFile) -> bool:
+        """The indexed file still has the content it was indexed with (forgotten if not)"""
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            self.forget(entry.path)
+            return False
+        if st.st_size != entry.size:
+            self.forget(entry.path)
+            return False
+        if st.st_mtime_ns != entry.mtime_ns:
+            sha256, _crc = _file_sha256_crc(Path(entry.path))
+            if sha256 != entry.sha256:
+                self.forget(entry.path)
+                return False
+            entry.mtime_ns = st.st_mtime_ns
+            self.add(entry)
+        return True
+
+    def record(self, info: zipfile.ZipInfo, target: Path, sha256: str, packed: Optional[str]):
+        """Index a member just extracted to target (hashes of its content and compressed bytes)"""
+        self.add(IndexedFile(info.CRC, info.file_size, sha256, packed, info.compress_type,
+                             str(Path(target).absolute()), target.stat().st_mtime_ns))
+
+    def link_known(self, zf: zipfile.ZipFile, zip_path: Path, info: zipfile.ZipInfo,
+                   target: Path) -> Optional[str]:
+        """Link an identical, earlier extracted file to target; the link method or None if there is none"""
+        if info.file_size < DEDUP_MIN_SIZE:
+            return None
+        target_key = str(Path(target).absolute())
+        packed = content = None
+        for entry in self.candidates(info.CRC, info.file_size):
+            if entry.path == target_key or not self._unchanged(entry):
+                continue
+            with span(f'dedup:{info.filename}', size=info.file_size):
+                if entry.packed_sha256 and entry.method == info.compress_type:
+                    packed = packed or packed_sha256(zip_path, info)
+                    if packed != entry.packed_sha256:
+                        continue
+                else:
+                    content = content or content_sha256(zf, info)
+                    if content != entry.sha256:
+                        continue
+                method = _link(Path(entry.path), target)
+            if method is None:
+                continue
+            self.add(IndexedFile(info.CRC, info.file_size, entry.sha256, packed,
+                                 info.compress_type, target_key, target.stat().st_mtime_ns))
+            return method
+        return None
+
+    def index_folder(self, zip_path: Path, out_dir: Path) -> int:
+        """Index an existing extraction of zip_path; files that differ from their member are skipped"""
+        added = 0
+        with zipfile.ZipFile(zip_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or info.file_size < DEDUP_MIN_SIZE:
+                    continue
+                target = zip_member_target(Path(out_dir), info.filename)
+                try:
+                    if target.stat().st_size != info.file_size:
+                        continue
+                except OSError:
+                    continue
+                sha256, crc = _file_sha256_crc(target)
+                if crc == info.CRC:
+                    self.record(info, target, sha256, packed_sha256(zip_path, info))
+                    added += 1
+        return added
+
+    def prune(self) -> int:
+        """Forget files that are gone or changed, return how many"""
+        removed = 0
+        for entry in self.entries():
+            if not self._unchanged(entry):
+                removed += 1
+        return removed
+
+def default_index_path() -> Path:
+    """QFF_EXTRACT_INDEX, else ~/.qflashforge/extract_index.sqlite"""
+    env = os.environ.get('QFF_EXTRACT_INDEX')
+    return Path(env) if env else Path.home() / '.qflashforge' / 'extract_index.sqlite'
+
+def extract_index_from_env() -> Optional[ExtractIndex]:
+    """Index used by the GUI: only when QFF_EXTRACT_INDEX is set"""
+    if not os.environ.get('QFF_EXTRACT_INDEX'):
+        return None
+    try:
+        return ExtractIndex(default_index_path())
+    except (OSError, sqlite3.Error):
+        return None
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Inspect the index of extracted ROM members')
+    parser.add_argument('--db', type=Path, default=None, help='database (default QFF_EXTRACT_INDEX or ~/.qflashforge)')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('stats')
+    p = sub.add_parser('add', help='index an existing extraction of an archive')
+    p.add_argument('zip', type=Path)
+    p.add_argument('folder', type=Path)
+    sub.add_parser('prune', help='forget files that are gone or changed')
+    args = parser.parse_args(argv)
+
+    index = ExtractIndex(args.db or default_index_path())
+    if args.command == 'stats':
+        entries = index.entries()
+        unique = {(e.crc, e.size) for e in entries}
+        total = sum(e.size for e in entries)
+        stored = sum(size for _crc, size in unique)
+        print(f"{len(entries)} files, {len(unique)} distinct members")
+        print(f"{total / GB:.2f} GB extracted, {stored / GB:.2f} GB distinct ({(total - stored) / GB:.2f} GB shared)")
+    elif args.command == 'add':
+        print(f"Indexed {index.index_folder(args.zip, args.folder)} files")
+    elif args.command == 'prune':
+        print(f"Forgot {index.prune()} files")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
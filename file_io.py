@@ -0,0 +1,97 @@
+"""
+OPlus ROM Converter - File I/O Helpers
+Positional reads/writes that also work on Windows, hole-preserving range
+copies out of raw or sparse images, and safe placement of extracted files.
+Shared by the unpacker, the native super writer and the extractors.
+"""
+import os
+from pathlib import Path
+
+from buffer_pool import fill_buffer
+from io_throttle import throttle, is_throttled
+from sparse_image import SEGMENT_FILL, SEGMENT_HOLE
+
+MB = 1024 * 1024
+
+# copy_file_range step in background mode, so the bandwidth cap stays smooth
+THROTTLED_COPY_SIZE = 4 * MB
+
+def pread(fd: int, length: int, offset: int) -> bytes:
+    """os.pread, or seek + read where it is missing (Windows)"""
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+def pread_into(fd: int, view: memoryview, offset: int) -> int:
+    """Read into view at offset, return the byte count"""
+    if hasattr(os, 'preadv'):
+        return os.preadv(fd, [view], offset)
+    data = pread(fd, len(view), offset)
+    view[:len(data)] = data
+    return len(data)
+
+def pwrite_all(fd: int, data, offset: int):
+    """Write all of data at offset"""
+    view = memoryview(data)
+    if not hasattr(os, 'pwrite'):
+        os.lseek(fd, offset, os.SEEK_SET)
+    while view:
+        n = os.pwrite(fd, view, offset) if hasattr(os, 'pwrite') else os.write(fd, view)
+        view = view[n:]
+        offset += n
+
+def copy_range(src, src_fd: int, dst_fd: int, src_offset: int, dst_offset: int,
+               length: int, buf: memoryview):
+    """Copy one range of src (a SuperSource) into dst_fd, leaving holes where src has none"""
+    for kind, seg_offset, n, source in src.segments(src_offset, length):
+        out = dst_offset + (seg_offset - src_offset)
+        if kind == SEGMENT_HOLE:
+            continue
+        if kind == SEGMENT_FILL:
+            usable = fill_buffer(buf, source)
+            done = 0
+            while done < n:
+                step = min(usable, n - done)
+                throttle(step)
+                pwrite_all(dst_fd, buf[:step], out + done)
+                done += step
+            continue
+        done = 0
+        if hasattr(os, 'copy_file_range'):
+            step = THROTTLED_COPY_SIZE if is_throttled() else n
+            try:
+                while done < n:
+                    throttle(2 * min(step, n - done))
+                    copied = os.copy_file_range(src_fd, dst_fd, min(step, n - done), source + done, out + done)
+                    if not copied:
+                        break
+                    done += copied
+            except OSError:
+                pass  # cross-device or unsupported: fall back to pread/pwrite
+        while done < n:
+            step = min(len(buf), n - done)
+            got = pread_into(src_fd, buf[:step], source + done)
+            if not got:
+                raise EOFError(f"Unexpected end of {src.path.name}")
+            throttle(2 * got)
+            pwrite_all(dst_fd, buf[:got], out + done)
+            done += got
+
+def zip_member_target(out_dir: Path, member_name: str) -> Path:
+    """Resolve a ZIP member name inside out_dir (same sanitising as ZipFile.extract)"""
+    parts = [p for p in member_name.replace('\\', '/').split('/')
+             if p not in ('', '.', '..')]
+    if parts and len(parts[0]) == 2 and parts[0][1] == ':':
+        parts = parts[1:]
+    if not parts:
+        raise ValueError(f"Invalid member name: {member_name}")
+    return out_dir.joinpath(*parts)
+
+def unshare(target: Path):
+    """Remove target if it is a hardlink, so rewriting it can't change the other copies"""
+    try:
+        if target.stat().st_nlink > 1:
+            target.unlink()
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,483 @@
+"""
+OPlus ROM Converter - Encrypted Firmware (OZIP / OFP)
+Factory packages also arrive as encrypted containers. Instead of decrypting
+them to a plain ZIP first (a full extra read and write of the firmware),
+extract_firmware decrypts while it extracts, in parallel pieces on a thread
+pool, each worker with its own file handles, into the usual META/ + IMAGES/
+layout that create_super_image builds from.
+
+- OZIP ("OPPOENCRYPT!" header): a ZIP starting at 0x1050 in which the
+  first 16 bytes of every 0x4010 are AES-128-ECB encrypted. It is read
+  through a decrypting file object, so zipfile extracts it as usual.
+- Qualcomm OFP: an AES-128-CFB encrypted XML index at the end lists the
+  files; only the first 256 KB of most files is encrypted, the rest is
+  copied as is.
+MediaTek OFPs are recognised but not supported.
+
+Vendor keys are not shipped. Put them in a JSON file (QFF_FIRMWARE_KEYS,
+default ~/.qflashforge/firmware_keys.json); the right one is found by
+trial decryption:
+    {"ozip": ["<32 hex>", ...], "ofp_qc": [{"key": "<32 hex>", "iv": "<32 hex>"}, ...]}
+AES comes from the 'cryptography' package (or PyCryptodome).
+
+Usage:
+    python firmware_decrypt.py FIRMWARE.ozip|.ofp OUT_DIR [-j 4] [--keys keys.json]
+    python firmware_decrypt.py FIRMWARE.ozip --to-zip plain.zip
+"""
+import io
+import os
+import sys
+import json
+import struct
+import zipfile
+import argparse
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Dict, Optional, Callable, Tuple
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    try:
+        from cryptography.hazmat.decrepit.ciphers.modes import CFB  # Newer releases moved it here
+    except ImportError:
+        CFB = modes.CFB
+except ImportError:
+    Cipher = None
+try:
+    from Cryptodome.Cipher import AES
+except ImportError:
+    try:
+        from Crypto.Cipher import AES
+    except ImportError:
+        AES = None
+
+from buffer_pool import get_default_pool, copy_stream
+from converter import extract_rom_zip, ZIP_STREAM_CHUNK
+from extract_index import ExtractIndex
+from lp_unpack import SuperSource, COPY_TASK_SIZE
+from file_io import pread, pread_into, pwrite_all, copy_range, zip_member_target, unshare
+from tracing import span, count, traced, BYTES_READ, BYTES_WRITTEN
+from io_throttle import throttle
+
+CONTAINER_ZIP = 'zip'
+CONTAINER_OZIP = 'ozip'
+CONTAINER_OFP_QC = 'ofp_qc'
+CONTAINER_OFP_MTK = 'ofp_mtk'
+CONTAINER_NAMES = {CONTAINER_OZIP: 'OZIP', CONTAINER_OFP_QC: 'Qualcomm OFP'}
+FIRMWARE_SUFFIXES = ('.zip', '.ozip', '.ofp')
+
+OZIP_MAGIC = b'OPPOENCRYPT!'
+OZIP_HEADER_SIZE = 0x1050
+OZIP_BLOCK = 16                       # Encrypted bytes at the start of every period
+OZIP_PERIOD = OZIP_BLOCK + 0x4000
+OZIP_TASK_SIZE = OZIP_PERIOD * 4096   # ~64 MB pieces for --to-zip
+
+OFP_PAGE_SIZES = (0x200, 0x1000)
+OFP_QC_MAGIC = 0x7CEF
+OFP_ENCRYPTED_SIZE = 0x40000
+# Index sections whose files are encrypted as a whole, not just their first 256 KB
+OFP_FULLY_ENCRYPTED = ('Sahara', 'Config', 'Provision', 'ChainedTableOfDigests', 'DigestsToSign', 'Firmware')
+
+NO_CRYPTO = "decrypting needs an AES library: pip install cryptography"
+
+class FirmwareError(Exception):
+    """Unsupported container, no matching key, damaged index..."""
+    pass
+
+@dataclass
+class OfpEntry:
+    """One file in a Qualcomm OFP index"""
+    name: str
+    offset: int          # In the container
+    size: int            # Real size in bytes
+    encrypted: int       # Leading bytes that are encrypted
+
+# --- AES ---
+
+def have_crypto() -> bool:
+    return Cipher is not None or AES is not None
+
+def aes_ecb_decrypt(key: bytes, data: bytes) -> bytes:
+    if Cipher is not None:
+        decryptor = Cipher(algorithms.AES(key), modes.ECB()).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+    if AES is not None:
+        return AES.new(key, AES.MODE_ECB).decrypt(data)
+    raise FirmwareError(NO_CRYPTO)
+
+def aes_cfb_decrypt(key: bytes, iv: bytes, data: bytes) -> bytes:
+    if Cipher is not None:
+        decryptor = Cipher(algorithms.AES(key), CFB(iv)).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+    if AES is not None:
+        return AES.new(key, AES.MODE_CFB, iv=iv, segment_size=128).decrypt(data)
+    raise FirmwareError(NO_CRYPTO)
+
+# --- Keys ---
+
+def default_keys_path() -> Path:
+    return Path(os.environ.get('QFF_FIRMWARE_KEYS') or Path.home() / '.qflashforge' / 'firmware_keys.json')
+
+def load_keys(path: Optional[Path] = None) -> Dict[str, list]:
+    """Candidate keys per container type, decoded to bytes; empty if there is no key file"""
+    path = Path(path) if path else default_keys_path()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        raise FirmwareError(f"Can't read key file {path}: {e}")
+    try:
+        return {
+            CONTAINER_OZIP: [bytes.fromhex(k) for k in data.get(CONTAINER_OZIP, [])],
+            CONTAINER_OFP_QC: [(bytes.fromhex(k['key']), bytes.fromhex(k['iv']))
+                               for k in data.get(CONTAINER_OFP_QC, [])],
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        raise FirmwareError(f"Bad key file {path}: {e}")
+
+# --- Detection ---
+
+def _ofp_qc_footer(f, file_size: int) -> Optional[Tuple[int, int, int]]:
+    """(page size, index offset, index length) of a Qualcomm OFP, None if it isn't one"""
+    for page in OFP_PAGE_SIZES:
+        if file_size < page:
+            continue
+        f.seek(file_size - page + 0x10)
+        magic, offset_pages, length = struct.unpack('<III', f.read(12))
+        if magic == OFP_QC_MAGIC:
+            return page, offset_pages * page, length
+    return None
+
+def detect_container(path: Path) -> Optional[str]:
+    """CONTAINER_* for a firmware file, None if it is none of them"""
+    path = Path(path)
+    with open(path, 'rb') as f:
+        head = f.read(len(OZIP_MAGIC))
+        if head == OZIP_MAGIC:
+            return CONTAINER_OZIP
+        if head[:4] == b'PK\x03\x04':
+            return CONTAINER_ZIP
+        if _ofp_qc_footer(f, os.fstat(f.fileno()).st_size):
+            return CONTAINER_OFP_QC
+    if path.suffix.lower() == '.ofp':
+        return CONTAINER_OFP_MTK
+    return None
+
+# --- OZIP ---
+
+class OzipFile(io.RawIOBase):
+    """Seekable, decrypted view of a whole-file OZIP: the plain ZIP inside"""
+
+    def __init__(self, path: Path, key: bytes):
+        self.path = Path(path)
+        self.key = key
+        self._fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.size = max(0, os.fstat(self._fd).st_size - OZIP_HEADER_SIZE)
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self.size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast('B')
+        n = pread_into(self._fd, view[:max(0, min(len(view), self.size - self._pos))],
+                        OZIP_HEADER_SIZE + self._pos)
+        if n:
+            _decrypt_heads(self._fd, self.key, view[:n], self._pos)
+            throttle(n)
+            self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+def _decrypt_heads(fd: int, key: bytes, view: memoryview, pos: int):
+    """Decrypt, in place, the encrypted 16-byte blocks that overlap view (plain offset pos)"""
+    starts = range(pos // OZIP_PERIOD * OZIP_PERIOD, pos + len(view), OZIP_PERIOD)
+    blocks = [s for s in starts if s + OZIP_BLOCK > pos]
+    # One ECB call for all blocks: they are independent
+    cipher = b''.join(pread(fd, OZIP_BLOCK, OZIP_HEADER_SIZE + s) for s in blocks)
+    usable = len(cipher) // OZIP_BLOCK  # A short block at the very end stays plain
+    plain = aes_ecb_decrypt(key, cipher[:usable * OZIP_BLOCK]) if usable else b''
+    for i, start in enumerate(blocks[:usable]):
+        lo, hi = max(start, pos), min(start + OZIP_BLOCK, pos + len(view))
+        view[lo - pos:hi - pos] = plain[i * OZIP_BLOCK + lo - start:i * OZIP_BLOCK + hi - start]
+
+def find_ozip_key(path: Path, keys: List[bytes]) -> Optional[bytes]:
+    """The key that turns the first block into a ZIP local header"""
+    with open(path, 'rb') as f:
+        f.seek(OZIP_HEADER_SIZE)
+        block = f.read(OZIP_BLOCK)
+    if len(block) < OZIP_BLOCK:
+        raise FirmwareError(f"{Path(path).name} is too short for an OZIP")
+    for key in keys:
+        if aes_ecb_decrypt(key, block)[:4] == b'PK\x03\x04':
+            return key
+    return None
+
+def _open_ozip(path: Path, key: bytes) -> zipfile.ZipFile:
+    return zipfile.ZipFile(io.BufferedReader(OzipFile(path, key), ZIP_STREAM_CHUNK))
+
+def extract_ozip(path: Path, out_dir: Path, key: bytes, workers: Optional[int] = None,
+                 progress_callback: Optional[Callable[[int, int], None]] = None) -> int:
+    """Extract the ZIP inside an OZIP, members largest first on parallel workers; returns the member count"""
+    with _open_ozip(path, key) as zf:
+        infos = sorted((i for i in zf.infolist() if not i.is_dir()), key=lambda i: i.compress_size, reverse=True)
+    pool = get_default_pool()
+    local = threading.local()
+    opened: List[zipfile.ZipFile] = []
+    lock = threading.Lock()
+    done = [0]
+
+    def extract(info: zipfile.ZipInfo):
+        zf = getattr(local, 'zf', None)
+        if zf is None:
+            zf = local.zf = _open_ozip(path, key)  # Own file handle per worker
+            with lock:
+                opened.append(zf)
+        target = zip_member_target(Path(out_dir), info.filename)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        unshare(target)
+        with span(f'ozip:{info.filename}', size=info.file_size), \
+                zf.open(info) as src, open(target, 'wb') as dst, pool.buffer() as buf:
+            copy_stream(src, dst, buf[:ZIP_STREAM_CHUNK])
+        count(BYTES_READ, info.compress_size)
+        count(BYTES_WRITTEN, info.file_size)
+        with lock:
+            done[0] += 1
+            if progress_callback:
+                progress_callback(done[0], len(infos))
+
+    try:
+        _run_all(extract, [(i,) for i in infos], workers)
+    finally:
+        for zf in opened:
+            zf.close()
+    return len(infos)
+
+def decrypt_ozip(path: Path, out_path: Path, key: bytes, workers: Optional[int] = None):
+    """Write the plain ZIP inside an OZIP, in parallel pieces"""
+    with OzipFile(path, key) as src:
+        size = src.size
+    with open(out_path, 'wb') as f:
+        f.truncate(size)
+    pool = get_default_pool()
+
+    def piece(offset: int, length: int):
+        with OzipFile(path, key) as src, pool.buffer() as buf:
+            fd = os.open(out_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                src.seek(offset)
+                done = 0
+                while done < length:
+                    n = src.readinto(buf[:min(len(buf), length - done)])
+                    if not n:
+                        raise EOFError(f"Unexpected end of {Path(path).name}")
+                    pwrite_all(fd, buf[:n], offset + done)
+                    done += n
+            finally:
+                os.close(fd)
+        count(BYTES_WRITTEN, length)
+
+    _run_all(piece, [(o, min(OZIP_TASK_SIZE, size - o)) for o in range(0, size, OZIP_TASK_SIZE)], workers)
+
+# --- Qualcomm OFP ---
+
+def read_ofp_index(path: Path, keys: List[Tuple[bytes, bytes]]) -> Tuple[bytes, bytes, List[OfpEntry]]:
+    """(key, iv, entries) of a Qualcomm OFP; the key is the one that decrypts the XML index"""
+    with open(path, 'rb') as f:
+        footer = _ofp_qc_footer(f, os.fstat(f.fileno()).st_size)
+        if footer is None:
+            raise FirmwareError(f"{Path(path).name} is not a Qualcomm OFP")
+        page, offset, length = footer
+        f.seek(offset)
+        encrypted = f.read(length)
+    for key, iv in keys:
+        index = aes_cfb_decrypt(key, iv, encrypted).rstrip(b'\0')
+        if index.lstrip().startswith(b'<?xml'):
+            break
+    else:
+        raise FirmwareError(f"No key in the key file decrypts {Path(path).name}")
+    try:
+        root = ET.fromstring(index)
+    except ET.ParseError as e:
+        raise FirmwareError(f"Damaged OFP index: {e}")
+    entries: Dict[str, OfpEntry] = {}
+    for section in root:
+        for item in section.iter():
+            name = item.attrib.get('Path') or item.attrib.get('filename')
+            if not name or 'FileOffsetInSrc' not in item.attrib or name in entries:
+                continue
+            size = int(item.attrib.get('SizeInByte', 0))
+            full = section.tag in OFP_FULLY_ENCRYPTED
+            entries[name] = OfpEntry(name, int(item.attrib['FileOffsetInSrc']) * page, size,
+                                     size if full else min(size, OFP_ENCRYPTED_SIZE))
+    return key, iv, list(entries.values())
+
+def _ofp_target(out_dir: Path, name: str) -> Path:
+    """Same layout as factory ZIPs: super_def files in META/, everything else in IMAGES/"""
+    base = zip_member_target(Path(out_dir), name).name
+    return Path(out_dir) / ('META' if base.startswith('super_def') else 'IMAGES') / base
+
+def extract_ofp_qc(path: Path, out_dir: Path, key: bytes, iv: bytes, entries: List[OfpEntry],
+                   workers: Optional[int] = None,
+                   progress_callback: Optional[Callable[[int, int], None]] = None) -> int:
+    """Decrypt/copy every file of a Qualcomm OFP in parallel pieces; returns the file count"""
+    tasks = []
+    for entry in sorted(entries, key=lambda e: e.size, reverse=True):
+        target = _ofp_target(out_dir, entry.name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        unshare(target)
+        with open(target, 'wb') as f:
+            f.truncate(entry.size)
+        # The encrypted head is one CFB stream; the plain rest is split for the workers
+        tasks.append((entry, target, 0, entry.encrypted))
+        for offset in range(entry.encrypted, entry.size, COPY_TASK_SIZE):
+            tasks.append((entry, target, offset, min(COPY_TASK_SIZE, entry.size - offset)))
+    pool = get_default_pool()
+    src = SuperSource(path)
+    lock = threading.Lock()
+    left = {e.name: sum(1 for t in tasks if t[0] is e) for e in entries}
+    done = [0]
+
+    def piece(entry: OfpEntry, target: Path, offset: int, length: int):
+        src_fd = src.open_fd()
+        fd = os.open(target, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            with span(f'ofp:{entry.name}', offset=offset, length=length):
+                if offset < entry.encrypted:
+                    data = pread(src_fd, length, entry.offset)
+                    if len(data) < length:
+                        raise EOFError(f"Unexpected end of {Path(path).name} in {entry.name}")
+                    throttle(2 * length)
+                    pwrite_all(fd, aes_cfb_decrypt(key, iv, data), 0)
+                elif length:
+                    with pool.buffer() as buf:
+                        copy_range(src, src_fd, fd, entry.offset + offset, offset, length, buf)
+        finally:
+            os.close(fd)
+            os.close(src_fd)
+        count(BYTES_WRITTEN, length)
+        with lock:
+            left[entry.name] -= 1
+            if not left[entry.name]:
+                done[0] += 1
+                if progress_callback:
+                    progress_callback(done[0], len(entries))
+
+    try:
+        _run_all(piece, tasks, workers)
+    finally:
+        src.close()
+    return len(entries)
+
+# --- Common ---
+
+def _run_all(func: Callable, tasks: List[tuple], workers: Optional[int]):
+    """Run func(*task) for every task on a thread pool; the first error cancels the rest"""
+    workers = max(1, min(workers or os.cpu_count() or 1, get_default_pool().capacity))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decrypt') as executor:
+        futures = [executor.submit(func, *task) for task in tasks]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+@traced('firmware')
+def extract_firmware(
+    path: Path,
+    out_dir: Path,
+    log_callback: Optional[Callable[[str], None]] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None,
+    verify: bool = False,
+    workers: Optional[int] = None,
+    keys_path: Optional[Path] = None,
+    index: Optional[ExtractIndex] = None
+) -> bool:
+    """Extract a ROM ZIP, OZIP or Qualcomm OFP into out_dir (META/ + IMAGES/)
+
+    Plain ZIPs go to extract_rom_zip (verify and index apply to them); encrypted
+    containers are decrypted while extracting. Member CRCs inside an OZIP
+    are still checked by zipfile as they are extracted.
+    """
+    path = Path(path)
+    try:
+        kind = detect_container(path)
+        if kind in (CONTAINER_ZIP, None):
+            return extract_rom_zip(path, out_dir, log_callback, progress_callback, verify=verify, index=index)
+        if kind == CONTAINER_OFP_MTK:
+            raise FirmwareError(f"{path.name}: MediaTek OFP packages are not supported")
+        if not have_crypto():
+            raise FirmwareError(f"{path.name}: {NO_CRYPTO}")
+        keys = load_keys(keys_path).get(kind, [])
+        if not keys:
+            raise FirmwareError(f"{path.name}: no {kind} keys in {keys_path or default_keys_path()}")
+        if log_callback:
+            log_callback(f"Decrypting {CONTAINER_NAMES[kind]} {path.name}...")
+        with span(f'decrypt:{kind}'):
+            if kind == CONTAINER_OZIP:
+                key = find_ozip_key(path, keys)
+                if key is None:
+                    raise FirmwareError(f"No key in the key file decrypts {path.name}")
+                extracted = extract_ozip(path, Path(out_dir), key, workers, progress_callback)
+            else:
+                key, iv, entries = read_ofp_index(path, keys)
+                extracted = extract_ofp_qc(path, Path(out_dir), key, iv, entries, workers, progress_callback)
+        if log_callback:
+            log_callback(f"Decrypted {extracted} files from {path.name}")
+        return True
+    except (FirmwareError, OSError, EOFError, zipfile.BadZipFile, ValueError) as e:
+        if log_callback:
+            log_callback(f"ERROR: {e}")
+        return False
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Extract encrypted OPlus firmware (OZIP / Qualcomm OFP)')
+    parser.add_argument('firmware', type=Path)
+    parser.add_argument('out_dir', type=Path, nargs='?')
+    parser.add_argument('--to-zip', type=Path, default=None, help='OZIP only: write the plain ZIP instead')
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--keys', type=Path, default=None, help='key file (default QFF_FIRMWARE_KEYS)')
+    args = parser.parse_args(argv)
+
+    if args.to_zip:
+        try:
+            if detect_container(args.firmware) != CONTAINER_OZIP:
+                raise FirmwareError(f"{args.firmware.name} is not an OZIP")
+            key = find_ozip_key(args.firmware, load_keys(args.keys).get(CONTAINER_OZIP, []))
+            if key is None:
+                raise FirmwareError(f"No key in the key file decrypts {args.firmware.name}")
+            decrypt_ozip(args.firmware, args.to_zip, key, args.jobs)
+        except (FirmwareError, OSError, EOFError) as e:
+            print(f"ERROR: {e}")
+            return 1
+        print(f"Wrote {args.to_zip}")
+        return 0
+    if not args.out_dir:
+        parser.error('OUT_DIR or --to-zip is required')
+    ok = extract_firmware(args.firmware, args.out_dir, print, workers=args.jobs, keys_path=args.keys)
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+OPlus ROM Converter - Filesystem Size Detection
+Reads the ext4 / EROFS superblock of a raw partition image to find where the
+filesystem really ends, so padding after it need not be copied into super.
+Images signed with an AVB footer are never trimmed: the verity hashtree, FEC
+data and the footer itself live after the filesystem.
+"""
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+# Both superblocks live 1024 bytes into the image
+SUPERBLOCK_OFFSET = 1024
+SUPERBLOCK_READ = 1024
+
+# ext4 (see linux fs/ext4/ext4.h, struct ext4_super_block)
+EXT4_MAGIC = 0xEF53
+EXT4_MAGIC_OFFSET = 0x38
+EXT4_BLOCKS_COUNT_LO_OFFSET = 0x04
+EXT4_LOG_BLOCK_SIZE_OFFSET = 0x18
+EXT4_FEATURE_INCOMPAT_OFFSET = 0x60
+EXT4_BLOCKS_COUNT_HI_OFFSET = 0x150
+EXT4_FEATURE_INCOMPAT_64BIT = 0x80
+
+# EROFS (see linux fs/erofs/erofs_fs.h, struct erofs_super_block)
+EROFS_MAGIC = 0xE0F5E1E2
+EROFS_BLKSZBITS_OFFSET = 0x0C
+EROFS_BLOCKS_OFFSET = 0x24
+
+# AVB footer (see external/avb/libavb/avb_footer.h): last 64 bytes of the image
+AVB_FOOTER_MAGIC = b'AVBf'
+AVB_FOOTER_SIZE = 64
+
+FS_EXT4 = 'ext4'
+FS_EROFS = 'erofs'
+
+@dataclass
+class FilesystemInfo:
+    """Filesystem found at the start of an image"""
+    fs_type: str
+    block_size: int
+    blocks: int
+
+    @property
+    def size(self) -> int:
+        return self.block_size * self.blocks
+
+def _parse_ext4(sb: bytes) -> Optional[FilesystemInfo]:
+    if struct.unpack_from('<H', sb, EXT4_MAGIC_OFFSET)[0] != EXT4_MAGIC:
+        return None
+    blocks = struct.unpack_from('<I', sb, EXT4_BLOCKS_COUNT_LO_OFFSET)[0]
+    log_block_size = struct.unpack_from('<I', sb, EXT4_LOG_BLOCK_SIZE_OFFSET)[0]
+    incompat = struct.unpack_from('<I', sb, EXT4_FEATURE_INCOMPAT_OFFSET)[0]
+    if incompat & EXT4_FEATURE_INCOMPAT_64BIT:
+        blocks |= struct.unpack_from('<I', sb, EXT4_BLOCKS_COUNT_HI_OFFSET)[0] << 32
+    if log_block_size > 6:
+        return None
+    return FilesystemInfo(FS_EXT4, 1024 << log_block_size, blocks)
+
+def _parse_erofs(sb: bytes) -> Optional[FilesystemInfo]:
+    if struct.unpack_from('<I', sb, 0)[0] != EROFS_MAGIC:
+        return None
+    blkszbits = sb[EROFS_BLKSZBITS_OFFSET]
+    blocks = struct.unpack_from('<I', sb, EROFS_BLOCKS_OFFSET)[0]
+    if not 9 <= blkszbits <= 16:
+        return None
+    return FilesystemInfo(FS_EROFS, 1 << blkszbits, blocks)
+
+def read_filesystem_info(img_path: Path) -> Optional[FilesystemInfo]:
+    """Detect ext4/EROFS in a raw image, None for anything else"""
+    try:
+        with open(img_path, 'rb') as f:
+            f.seek(SUPERBLOCK_OFFSET)
+            sb = f.read(SUPERBLOCK_READ)
+    except OSError:
+        return None
+    if len(sb) < SUPERBLOCK_READ:
+        return None
+    info = _parse_ext4(sb) or _parse_erofs(sb)
+    if info is None or info.blocks == 0:
+        return None
+    return info
+
+def has_avb_footer(img_path: Path) -> bool:
+    """The image ends with an AVB footer (avbtool add_hash_footer/add_hashtree_footer)"""
+    try:
+        with open(img_path, 'rb') as f:
+            f.seek(0, 2)
+            if f.tell() < AVB_FOOTER_SIZE:
+                return False
+            f.seek(-AVB_FOOTER_SIZE, 2)
+            return f.read(len(AVB_FOOTER_MAGIC)) == AVB_FOOTER_MAGIC
+    except OSError:
+        return False
+
+def align_up(value: int, alignment: int) -> int:
+    if alignment <= 1:
+        return value
+    return (value + alignment - 1) // alignment * alignment
+
+def trimmed_size(img_path: Path, block_size: int) -> Optional[int]:
+    """Filesystem end rounded up to block_size, None if it can't be trimmed
+
+    Only returns a size smaller than the image; a filesystem that claims to
+    extend past the end of the file is treated as unknown. AVB-signed images
+    are left whole, as dm-verity needs everything up to the footer.
+    """
+    info = read_filesystem_info(img_path)
+    if info is None or has_avb_footer(img_path):
+        return None
+    file_size = img_path.stat().st_size
+    size = align_up(info.size, block_size)
+    if size >= file_size or info.size > file_size:
+        return None
+    return size
@@ -10,16 +10,29 @@ import subprocess
 import ctypes
 from typing import Optional, List, Dict
 import datetime
+import time
 import webbrowser
-import zipfile
 from PIL import Image, ImageTk
 
 from converter import (
     find_rawprogram_xmls, find_super_def, parse_super_def,
     find_all_super_defs, get_region_display_name,
     parse_rawprogram_xml, check_super_exists, create_super_image,
-    get_super_path, is_sparse_image, get_sparse_info, SuperConfig, RegionInfo
+    get_super_path, is_sparse_image, get_sparse_info, probe_images,
+    SuperConfig, RegionInfo
 )
+from preflight import run_preflight
+from tracing import start_tracing, stop_tracing, current_session, add_span
+from build_cache import build_cache_from_env
+from build_history import default_history
+from io_throttle import start_background, stop_background, DEFAULT_RATE, MB
+from backends import AUTO
+from firmware_decrypt import extract_firmware
+from extract_index import extract_index_from_env
+
+# While a traced build runs, the Tk loop is sampled this often; later callbacks are logged as stalls
+TK_HEARTBEAT_MS = 100
+TK_STALL_MS = 50
 
 import sys
 import os
@@ -45,6 +58,13 @@ TRANSLATIONS = {
         'run_zadig': '🛠️ Chạy Zadig (WinUSB)',
         'install_kedacom': '🔌 Cài Driver Kedacom',
         'append_nvid': 'Thêm NV ID vào tên file',
+        'trim_fs': 'Cắt phân vùng theo kích thước filesystem',
+        'scratch_btn': 'Thư mục tạm...',
+        'scratch_default': 'Tạm: cạnh file xuất',
+        'trace_build': 'Ghi trace hiệu năng (Chrome trace)',
+        'native_layout': 'Ghi super.img song song (không cần lpmake)',
+        'background_build': 'Chạy nền (giới hạn MB/s, khi đang flash máy)',
+        'verify_zip': 'Kiểm tra CRC file ZIP trước khi giải nén',
         'create_btn': 'TẠO SUPER IMAGE',
         'recreate_btn': 'TẠO LẠI SUPER IMAGE',
         'processing': 'ĐANG XỬ LÝ...',
@@ -61,6 +81,9 @@ TRANSLATIONS = {
         'col_size': 'Kích thước',
         'col_group': 'Nhóm',
         'col_status': 'Trạng thái',
+        'col_raw': 'Giải nén',
+        'col_ratio': 'Tỉ lệ',
+        'col_fit': 'Vừa',
         'msg_success': 'Thành công',
         'msg_failed': 'Thất bại',
         'msg_overwrite': 'File đã tồn tại. Bạn có muốn ghi đè không?',
@@ -96,6 +119,13 @@ TRANSLATIONS = {
         'run_zadig': '🛠️ Run Zadig (WinUSB)',
         'install_kedacom': '🔌 Install Kedacom Driver',
         'append_nvid': 'Append NV ID to filename',
+        'trim_fs': 'Trim partitions to filesystem size',
+        'scratch_btn': 'Scratch folder...',
+        'scratch_default': 'Scratch: next to output',
+        'trace_build': 'Record performance trace (Chrome trace)',
+        'native_layout': 'Write super.img in parallel (no lpmake)',
+        'background_build': 'Background mode (MB/s cap, while flashing phones)',
+        'verify_zip': 'Verify ZIP (CRC) before extracting',
         'create_btn': 'CREATE SUPER IMAGE',
         'recreate_btn': 'RE-CREATE SUPER IMAGE',
         'processing': 'PROCESSING...',
@@ -112,6 +142,9 @@ TRANSLATIONS = {
         'col_size': 'Size',
         'col_group': 'Group',
         'col_status': 'Status',
+        'col_raw': 'Raw Size',
+        'col_ratio': 'Sparse %',
+        'col_fit': 'Fits',
         'msg_success': 'Success',
         'msg_failed': 'Failed',
         'msg_overwrite': 'File exists. Overwrite?',
@@ -187,6 +220,7 @@ class RomConverterApp:
         self.available_regions: List[RegionInfo] = []
         self.selected_region_index: int = -1
         self.is_processing = False
+        self.probe_generation = 0  # Bumped on every region load to drop stale probe results
         
         self.create_layout()
         self.update_texts() # Initial Text Load
@@ -248,6 +282,13 @@ class RomConverterApp:
         self.ui_elements['btn_zadig'].config(text=self.tr('run_zadig'))
         self.ui_elements['btn_driver'].config(text=self.tr('install_kedacom'))
         self.ui_elements['chk_nvid'].config(text=self.tr('append_nvid'))
+        self.ui_elements['chk_trim'].config(text=self.tr('trim_fs'))
+        self.ui_elements['btn_scratch'].config(text=self.tr('scratch_btn'))
+        self.scratch_var.set(str(self.scratch_dir) if self.scratch_dir else self.tr('scratch_default'))
+        self.ui_elements['chk_trace'].config(text=self.tr('trace_build'))
+        self.ui_elements['chk_native'].config(text=self.tr('native_layout'))
+        self.ui_elements['chk_background'].config(text=self.tr('background_build'))
+        self.ui_elements['chk_verify_zip'].config(text=self.tr('verify_zip'))
         
         self.ui_elements['btn_save_log'].config(text=self.tr('save_log'))
         self.ui_elements['btn_clear_log'].config(text=self.tr('clear_log'))
@@ -269,6 +310,9 @@ class RomConverterApp:
         self.partition_tree.heading('len', text=self.tr('col_size'))
         self.partition_tree.heading('grp', text=self.tr('col_group'))
         self.partition_tree.heading('status', text=self.tr('col_status'))
+        self.partition_tree.heading('raw', text=self.tr('col_raw'))
+        self.partition_tree.heading('ratio', text=self.tr('col_ratio'))
+        self.partition_tree.heading('fit', text=self.tr('col_fit'))
 
     def create_layout(self):
         # 1. Header Bar
@@ -407,18 +451,65 @@ class RomConverterApp:
                            bg=COLORS['card_bg'], fg=COLORS['text_primary'], selectcolor=COLORS['card_bg'], activebackground=COLORS['card_bg'])
         self.ui_elements['chk_nvid'].pack(anchor='w')
         tk.Label(parent, text="(e.g. super.10000010.img)", bg=COLORS['card_bg'], fg=COLORS['text_secondary'], font=('Segoe UI', 8)).pack(anchor='w', padx=20)
+        
+        self.trim_to_fs = tk.BooleanVar(value=False)
+        self.ui_elements['chk_trim'] = tk.Checkbutton(parent, text="", variable=self.trim_to_fs,
+                           bg=COLORS['card_bg'], fg=COLORS['text_primary'], selectcolor=COLORS['card_bg'], activebackground=COLORS['card_bg'])
+        self.ui_elements['chk_trim'].pack(anchor='w')
+        tk.Label(parent, text="(ext4 / EROFS)", bg=COLORS['card_bg'], fg=COLORS['text_secondary'], font=('Segoe UI', 8)).pack(anchor='w', padx=20)
+        
+        # Where decoded raw files go (e.g. a separate NVMe); space is checked before building
+        self.scratch_dir: Optional[Path] = None
+        self.scratch_var = tk.StringVar()
+        self.ui_elements['btn_scratch'] = tk.Button(parent, text="", bg='#ECEFF1', fg=COLORS['text_primary'],
+                              relief='flat', command=self.browse_scratch, font=FONTS['button'], cursor='hand2')
+        self.ui_elements['btn_scratch'].pack(anchor='w', pady=(5, 0))
+        tk.Label(parent, textvariable=self.scratch_var, bg=COLORS['card_bg'], fg=COLORS['text_secondary'], font=('Segoe UI', 8)).pack(anchor='w', padx=20)
+        
+        self.trace_build = tk.BooleanVar(value=False)
+        self.ui_elements['chk_trace'] = tk.Checkbutton(parent, text="", variable=self.trace_build,
+                           bg=COLORS['card_bg'], fg=COLORS['text_primary'], selectcolor=COLORS['card_bg'], activebackground=COLORS['card_bg'])
+        self.ui_elements['chk_trace'].pack(anchor='w', pady=(5, 0))
+        tk.Label(parent, text="(super.trace.json + .prof)", bg=COLORS['card_bg'], fg=COLORS['text_secondary'], font=('Segoe UI', 8)).pack(anchor='w', padx=20)
+        
+        self.native_layout = tk.BooleanVar(value=False)
+        self.ui_elements['chk_native'] = tk.Checkbutton(parent, text="", variable=self.native_layout,
+                           bg=COLORS['card_bg'], fg=COLORS['text_primary'], selectcolor=COLORS['card_bg'], activebackground=COLORS['card_bg'])
+        self.ui_elements['chk_native'].pack(anchor='w', pady=(5, 0))
+        
+        # Low priority + bandwidth cap so USB flashing on the same PC keeps its disk time
+        self.background_build = tk.BooleanVar(value=False)
+        self.background_mb = tk.StringVar(value=str(DEFAULT_RATE // MB))
+        self.ui_elements['chk_background'] = tk.Checkbutton(parent, text="", variable=self.background_build,
+                           bg=COLORS['card_bg'], fg=COLORS['text_primary'], selectcolor=COLORS['card_bg'], activebackground=COLORS['card_bg'])
+        self.ui_elements['chk_background'].pack(anchor='w', pady=(5, 0))
+        tk.Spinbox(parent, from_=5, to=1000, increment=5, width=6, textvariable=self.background_mb,
+                   relief='flat', bg='#FAFAFA').pack(anchor='w', padx=20)
+        
+        self.verify_zip = tk.BooleanVar(value=False)
+        self.ui_elements['chk_verify_zip'] = tk.Checkbutton(parent, text="", variable=self.verify_zip,
+                           bg=COLORS['card_bg'], fg=COLORS['text_primary'], selectcolor=COLORS['card_bg'], activebackground=COLORS['card_bg'])
+        self.ui_elements['chk_verify_zip'].pack(anchor='w', pady=(5, 0))
+
+    def browse_scratch(self):
+        folder = filedialog.askdirectory(title=self.tr('scratch_btn'))
+        self.scratch_dir = Path(folder) if folder else None
+        self.scratch_var.set(str(self.scratch_dir) if self.scratch_dir else self.tr('scratch_default'))
 
     def create_partitions_content(self, parent):
         container = tk.Frame(parent, bg='white')
         container.pack(fill=tk.BOTH, expand=True)
         
-        self.partition_tree = ttk.Treeview(container, columns=('name', 'len', 'grp', 'status'), show='headings')
+        self.partition_tree = ttk.Treeview(container, columns=('name', 'len', 'grp', 'status', 'raw', 'ratio', 'fit'), show='headings')
         # Headings set in update_texts
         
-        self.partition_tree.column('name', width=150)
+        self.partition_tree.column('name', width=130)
         self.partition_tree.column('len', width=80)
-        self.partition_tree.column('grp', width=150)
-        self.partition_tree.column('status', width=100)
+        self.partition_tree.column('grp', width=130)
+        self.partition_tree.column('status', width=80)
+        self.partition_tree.column('raw', width=80)
+        self.partition_tree.column('ratio', width=60)
+        self.partition_tree.column('fit', width=40)
         
         vsb = ttk.Scrollbar(container, orient="vertical", command=self.partition_tree.yview)
         self.partition_tree.configure(yscrollcommand=vsb.set)
@@ -644,24 +735,25 @@ class RomConverterApp:
         self.selected_region = region
         self.log(f"Config loaded: {region.nv_text}", "INFO")
         
-        self.super_config = parse_super_def(region.config_path)
+        # Parsed once during scan_rom; fall back for regions built elsewhere
+        self.super_config = region.config or parse_super_def(region.config_path)
         
-        # Populate table
+        # Populate table; image probing (stat + header) runs in the background
         self.partition_tree.delete(*self.partition_tree.get_children())
+        rows = []
         for p in self.super_config.partitions:
             if not p.path: continue
             
-            img_path = self.rom_folder / p.path
-            status = "Missing ⚠️"
-            if img_path.exists():
-                status = "Ready" if not is_sparse_image(img_path) else "Sparse"
-                
-            self.partition_tree.insert('', tk.END, values=(
+            iid = self.partition_tree.insert('', tk.END, values=(
                 p.name, 
                 f"{p.size/1024/1024:.1f} MB", 
                 p.group_name, 
-                status
+                "...", "", "", ""
             ))
+            rows.append((iid, p))
+        
+        self.probe_generation += 1
+        threading.Thread(target=self._probe_worker, args=(self.probe_generation, self.rom_folder, rows), daemon=True).start()
             
         self.start_btn.configure(state='normal', bg=COLORS['success'])
         self.start_btn.configure(text=self.tr('create_btn'))
@@ -674,6 +766,32 @@ class RomConverterApp:
         else:
             self.start_btn.configure(text=self.tr('create_btn'), bg=COLORS['success'])
 
+    def _probe_worker(self, generation, rom_folder, rows):
+        paths = [rom_folder / p.path for _, p in rows]
+        probe_images(paths, lambda i, probe: self.root.after(
+            0, lambda: self._fill_probe_row(generation, rows[i], probe)))
+
+    def _fill_probe_row(self, generation, row, probe):
+        if generation != self.probe_generation: return  # Region changed meanwhile
+        iid, p = row
+        
+        if not probe.exists:
+            values = ("Missing ⚠️", "", "", "")
+        else:
+            fits = probe.fits(p)
+            values = (
+                "Sparse" if probe.is_sparse else "Ready",
+                f"{probe.raw_size/1024/1024:.1f} MB",
+                f"{probe.sparse_ratio*100:.0f}%" if probe.is_sparse else "-",
+                "✔" if fits else "✖"
+            )
+            if not fits:
+                self.log(f"{p.name}: image ({probe.raw_size/1024/1024:.1f} MB) exceeds partition size", "WARN")
+        
+        try:
+            self.partition_tree.item(iid, values=(p.name, f"{p.size/1024/1024:.1f} MB", p.group_name) + values)
+        except tk.TclError: pass  # Row already removed
+
     def run_zadig(self):
         zadig_path = resource_path("zadig-2.9.exe")
         if zadig_path.exists():
@@ -736,14 +854,74 @@ class RomConverterApp:
         self.start_btn.configure(state='disabled', text=self.tr('processing'), bg='#9E9E9E')
         self.progress_var.set(0)
         
-        threading.Thread(target=self._worker, args=(out,), daemon=True).start()
+        scratch_dirs = [self.scratch_dir] if self.scratch_dir else None
+        background_rate = 0
+        if self.background_build.get():
+            try:
+                background_rate = max(1, int(float(self.background_mb.get()) * MB))
+            except ValueError:
+                background_rate = DEFAULT_RATE
+        threading.Thread(target=self._worker, args=(out, self.trim_to_fs.get(), scratch_dirs, self.trace_build.get(),
+                                                    self.native_layout.get(), background_rate),
+                         daemon=True).start()
+
+    def _tk_heartbeat(self, due_ns):
+        """Record Tk callbacks that ran late (the UI thread was busy) while tracing"""
+        if current_session() is None:
+            return
+        now = time.perf_counter_ns()
+        if now - due_ns > TK_STALL_MS * 1_000_000:
+            add_span('tk:stall', due_ns, now)
+        self.root.after(TK_HEARTBEAT_MS, lambda: self._tk_heartbeat(time.perf_counter_ns() + TK_HEARTBEAT_MS * 1_000_000))
+
+    def _worker(self, out_path, trim_to_filesystem=False, scratch_dirs=None, trace=False, native_layout=False,
+                background_rate=0):
+        if background_rate:
+            # Lowers this thread's priority; the build's worker threads inherit it
+            start_background(background_rate)
+        if trace:
+            # cProfile follows the thread that starts tracing: this worker
+            start_tracing(profile=True)
+            self.root.after(0, lambda: self._tk_heartbeat(time.perf_counter_ns()))
+        try:
+            self._build(out_path, trim_to_filesystem, scratch_dirs, native_layout)
+        finally:
+            if background_rate:
+                stop_background()
+            tracer = stop_tracing() if trace else None
+            if tracer:
+                self._write_trace(tracer, out_path)
+
+    def _write_trace(self, tracer, out_path):
+        log = lambda msg: self.root.after(0, lambda: self.log(msg, "INFO"))
+        try:
+            written = tracer.write_chrome_trace(out_path.with_suffix('.trace.json'))
+        except OSError as e:
+            log(f"WARNING: Could not write trace: {e}")
+            return
+        for line in tracer.summary()[:20]:
+            log(line)
+        log(f"Trace: {', '.join(p.name for p in written)}")
 
-    def _worker(self, out_path):
+    def _build(self, out_path, trim_to_filesystem, scratch_dirs, native_layout=False):
         try:
+            # Header-only integrity check: catch missing/truncated images before the long build
+            report = run_preflight(self.rom_folder, [self.super_config], check_rawprogram=False,
+                                   log_callback=lambda msg: self.root.after(0, lambda: self.log(msg, "INFO")))
+            if not report.ok:
+                self.root.after(0, lambda: self._finish(False, None))
+                return
+            
             success = create_super_image(
                 self.super_config, self.rom_folder, out_path,
                 lambda msg: self.root.after(0, lambda: self.log(msg, "INFO")),
-                lambda cur, tot: self.root.after(0, lambda: self._update_prog(cur, tot))
+                lambda cur, tot: self.root.after(0, lambda: self._update_prog(cur, tot)),
+                trim_to_filesystem=trim_to_filesystem,
+                scratch_dirs=scratch_dirs,
+                build_cache=build_cache_from_env(),
+                history=default_history(),
+                decoder=AUTO,
+                assembler='native' if native_layout else AUTO  # Unticked: fastest backend on this host
             )
             
             if success:
@@ -783,7 +961,7 @@ class RomConverterApp:
         
         zip_path = filedialog.askopenfilename(
             title=self.tr('extract_btn'),
-            filetypes=[("ZIP Files", "*.zip")]
+            filetypes=[("Firmware", "*.zip *.ozip *.ofp"), ("ZIP Files", "*.zip")]
         )
         if not zip_path: return
         
@@ -807,27 +985,21 @@ class RomConverterApp:
         self.progress_var.set(0)
         self.log(f"Extracting: {Path(zip_path).name} -> {final_out_dir.name}", "INFO")
         
-        threading.Thread(target=self._extract_worker, args=(zip_path, final_out_dir), daemon=True).start()
+        threading.Thread(target=self._extract_worker, args=(zip_path, final_out_dir, self.verify_zip.get()),
+                         daemon=True).start()
 
-    def _extract_worker(self, zip_path, out_dir):
-        try:
-            with zipfile.ZipFile(zip_path, 'r') as zf:
-                infos = zf.infolist()
-                total = sum(1 for x in infos if not x.is_dir())
-                current = 0
-                
-                for info in infos:
-                    if info.is_dir(): continue
-                    zf.extract(info, out_dir)
-                    current += 1
-                    # Update every 5 files to reduce UI lag per file
-                    if current % 5 == 0 or current == total:
-                         self.root.after(0, lambda c=current, t=total: self._extract_prog(c, t))
-            
+    def _extract_worker(self, zip_path, out_dir, verify=False):
+        success = extract_firmware(
+            Path(zip_path), out_dir,
+            lambda msg: self.root.after(0, lambda: self.log(msg, "ERROR" if msg.startswith(("ERROR", "Extraction Error")) else "INFO")),
+            lambda c, t: self.root.after(0, lambda: self._extract_prog(c, t)),
+            verify=verify,
+            index=extract_index_from_env()
+        )
+        
+        if success:
             self.root.after(0, lambda: self._extract_finish(True, out_dir))
-            
-        except Exception as e:
-            self.root.after(0, lambda: self.log(f"Extraction Error: {e}", "ERROR"))
+        else:
             self.root.after(0, lambda: self._extract_finish(False, None))
 
     def _extract_prog(self, cur, tot):
@@ -0,0 +1,111 @@
+"""
+OPlus ROM Converter - I/O Scheduling for Spinning Disks
+Parallel, scattered I/O is what SSDs want and what kills a hard disk: every
+seek costs milliseconds. When a ROM or output lives on a rotational device
+the builder switches to a sequential schedule: partitions are read in the
+physical order of their source files, super.img is written front to back,
+one large I/O at a time with read-ahead hints.
+
+Usage:
+    python io_schedule.py PATH [PATH ...]    # rotational? physical order?
+"""
+import os
+import sys
+import struct
+import argparse
+from pathlib import Path
+from typing import List, Optional
+
+MB = 1024 * 1024
+
+SCHEDULE_AUTO = 'auto'
+SCHEDULE_PARALLEL = 'parallel'      # SSD/NVMe: many workers, any order
+SCHEDULE_SEQUENTIAL = 'sequential'  # HDD: one stream, ascending offsets
+SCHEDULES = (SCHEDULE_AUTO, SCHEDULE_PARALLEL, SCHEDULE_SEQUENTIAL)
+
+# Read/write size of the sequential schedule, and how far ahead to hint
+HDD_IO_SIZE = 8 * MB
+HDD_READAHEAD = 32 * MB
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = '<QQIIII'   # start, length, flags, mapped_extents, extent_count, reserved
+FIEMAP_EXTENT = '<QQQQQI12x'  # logical, physical, length, reserved x2, flags
+FIEMAP_FLAG_SYNC = 0x1
+
+def _existing(path: Path) -> Path:
+    path = Path(path).absolute()
+    while not path.exists() and path.parent != path:
+        path = path.parent
+    return path
+
+def is_rotational(path: Path) -> Optional[bool]:
+    """True if path is on a spinning disk (Linux sysfs), None if unknown"""
+    try:
+        dev = os.stat(_existing(path)).st_dev
+        block = Path(os.path.realpath(f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}'))
+    except (OSError, AttributeError):
+        return None
+    # A partition (sda1) has no queue/ of its own: use its disk's
+    for candidate in (block, block.parent):
+        try:
+            with open(candidate / 'queue' / 'rotational', 'r') as f:
+                return f.read().strip() == '1'
+        except OSError:
+            continue
+    return None
+
+def physical_offset(path: Path) -> Optional[int]:
+    """Disk byte offset of the file's first extent (Linux FIEMAP), None if unknown"""
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    buf = bytearray(struct.calcsize(FIEMAP_HEADER) + struct.calcsize(FIEMAP_EXTENT))
+    struct.pack_into(FIEMAP_HEADER, buf, 0, 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 1, 0)
+    try:
+        with open(path, 'rb') as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf, True)
+    except OSError:
+        return None
+    if struct.unpack_from(FIEMAP_HEADER, buf)[3] == 0:
+        return None  # Empty or fully sparse file
+    return struct.unpack_from(FIEMAP_EXTENT, buf, struct.calcsize(FIEMAP_HEADER))[1]
+
+def physical_order(paths: List[Path]) -> List[int]:
+    """Indices of paths sorted by device and on-disk position
+
+    Files without a known position keep their relative order after the
+    others on the same device.
+    """
+    keys = []
+    for i, path in enumerate(paths):
+        try:
+            dev = os.stat(path).st_dev
+        except OSError:
+            dev = -1
+        offset = physical_offset(path)
+        keys.append((dev, offset is None, offset or 0, i))
+    return [k[3] for k in sorted(keys)]
+
+def resolve_schedule(schedule: str, paths: List[Path]) -> str:
+    """Turn SCHEDULE_AUTO into sequential when any of paths is on a rotational disk"""
+    if schedule != SCHEDULE_AUTO:
+        return schedule
+    if any(is_rotational(p) for p in paths):
+        return SCHEDULE_SEQUENTIAL
+    return SCHEDULE_PARALLEL
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Show the disk type and physical order of files')
+    parser.add_argument('paths', type=Path, nargs='+')
+    args = parser.parse_args(argv)
+    for i in physical_order(args.paths):
+        path = args.paths[i]
+        rotational = {True: 'HDD', False: 'SSD', None: '?'}[is_rotational(path)]
+        offset = physical_offset(path) if path.is_file() else None
+        print(f"{rotational:4} {offset if offset is not None else '-':>16}  {path}")
+    print(f"Schedule: {resolve_schedule(SCHEDULE_AUTO, args.paths)}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+"""
+OPlus ROM Converter - Background Builds
+A build on the PC that is also flashing phones must not take the whole disk.
+Background mode caps the engine's disk bandwidth (reads plus writes) with a
+token bucket, lowers CPU and I/O priority of the build thread and anything
+it starts, and backs off further while other builds are running.
+
+Builds announce themselves with job_activity(): marker files in a shared
+folder (QFF_ACTIVITY_DIR, default <temp>/qflashforge_activity), so the GUI,
+the watch folder and the job server see each other's jobs.
+
+    with background(rate=50 * MB):
+        create_super_image(...)
+
+Usage:
+    python io_throttle.py     # list active jobs
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+from pathlib import Path
+from typing import List, Optional
+
+MB = 1024 * 1024
+
+DEFAULT_RATE = 50 * MB        # Bytes per second, reads plus writes
+MIN_RATE = 4 * MB             # Backoff never goes below this
+BURST_SECONDS = 0.5           # Bucket size in seconds of the rate
+BACKOFF_CHECK_SECONDS = 2.0   # How often other jobs are counted
+
+# Job markers are refreshed this often and ignored once older than STALE
+MARKER_REFRESH_SECONDS = 10.0
+MARKER_STALE_SECONDS = 60.0
+
+# Linux ioprio_set(2)
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO_SET = {'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'arm64': 30}
+
+# Windows priority modes (SetThreadPriority / SetPriorityClass / CreateProcess)
+THREAD_MODE_BACKGROUND_BEGIN = 0x00010000
+PROCESS_MODE_BACKGROUND_BEGIN = 0x00100000
+IDLE_PRIORITY_CLASS = 0x00000040
+
+BACKGROUND_NICE = 10
+
+class TokenBucket:
+    """Thread-safe token bucket: consume(n) blocks until n bytes may pass"""
+
+    def __init__(self, rate: int, burst: Optional[int] = None):
+        self.rate = max(1, rate)
+        self.burst = burst or max(1, int(rate * BURST_SECONDS))
+        self.tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate: int):
+        with self._lock:
+            self.rate = max(1, rate)
+
+    def consume(self, n: int) -> float:
+        """Take n tokens (may go into debt for large n), return the seconds slept"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+# --- Job activity (visible across processes) ---
+
+def activity_dir() -> Path:
+    return Path(os.environ.get('QFF_ACTIVITY_DIR') or Path(tempfile.gettempdir()) / 'qflashforge_activity')
+
+_markers: List[Path] = []
+_markers_lock = threading.Lock()
+_refresher: Optional[threading.Thread] = None
+
+def _refresh_markers():
+    while True:
+        time.sleep(MARKER_REFRESH_SECONDS)
+        with _markers_lock:
+            markers = list(_markers)
+        for marker in markers:
+            try:
+                os.utime(marker)
+            except OSError:
+                pass
+
+@contextlib.contextmanager
+def job_activity(name: str = 'build'):
+    """Announce a running job to other builds (and processes) for the duration of the block"""
+    global _refresher
+    marker = activity_dir() / f"{os.getpid()}-{uuid.uuid4().hex[:8]}.{name}"
+    try:
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+    except OSError:
+        yield  # Shared folder unusable: just don't announce
+        return
+    with _markers_lock:
+        _markers.append(marker)
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_markers, name='activity-markers', daemon=True)
+            _refresher.start()
+    try:
+        yield
+    finally:
+        with _markers_lock:
+            _markers.remove(marker)
+        try:
+            marker.unlink()
+        except OSError:
+            pass
+
+def active_jobs() -> List[Path]:
+    """Fresh job markers of every process"""
+    now = time.time()
+    result = []
+    try:
+        for marker in activity_dir().iterdir():
+            try:
+                if now - marker.stat().st_mtime < MARKER_STALE_SECONDS:
+                    result.append(marker)
+            except OSError:
+                continue
+    except OSError:
+        pass
+    return result
+
+# --- Throttle ---
+
+class Throttle:
+    """Bandwidth cap that shrinks while other jobs run (rate / (1 + others))"""
+
+    def __init__(self, rate: int = DEFAULT_RATE):
+        self.base_rate = rate
+        self.bucket = TokenBucket(rate)
+        self.others = 0
+        self.waited = 0.0
+        self._next_check = 0.0
+
+    def _backoff(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + BACKOFF_CHECK_SECONDS
+        with _markers_lock:
+            own = set(_markers)
+        others = sum(1 for m in active_jobs() if m not in own)
+        # Our own concurrent jobs (job server, watch folder) share the one bucket already
+        if others != self.others:
+            self.others = others
+            self.bucket.set_rate(max(MIN_RATE, self.base_rate // (1 + others)))
+
+    def consume(self, n: int):
+        self._backoff()
+        self.waited += self.bucket.consume(n)
+
+_throttle: Optional[Throttle] = None
+
+def throttle(n: int):
+    """Account n bytes of disk I/O; blocks in background mode, free otherwise"""
+    current = _throttle
+    if current is not None:
+        current.consume(n)
+
+def is_throttled() -> bool:
+    return _throttle is not None
+
+def start_background(rate: int = DEFAULT_RATE, priority: bool = True, process: bool = False) -> Throttle:
+    """Cap disk bandwidth process-wide; with priority also lower this thread's (or the process') priority"""
+    global _throttle
+    if priority:
+        lower_priority(process)
+    _throttle = Throttle(rate)
+    return _throttle
+
+def stop_background() -> Optional[Throttle]:
+    """Remove the bandwidth cap (lowered priorities stay with their threads)"""
+    global _throttle
+    current, _throttle = _throttle, None
+    return current
+
+@contextlib.contextmanager
+def background(rate: int = DEFAULT_RATE, priority: bool = True):
+    """Background mode for the enclosed block (run it on its own thread when priority is lowered)"""
+    current = start_background(rate, priority)
+    try:
+        yield current
+    finally:
+        stop_background()
+
+# --- Priorities ---
+
+def _ioprio_idle(tid: int) -> bool:
+    number = SYS_IOPRIO_SET.get(platform.machine().lower())
+    if number is None:
+        return False
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.syscall(number, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
+    except (OSError, AttributeError):
+        return False
+
+def lower_priority(process: bool = False) -> bool:
+    """Lowest CPU and I/O priority for the calling thread and the threads/processes it starts
+
+    With process, for every thread of the process. Can't be undone without
+    privileges, so the GUI does it on the build thread only.
+    """
+    if sys.platform == 'win32':
+        try:
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            if process:
+                return bool(kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), PROCESS_MODE_BACKGROUND_BEGIN))
+            return bool(kernel32.SetThreadPriority(kernel32.GetCurrentThread(), THREAD_MODE_BACKGROUND_BEGIN))
+        except (OSError, AttributeError):
+            return False
+    if sys.platform.startswith('linux'):
+        # Linux priorities are per thread; new threads inherit them from their creator
+        if process:
+            try:
+                tids = [int(t) for t in os.listdir('/proc/self/task')]
+            except OSError:
+                tids = [threading.get_native_id()]
+        else:
+            tids = [threading.get_native_id()]
+        ok = True
+        for tid in tids:
+            try:
+                os.setpriority(os.PRIO_PROCESS, tid, min(19, os.getpriority(os.PRIO_PROCESS, tid) + BACKGROUND_NICE))
+            except OSError:
+                ok = False
+            ok = _ioprio_idle(tid) and ok
+        return ok
+    try:
+        os.nice(BACKGROUND_NICE)
+        return True
+    except (OSError, AttributeError):
+        return False
+
+def subprocess_creationflags() -> int:
+    """creationflags for external tools: idle priority on Windows in background mode
+
+    Elsewhere child processes inherit the lowered priority of their parent thread.
+    """
+    if sys.platform == 'win32' and _throttle is not None:
+        return IDLE_PRIORITY_CLASS | getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+    return 0
+
+def add_background_arguments(parser: argparse.ArgumentParser):
+    """--background/--bandwidth-mb for the command-line tools"""
+    parser.add_argument('--background', action='store_true',
+                        help='low priority, bandwidth-capped builds (for PCs that are flashing)')
+    parser.add_argument('--bandwidth-mb', type=float, default=DEFAULT_RATE / MB,
+                        help='with --background: disk bandwidth cap in MB/s (reads plus writes)')
+
+def background_from_args(args: argparse.Namespace) -> Optional[Throttle]:
+    """Enable background mode for the whole process when --background was given"""
+    if not getattr(args, 'background', False):
+        return None
+    return start_background(int(args.bandwidth_mb * MB), priority=True, process=True)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='List builds currently running on this PC')
+    parser.parse_args(argv)
+    now = time.time()
+    for marker in active_jobs():
+        pid, _, name = marker.name.partition('-')
+        print(f"pid {pid:>7}  {name.split('.', 1)[-1]:10}  seen {now - marker.stat().st_mtime:4.0f}s ago")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
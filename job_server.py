@@ -0,0 +1,380 @@
+"""
+OPlus ROM Converter - Local Job Server
+Small HTTP API (stdlib only) so other stations can run scans, preflights,
+builds and verifies on this machine. Progress and log lines are streamed as
+Server-Sent Events carrying the same data log_callback/progress_callback get.
+
+Endpoints:
+    GET  /api/regions?rom=PATH          super_def regions of a ROM folder
+    POST /api/jobs                      {"type": "scan|preflight|build|verify", "rom": PATH, ...} -> {"id": ...}
+    GET  /api/jobs                      all jobs
+    GET  /api/jobs/ID                   one job (status, result)
+    GET  /api/jobs/ID/events            text/event-stream of log/progress/status events
+    GET  /api/jobs/ID/trace             Chrome trace of a job submitted with "trace": true
+
+Binding to anything but loopback requires a token: jobs write to any path
+the client names.
+
+Usage:
+    python job_server.py [--host 127.0.0.1] [--port 8765] [--jobs 1] [--token SECRET] [--trace FILE]
+"""
+import sys
+import hmac
+import json
+import time
+import uuid
+import argparse
+import contextlib
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Dict, Optional, Any
+from urllib.parse import urlparse, parse_qs
+
+from converter import (
+    find_all_super_defs, create_super_image, verify_super_image, get_super_path,
+    RegionInfo
+)
+from preflight import run_preflight
+from write_pipeline import PipelineOptions
+from build_cache import BuildCache, build_cache_from_env, GB
+from build_history import BuildHistory, default_history
+from io_throttle import add_background_arguments, background_from_args
+from io_schedule import SCHEDULES, SCHEDULE_AUTO
+from backends import AUTO, DECODERS, ASSEMBLERS
+from tracing import span, collect, current_session, add_trace_arguments, traced_from_args
+
+DEFAULT_PORT = 8765
+JOB_TYPES = ('scan', 'preflight', 'build', 'verify')
+
+# Job states
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+FINAL_STATUSES = (STATUS_DONE, STATUS_FAILED)
+
+# Finished jobs (and their events) are dropped past this count or age
+JOB_RETENTION = 100
+JOB_MAX_AGE = 24 * 3600.0
+
+# Idle SSE connections get a comment line this often so proxies keep them open
+SSE_KEEPALIVE = 15.0
+
+class JobError(Exception):
+    """Bad job request (reported as HTTP 400)"""
+
+@dataclass
+class Job:
+    """One submitted job and its event history"""
+    id: str
+    type: str
+    params: Dict[str, Any]
+    status: str = STATUS_QUEUED
+    created: float = field(default_factory=time.time)
+    finished: Optional[float] = None
+    result: Any = None
+    error: Optional[str] = None
+    events: List[Dict[str, Any]] = field(default_factory=list)
+    trace: Optional[Dict[str, Any]] = field(default=None, repr=False)
+    cond: threading.Condition = field(default_factory=threading.Condition, repr=False)
+
+    def emit(self, event: str, data: Dict[str, Any]):
+        with self.cond:
+            self.events.append({'id': len(self.events), 'event': event, 'data': data})
+            # Marked finished together with the final status event, so a stream
+            # that sees finished has that event too
+            if event == 'status' and data.get('status') in FINAL_STATUSES:
+                self.finished = time.time()
+            self.cond.notify_all()
+
+    def summary(self) -> Dict[str, Any]:
+        return {'id': self.id, 'type': self.type, 'params': self.params, 'status': self.status,
+                'created': self.created, 'finished': self.finished, 'result': self.result,
+                'error': self.error, 'events': len(self.events), 'trace': self.trace is not None}
+
+def _region_dict(region: RegionInfo) -> Dict[str, Any]:
+    return {'nv_id': region.nv_id, 'nv_text': region.nv_text, 'config': region.config_path.name,
+            'used_size': region.used_size, 'partition_count': region.partition_count}
+
+class JobManager:
+    """Runs jobs on a bounded pool and keeps their events for streaming"""
+
+    def __init__(self, max_jobs: int = 1, build_cache: Optional[BuildCache] = None,
+                 history: Optional[BuildHistory] = None, retention: int = JOB_RETENTION,
+                 max_age: float = JOB_MAX_AGE):
+        self.jobs: Dict[str, Job] = {}
+        self.retention = retention
+        self.max_age = max_age
+        self.build_cache = build_cache
+        self.history = history
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_jobs), thread_name_prefix='job')
+
+    def submit(self, params: Dict[str, Any]) -> Job:
+        job_type = params.get('type')
+        if job_type not in JOB_TYPES:
+            raise JobError(f"type must be one of {', '.join(JOB_TYPES)}")
+        rom = params.get('rom')
+        if not rom or not Path(rom).is_dir():
+            raise JobError("rom must be an existing ROM folder")
+        if job_type in ('build', 'verify') and not params.get('region'):
+            raise JobError("region (NV ID) is required")
+        if params.get('io_schedule', SCHEDULE_AUTO) not in SCHEDULES:
+            raise JobError(f"io_schedule must be one of {', '.join(SCHEDULES)}")
+        for key, registry in (('decoder', DECODERS), ('assembler', ASSEMBLERS)):
+            if params.get(key, AUTO) not in [AUTO] + list(registry):
+                raise JobError(f"{key} must be one of {', '.join([AUTO] + list(registry))}")
+        job = Job(id=uuid.uuid4().hex[:12], type=job_type, params=params)
+        with self._lock:
+            self._evict()
+            self.jobs[job.id] = job
+        job.emit('status', {'status': STATUS_QUEUED})
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            return sorted(self.jobs.values(), key=lambda j: j.created)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _evict(self):
+        """Drop finished jobs older than max_age and all but the newest retention ones (lock held)"""
+        finished = sorted((j for j in self.jobs.values() if j.finished is not None),
+                          key=lambda j: j.finished, reverse=True)
+        cutoff = time.time() - self.max_age
+        for index, job in enumerate(finished):
+            if index >= self.retention or job.finished < cutoff:
+                del self.jobs[job.id]
+
+    def _run(self, job: Job):
+        job.status = STATUS_RUNNING
+        job.emit('status', {'status': STATUS_RUNNING})
+        log = lambda msg: job.emit('log', {'message': msg})
+        progress = lambda cur, tot: job.emit('progress', {'current': cur, 'total': tot})
+        # Per-job tracing, unless the whole server is already being traced. The
+        # collector only sees this job's thread and the workers it propagates to.
+        trace = job.params.get('trace') and current_session() is None
+        with (collect() if trace else contextlib.nullcontext()) as tracer:
+            try:
+                with span(f'job:{job.type}', id=job.id):
+                    ok, job.result = self._execute(job, log, progress)
+                job.status = STATUS_DONE if ok else STATUS_FAILED
+            except Exception as e:
+                job.error = str(e)
+                job.status = STATUS_FAILED
+                log(f"ERROR: {e}")
+        if tracer:
+            job.trace = tracer.chrome_trace()
+        job.emit('status', {'status': job.status, 'result': job.result, 'error': job.error})
+
+    @staticmethod
+    def _find_region(rom: Path, nv_id: str) -> RegionInfo:
+        for region in find_all_super_defs(rom):
+            if region.nv_id == nv_id:
+                return region
+        raise JobError(f"region {nv_id} not found")
+
+    def _execute(self, job: Job, log, progress):
+        params = job.params
+        rom = Path(params['rom'])
+        if job.type == 'scan':
+            regions = [_region_dict(r) for r in find_all_super_defs(rom)]
+            log(f"Found {len(regions)} regions")
+            return True, regions
+        if job.type == 'preflight':
+            configs = None
+            if params.get('region'):
+                configs = [self._find_region(rom, params['region']).config]
+            report = run_preflight(rom, configs, log_callback=log)
+            return report.ok, report.to_dict()
+
+        region = self._find_region(rom, params['region'])
+        output = Path(params['output']) if params.get('output') else get_super_path(rom, region.nv_id)
+        if job.type == 'verify':
+            return verify_super_image(region.config, rom, output, log, progress), {'output': str(output)}
+        pipeline_options = PipelineOptions() if params.get('native_decode', True) else None
+        ok = create_super_image(
+            region.config, rom, output, log, progress,
+            pipeline_options=pipeline_options,
+            archive_format=params.get('archive_format'),
+            trim_to_filesystem=bool(params.get('trim_to_filesystem', False)),
+            scratch_dirs=[Path(d) for d in params['scratch_dirs']] if params.get('scratch_dirs') else None,
+            build_cache=self.build_cache if params.get('use_cache', True) else None,
+            history=self.history,
+            decoder=params.get('decoder') or (AUTO if params.get('native_decode', True) else 'simg2img'),
+            assembler=params.get('assembler') or ('native' if params.get('native_layout') else AUTO),
+            io_schedule=params.get('io_schedule', SCHEDULE_AUTO)
+        )
+        return ok, {'output': str(output)}
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """REST + SSE front end of a JobManager"""
+    server_version = 'QFlashForgeJobs/1'
+    manager: JobManager = None
+    token: Optional[str] = None
+
+    def log_message(self, format, *args):
+        pass  # Keep the console for job output
+
+    def _authorized(self) -> bool:
+        if not self.token:
+            return True
+        given = self.headers.get('Authorization', '').encode('utf-8')
+        if hmac.compare_digest(given, f'Bearer {self.token}'.encode('utf-8')):
+            return True
+        self._send_json(401, {'error': 'unauthorized'})
+        return False
+
+    def _send_json(self, code: int, data: Any):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        if parts == ['api', 'regions']:
+            rom = parse_qs(url.query).get('rom', [''])[0]
+            if not rom or not Path(rom).is_dir():
+                self._send_json(400, {'error': 'rom must be an existing ROM folder'})
+                return
+            self._send_json(200, [_region_dict(r) for r in find_all_super_defs(Path(rom))])
+        elif parts == ['api', 'jobs']:
+            self._send_json(200, [j.summary() for j in self.manager.list()])
+        elif len(parts) in (3, 4) and parts[:2] == ['api', 'jobs']:
+            job = self.manager.get(parts[2])
+            if job is None:
+                self._send_json(404, {'error': 'no such job'})
+            elif len(parts) == 3:
+                self._send_json(200, job.summary())
+            elif parts[3] == 'events':
+                self._stream_events(job)
+            elif parts[3] == 'trace':
+                if job.trace is None:
+                    self._send_json(404, {'error': 'job was not traced'})
+                else:
+                    self._send_json(200, job.trace)
+            else:
+                self._send_json(404, {'error': 'not found'})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if urlparse(self.path).path.rstrip('/') != '/api/jobs':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(params, dict):
+                raise JobError("body must be a JSON object")
+            job = self.manager.submit(params)
+        except (ValueError, JobError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(202, {'id': job.id, 'events': f'/api/jobs/{job.id}/events'})
+
+    def _stream_events(self, job: Job):
+        """Replay past events (or those after Last-Event-ID), then follow until the job ends"""
+        try:
+            index = int(self.headers.get('Last-Event-ID', -1)) + 1
+        except ValueError:
+            index = 0
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            while True:
+                with job.cond:
+                    if index >= len(job.events) and job.finished is None:
+                        job.cond.wait(SSE_KEEPALIVE)
+                    pending = job.events[index:]
+                    finished = job.finished is not None
+                if not pending and not finished:
+                    self.wfile.write(b': keepalive\n\n')
+                for event in pending:
+                    self.wfile.write(f"id: {event['id']}\nevent: {event['event']}\n"
+                                     f"data: {json.dumps(event['data'])}\n\n".encode('utf-8'))
+                index += len(pending)
+                self.wfile.flush()
+                if finished and index >= len(job.events):
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            return  # Client went away; the job keeps running
+
+def is_loopback(host: str) -> bool:
+    """True for addresses only this machine can reach (unknown host names count as remote)"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def create_server(host: str = '127.0.0.1', port: int = DEFAULT_PORT, max_jobs: int = 1,
+                  token: Optional[str] = None, build_cache: Optional[BuildCache] = None,
+                  history: Optional[BuildHistory] = None) -> ThreadingHTTPServer:
+    """HTTP server bound to host:port (port 0 picks a free one); call serve_forever()
+
+    Raises ValueError for a non-loopback host without a token.
+    """
+    if not token and not is_loopback(host):
+        raise ValueError(f"Refusing to listen on {host} without --token: any client could start builds")
+    manager = JobManager(max_jobs, build_cache, history)
+    handler = type('BoundJobRequestHandler', (JobRequestHandler,), {'manager': manager, 'token': token})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.manager = manager
+    return server
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Serve the conversion engine over HTTP')
+    parser.add_argument('--host', default='127.0.0.1', help='bind address (0.0.0.0 for the LAN)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--jobs', type=int, default=1, help='concurrent jobs')
+    parser.add_argument('--token', default=None, help='require "Authorization: Bearer TOKEN"')
+    parser.add_argument('--cache', type=Path, default=None, help='build cache folder (default QFF_BUILD_CACHE)')
+    parser.add_argument('--cache-gb', type=float, default=100.0, help='build cache size limit')
+    add_trace_arguments(parser)
+    add_background_arguments(parser)
+    args = parser.parse_args(argv)
+    background_from_args(args)
+
+    build_cache = BuildCache(args.cache, int(args.cache_gb * GB)) if args.cache else build_cache_from_env()
+    try:
+        server = create_server(args.host, args.port, args.jobs, args.token, build_cache, default_history())
+    except (ValueError, OSError) as e:
+        print(f"ERROR: {e}")
+        return 1
+    print(f"Listening on http://{server.server_address[0]}:{server.server_address[1]}/api/jobs")
+    with traced_from_args(args, print):
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Stopping...")
+        finally:
+            server.server_close()
+            server.manager.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+OPlus ROM Converter - Native Super Image Builder
+Lays out partitions the way lpmake does (metadata area, then each partition
+aligned to the block device alignment) and writes super.img without
+external tools. The partition extents are preallocated and filled by
+several workers in parallel, each with its own file descriptors; sparse
+source images are decoded straight into place. On spinning disks the
+sequential schedule (see io_schedule) writes front to back instead. LP
+metadata and geometry are written last, after the data is on disk, so an
+interrupted build never looks like a valid image.
+
+Usage (lpmake-style):
+    python lp_builder.py OUTPUT --device-size N --group main:MAX \
+        --partition system:main:system.img [--partition ...] [-j 4]
+"""
+import os
+import sys
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Dict, Optional, Callable, Tuple
+
+from buffer_pool import get_default_pool
+from lp_metadata import (
+    LpMetadata, LpMetadataError, LpGeometry, LpPartition, LpExtent, LpGroup, LpBlockDevice,
+    LP_SECTOR_SIZE, LP_PARTITION_RESERVED_BYTES, LP_METADATA_GEOMETRY_SIZE, LP_METADATA_MAJOR_VERSION,
+    LP_TARGET_TYPE_LINEAR, LP_PARTITION_ATTR_READONLY,
+    serialize_geometry, serialize_metadata, metadata_offsets
+)
+from lp_unpack import SuperSource, COPY_TASK_SIZE
+from file_io import copy_range, pwrite_all
+from tracing import span, count, propagate, BYTES_READ, BYTES_WRITTEN, add_trace_arguments, traced_from_args
+from io_schedule import (
+    SCHEDULES, SCHEDULE_AUTO, SCHEDULE_SEQUENTIAL, HDD_IO_SIZE, HDD_READAHEAD, resolve_schedule
+)
+from write_pipeline import fadvise
+
+# Same values create_super_image passes to lpmake
+DEFAULT_METADATA_SIZE = 65536
+DEFAULT_METADATA_SLOTS = 3
+
+# lpmake always emits this group first
+DEFAULT_GROUP = 'default'
+
+def _align_up(value: int, alignment: int) -> int:
+    return (value + alignment - 1) // alignment * alignment if alignment else value
+
+def plan_super_layout(
+    device_size: int,
+    alignment: int,
+    block_size: int,
+    groups: List[Tuple[str, int]],
+    partitions: List[Tuple[str, str, int]],
+    metadata_max_size: int = DEFAULT_METADATA_SIZE,
+    metadata_slots: int = DEFAULT_METADATA_SLOTS
+) -> LpMetadata:
+    """Metadata for groups [(name, maximum_size)] and partitions [(name, group, size)]
+
+    Partitions are placed in order, each starting on an alignment boundary
+    after the reserved/geometry/metadata area; sizes are rounded up to
+    block_size. Raises LpMetadataError if they don't fit.
+    """
+    reserved = (LP_PARTITION_RESERVED_BYTES + 2 * LP_METADATA_GEOMETRY_SIZE
+                + 2 * metadata_max_size * metadata_slots)
+    first_logical = _align_up(reserved, alignment)
+    geometry = LpGeometry(metadata_max_size, metadata_slots, block_size)
+    device = LpBlockDevice('super', first_logical // LP_SECTOR_SIZE, alignment, 0, device_size, 0)
+
+    lp_groups = [LpGroup(DEFAULT_GROUP, 0, 0)]
+    lp_groups += [LpGroup(name, 0, max_size) for name, max_size in groups if name != DEFAULT_GROUP]
+    known = {g.name: g for g in lp_groups}
+    group_used: Dict[str, int] = {}
+
+    lp_partitions = []
+    cursor = first_logical
+    for name, group_name, size in partitions:
+        if group_name not in known:
+            raise LpMetadataError(f"{name}: unknown group {group_name}")
+        size = _align_up(size, block_size)
+        group_used[group_name] = group_used.get(group_name, 0) + size
+        limit = known[group_name].maximum_size
+        if limit and group_used[group_name] > limit:
+            raise LpMetadataError(f"Group {group_name} needs {group_used[group_name]} bytes, maximum is {limit}")
+        partition = LpPartition(name, LP_PARTITION_ATTR_READONLY, group_name)
+        if size:
+            start = _align_up(cursor, alignment)
+            if start + size > device_size:
+                raise LpMetadataError(f"{name} does not fit: needs {start + size} of {device_size} bytes")
+            partition.extents.append(LpExtent(size // LP_SECTOR_SIZE, LP_TARGET_TYPE_LINEAR,
+                                              start // LP_SECTOR_SIZE, 0))
+            cursor = start + size
+        lp_partitions.append(partition)
+    return LpMetadata(geometry, LP_METADATA_MAJOR_VERSION, 0, lp_partitions, lp_groups, [device])
+
+def _preallocate(fd: int, offset: int, length: int) -> bool:
+    if not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, offset, length)
+        return True
+    except OSError:
+        return False  # e.g. EOPNOTSUPP on some filesystems; writes still work
+
+def write_metadata(fd: int, metadata: LpMetadata):
+    """Write every metadata slot (primary and backup), then both geometry copies"""
+    blob = serialize_metadata(metadata)
+    for slot in range(metadata.geometry.metadata_slot_count):
+        for offset in metadata_offsets(metadata.geometry, slot):
+            pwrite_all(fd, blob, offset)
+    # Geometry last: without it nothing reads the image as LP super
+    geometry = serialize_geometry(metadata.geometry)
+    pwrite_all(fd, geometry, LP_PARTITION_RESERVED_BYTES)
+    pwrite_all(fd, geometry, LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE)
+
+def write_super_image(
+    metadata: LpMetadata,
+    sources: Dict[str, Path],
+    output_path: Path,
+    workers: Optional[int] = None,
+    preallocate: bool = True,
+    schedule: str = SCHEDULE_AUTO,
+    log_callback: Optional[Callable[[str], None]] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+):
+    """Write partition data from sources (raw or sparse images) in parallel, then the metadata
+
+    The sequential schedule (picked automatically for rotational disks)
+    uses one worker writing in ascending offset order with large reads and
+    read-ahead hints. Raises LpMetadataError/OSError on failure; the output
+    then has no valid geometry.
+    """
+    device_size = metadata.block_devices[0].size
+    pool = get_default_pool()
+    schedule = resolve_schedule(schedule, [output_path] + list(sources.values()))
+    sequential = schedule == SCHEDULE_SEQUENTIAL
+    if sequential:
+        workers = 1
+    workers = max(1, min(workers or os.cpu_count() or 1, pool.capacity))
+
+    opened: Dict[str, SuperSource] = {}
+    try:
+        for partition in metadata.partitions:
+            if partition.extents and partition.name in sources:
+                src = opened[partition.name] = SuperSource(sources[partition.name])
+                if src.size > partition.size:
+                    raise LpMetadataError(f"{partition.name}: image is {src.size} bytes, partition {partition.size}")
+
+        # Truncating to 0 first drops any old geometry, so a crash leaves no valid image
+        with open(output_path, 'wb') as f:
+            f.truncate(device_size)
+            if preallocate:
+                with span('super:preallocate'):
+                    extents = [e for p in metadata.partitions if p.name in opened for e in p.extents]
+                    preallocate = all(_preallocate(f.fileno(), e.offset, e.size) for e in extents)
+
+        # (source, source offset, output offset, length) pieces across all partitions
+        tasks = []
+        for partition in metadata.partitions:
+            src = opened.get(partition.name)
+            if src is None:
+                continue
+            pos = 0
+            for extent in partition.extents:
+                end = min(extent.size, src.size - pos)
+                for piece in range(0, max(0, end), COPY_TASK_SIZE):
+                    tasks.append((partition.name, src, pos + piece, extent.offset + piece,
+                                  min(COPY_TASK_SIZE, end - piece)))
+                pos += extent.size
+        tasks.sort(key=lambda t: t[3])  # Ascending super offset
+        total = sum(t[4] for t in tasks)
+        done = [0]
+        lock = threading.Lock()
+
+        def copy_task(name: str, src: SuperSource, src_offset: int, dst_offset: int, length: int):
+            src_fd = src.open_fd()
+            fd = os.open(output_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                with span(f'extent:{name}', offset=dst_offset, length=length):
+                    if sequential:
+                        fadvise(src_fd, 'POSIX_FADV_SEQUENTIAL')
+                        if not src.sparse:  # Sparse offsets are logical, not file offsets
+                            fadvise(src_fd, 'POSIX_FADV_WILLNEED', src_offset, length + HDD_READAHEAD)
+                        copy_range(src, src_fd, fd, src_offset, dst_offset, length, big_buffer)
+                    else:
+                        with pool.buffer() as buf:
+                            copy_range(src, src_fd, fd, src_offset, dst_offset, length, buf)
+            finally:
+                os.close(fd)
+                os.close(src_fd)
+            count(BYTES_READ, length)  # Logical: holes in sparse sources are not read
+            count(BYTES_WRITTEN, length)
+            with lock:
+                done[0] += length
+                if progress_callback:
+                    progress_callback(done[0], total)
+
+        # One worker: a single large buffer instead of pool-sized pieces. A bounded
+        # exception to the buffer pool: HDD_IO_SIZE once per sequential build.
+        big_buffer = memoryview(bytearray(HDD_IO_SIZE)) if sequential else None
+        if log_callback:
+            log_callback(f"Writing {len(opened)} partitions with {workers} workers, {schedule} schedule "
+                         f"({'preallocated' if preallocate else 'not preallocated'})...")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Workers report to the build's collectors (build history)
+            task_fn = propagate(copy_task)
+            futures = [executor.submit(task_fn, *task) for task in tasks]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        fd = os.open(output_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            with span('super:fsync'):
+                os.fsync(fd)
+            with span('super:metadata'):
+                write_metadata(fd, metadata)
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+    finally:
+        for src in opened.values():
+            src.close()
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Build a super image from partition images without lpmake')
+    parser.add_argument('output', type=Path)
+    parser.add_argument('--device-size', type=int, required=True)
+    parser.add_argument('--alignment', type=int, default=1024 * 1024)
+    parser.add_argument('--block-size', type=int, default=4096)
+    parser.add_argument('--group', action='append', default=[], help='NAME:MAXIMUM_SIZE (repeatable)')
+    parser.add_argument('--partition', action='append', default=[], help='NAME:GROUP:IMAGE (repeatable)')
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--schedule', choices=SCHEDULES, default=SCHEDULE_AUTO,
+                        help='sequential for hard disks (auto: detect)')
+    add_trace_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        groups = [(name, int(size)) for name, size in (g.rsplit(':', 1) for g in args.group)]
+        parts = [p.split(':', 2) for p in args.partition]
+        sources = {name: Path(image) for name, _group, image in parts}
+        sizes = {}
+        for name, path in sources.items():
+            with SuperSource(path) as src:
+                sizes[name] = src.size
+        metadata = plan_super_layout(args.device_size, args.alignment, args.block_size, groups,
+                                     [(name, group, sizes[name]) for name, group, _image in parts])
+        with traced_from_args(args, print):
+            write_super_image(metadata, sources, args.output, args.jobs, schedule=args.schedule, log_callback=print)
+    except (LpMetadataError, OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
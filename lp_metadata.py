@@ -0,0 +1,246 @@
+"""
+OPlus ROM Converter - LP (Logical Partition) Metadata
+Reads and writes the dynamic-partition metadata at the start of super.img
+(see AOSP system/core/fs_mgr/liblp/include/liblp/metadata_format.h).
+"""
+import struct
+import hashlib
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+LP_SECTOR_SIZE = 512
+
+# The first 4 KiB are reserved, then primary and backup geometry (4 KiB each)
+LP_PARTITION_RESERVED_BYTES = 4096
+LP_METADATA_GEOMETRY_SIZE = 4096
+LP_METADATA_GEOMETRY_MAGIC = 0x616C4467
+LP_METADATA_HEADER_MAGIC = 0x414C5030
+LP_METADATA_MAJOR_VERSION = 10
+
+# magic, struct_size, checksum, metadata_max_size, metadata_slot_count, logical_block_size
+GEOMETRY_FORMAT = '<II32sIII'
+GEOMETRY_SIZE = struct.calcsize(GEOMETRY_FORMAT)
+
+# magic, major, minor, header_size, header_checksum, tables_size, tables_checksum,
+# then (offset, num_entries, entry_size) for partitions, extents, groups, block devices
+HEADER_FORMAT = '<IHHI32sI32s' + 'III' * 4
+HEADER_V1_0_SIZE = struct.calcsize(HEADER_FORMAT)
+HEADER_FLAGS_FORMAT = '<I'  # v10.2+, right after the v10.0 fields
+
+PARTITION_FORMAT = '<36sIIII'   # name, attributes, first_extent_index, num_extents, group_index
+EXTENT_FORMAT = '<QIQI'         # num_sectors, target_type, target_data, target_source
+GROUP_FORMAT = '<36sIQ'         # name, flags, maximum_size
+BLOCK_DEVICE_FORMAT = '<QIIQ36sI'  # first_logical_sector, alignment, alignment_offset, size, name, flags
+
+LP_TARGET_TYPE_LINEAR = 0
+LP_TARGET_TYPE_ZERO = 1
+
+LP_PARTITION_ATTR_READONLY = 0x1
+
+class LpMetadataError(Exception):
+    """Raised for missing or corrupt LP metadata"""
+
+@dataclass
+class LpGeometry:
+    metadata_max_size: int
+    metadata_slot_count: int
+    logical_block_size: int
+
+@dataclass
+class LpExtent:
+    num_sectors: int
+    target_type: int
+    target_data: int    # first physical sector for LINEAR extents
+    target_source: int  # block device index
+
+    @property
+    def size(self) -> int:
+        return self.num_sectors * LP_SECTOR_SIZE
+
+    @property
+    def offset(self) -> int:
+        return self.target_data * LP_SECTOR_SIZE
+
+@dataclass
+class LpPartition:
+    name: str
+    attributes: int
+    group_name: str
+    extents: List[LpExtent] = field(default_factory=list)
+
+    @property
+    def size(self) -> int:
+        return sum(e.size for e in self.extents)
+
+@dataclass
+class LpGroup:
+    name: str
+    flags: int
+    maximum_size: int
+
+@dataclass
+class LpBlockDevice:
+    name: str
+    first_logical_sector: int
+    alignment: int
+    alignment_offset: int
+    size: int
+    flags: int
+
+@dataclass
+class LpMetadata:
+    """One metadata slot of a super image"""
+    geometry: LpGeometry
+    major_version: int
+    minor_version: int
+    partitions: List[LpPartition]
+    groups: List[LpGroup]
+    block_devices: List[LpBlockDevice]
+    flags: int = 0
+
+    def partition(self, name: str) -> Optional[LpPartition]:
+        for p in self.partitions:
+            if p.name == name:
+                return p
+        return None
+
+def _cstr(raw: bytes) -> str:
+    return raw.split(b'\x00', 1)[0].decode('ascii', errors='replace')
+
+def parse_geometry(data: bytes) -> LpGeometry:
+    """Validate and decode one geometry block"""
+    if len(data) < GEOMETRY_SIZE:
+        raise LpMetadataError("Truncated geometry")
+    magic, struct_size, checksum, max_size, slot_count, block_size = struct.unpack_from(GEOMETRY_FORMAT, data)
+    if magic != LP_METADATA_GEOMETRY_MAGIC:
+        raise LpMetadataError("Bad geometry magic")
+    if struct_size < GEOMETRY_SIZE or struct_size > len(data):
+        raise LpMetadataError(f"Bad geometry size {struct_size}")
+    raw = bytearray(data[:struct_size])
+    raw[8:40] = bytes(32)
+    if hashlib.sha256(raw).digest() != checksum:
+        raise LpMetadataError("Geometry checksum mismatch")
+    if max_size == 0 or max_size % LP_SECTOR_SIZE or slot_count == 0:
+        raise LpMetadataError("Bad geometry values")
+    return LpGeometry(max_size, slot_count, block_size)
+
+def parse_metadata(data: bytes, geometry: LpGeometry) -> LpMetadata:
+    """Validate and decode one metadata slot (header + tables)"""
+    if len(data) < HEADER_V1_0_SIZE:
+        raise LpMetadataError("Truncated metadata header")
+    fields = struct.unpack_from(HEADER_FORMAT, data)
+    magic, major, minor, header_size, header_checksum, tables_size, tables_checksum = fields[:7]
+    tables = [fields[7 + 3 * i: 10 + 3 * i] for i in range(4)]
+    if magic != LP_METADATA_HEADER_MAGIC:
+        raise LpMetadataError("Bad metadata header magic")
+    if major != LP_METADATA_MAJOR_VERSION:
+        raise LpMetadataError(f"Unsupported metadata version {major}.{minor}")
+    if header_size < HEADER_V1_0_SIZE or header_size + tables_size > len(data):
+        raise LpMetadataError("Metadata exceeds slot size")
+    raw = bytearray(data[:header_size])
+    raw[12:44] = bytes(32)
+    if hashlib.sha256(raw).digest() != header_checksum:
+        raise LpMetadataError("Metadata header checksum mismatch")
+    table_data = data[header_size:header_size + tables_size]
+    if hashlib.sha256(table_data).digest() != tables_checksum:
+        raise LpMetadataError("Metadata tables checksum mismatch")
+    flags = 0
+    if header_size >= HEADER_V1_0_SIZE + 4:
+        flags = struct.unpack_from(HEADER_FLAGS_FORMAT, data, HEADER_V1_0_SIZE)[0]
+
+    def entries(index: int, fmt: str):
+        offset, count, entry_size = tables[index]
+        if entry_size < struct.calcsize(fmt) or offset + count * entry_size > tables_size:
+            raise LpMetadataError("Bad metadata table descriptor")
+        return [struct.unpack_from(fmt, table_data, offset + i * entry_size) for i in range(count)]
+
+    extents = [LpExtent(*e) for e in entries(1, EXTENT_FORMAT)]
+    groups = [LpGroup(_cstr(name), gflags, max_size) for name, gflags, max_size in entries(2, GROUP_FORMAT)]
+    block_devices = [LpBlockDevice(_cstr(name), first, align, align_off, size, bflags)
+                     for first, align, align_off, size, name, bflags in entries(3, BLOCK_DEVICE_FORMAT)]
+    partitions = []
+    for name, attrs, first_extent, num_extents, group_index in entries(0, PARTITION_FORMAT):
+        if first_extent + num_extents > len(extents) or group_index >= len(groups):
+            raise LpMetadataError(f"Partition {_cstr(name)} references missing entries")
+        partitions.append(LpPartition(_cstr(name), attrs, groups[group_index].name,
+                                      extents[first_extent:first_extent + num_extents]))
+    return LpMetadata(geometry, major, minor, partitions, groups, block_devices, flags)
+
+def metadata_offsets(geometry: LpGeometry, slot: int) -> List[int]:
+    """Byte offsets of the primary and backup copy of a slot"""
+    base = LP_PARTITION_RESERVED_BYTES + 2 * LP_METADATA_GEOMETRY_SIZE
+    primary = base + slot * geometry.metadata_max_size
+    backup = base + geometry.metadata_slot_count * geometry.metadata_max_size + slot * geometry.metadata_max_size
+    return [primary, backup]
+
+def read_metadata(read_at, slot: int = 0) -> LpMetadata:
+    """Read metadata through read_at(offset, length) -> bytes, falling back to backups"""
+    geometry = None
+    errors = []
+    for offset in (LP_PARTITION_RESERVED_BYTES, LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE):
+        try:
+            geometry = parse_geometry(read_at(offset, LP_METADATA_GEOMETRY_SIZE))
+            break
+        except LpMetadataError as e:
+            errors.append(str(e))
+    if geometry is None:
+        raise LpMetadataError(f"No valid geometry ({'; '.join(errors)})")
+    if slot >= geometry.metadata_slot_count:
+        raise LpMetadataError(f"Slot {slot} out of range ({geometry.metadata_slot_count} slots)")
+    for offset in metadata_offsets(geometry, slot):
+        try:
+            return parse_metadata(read_at(offset, geometry.metadata_max_size), geometry)
+        except LpMetadataError as e:
+            errors.append(str(e))
+    raise LpMetadataError(f"No valid metadata in slot {slot} ({'; '.join(errors)})")
+
+def _cbytes(name: str, size: int = 36) -> bytes:
+    raw = name.encode('ascii')
+    if len(raw) >= size:
+        raise LpMetadataError(f"Name too long: {name}")
+    return raw.ljust(size, b'\x00')
+
+def serialize_geometry(geometry: LpGeometry) -> bytes:
+    """One LP_METADATA_GEOMETRY_SIZE block with a valid checksum"""
+    raw = bytearray(struct.pack(GEOMETRY_FORMAT, LP_METADATA_GEOMETRY_MAGIC, GEOMETRY_SIZE, bytes(32),
+                                geometry.metadata_max_size, geometry.metadata_slot_count,
+                                geometry.logical_block_size))
+    raw[8:40] = hashlib.sha256(raw).digest()
+    return bytes(raw).ljust(LP_METADATA_GEOMETRY_SIZE, b'\x00')
+
+def serialize_metadata(metadata: LpMetadata) -> bytes:
+    """Header (v10.0) and tables of one metadata slot, checksummed"""
+    group_index = {g.name: i for i, g in enumerate(metadata.groups)}
+    partitions = bytearray()
+    extents = bytearray()
+    extent_count = 0
+    for p in metadata.partitions:
+        if p.group_name not in group_index:
+            raise LpMetadataError(f"Partition {p.name} references unknown group {p.group_name}")
+        partitions += struct.pack(PARTITION_FORMAT, _cbytes(p.name), p.attributes, extent_count,
+                                  len(p.extents), group_index[p.group_name])
+        for e in p.extents:
+            extents += struct.pack(EXTENT_FORMAT, e.num_sectors, e.target_type, e.target_data, e.target_source)
+        extent_count += len(p.extents)
+    groups = b''.join(struct.pack(GROUP_FORMAT, _cbytes(g.name), g.flags, g.maximum_size)
+                      for g in metadata.groups)
+    devices = b''.join(struct.pack(BLOCK_DEVICE_FORMAT, d.first_logical_sector, d.alignment,
+                                   d.alignment_offset, d.size, _cbytes(d.name), d.flags)
+                       for d in metadata.block_devices)
+
+    tables = bytes(partitions) + bytes(extents) + groups + devices
+    descriptors = []
+    offset = 0
+    for data, fmt in ((partitions, PARTITION_FORMAT), (extents, EXTENT_FORMAT),
+                      (groups, GROUP_FORMAT), (devices, BLOCK_DEVICE_FORMAT)):
+        entry_size = struct.calcsize(fmt)
+        descriptors += [offset, len(data) // entry_size, entry_size]
+        offset += len(data)
+    header = bytearray(struct.pack(HEADER_FORMAT, LP_METADATA_HEADER_MAGIC, LP_METADATA_MAJOR_VERSION, 0,
+                                   HEADER_V1_0_SIZE, bytes(32), len(tables),
+                                   hashlib.sha256(tables).digest(), *descriptors))
+    header[12:44] = hashlib.sha256(header).digest()
+    data = bytes(header) + tables
+    if len(data) > metadata.geometry.metadata_max_size:
+        raise LpMetadataError(f"Metadata needs {len(data)} bytes, slot holds {metadata.geometry.metadata_max_size}")
+    return data
@@ -0,0 +1,358 @@
+"""
+OPlus ROM Converter - Parallel Block Compression
+Compresses super.img (or partition images) in independent blocks across all
+cores with stdlib zlib/lzma. Output stays standard:
+
+- gzip: one gzip member per block (concatenated members are plain gzip);
+  each member carries its size in a FEXTRA subfield ('QF'), like BGZF, so
+  the decompressor can split the file without inflating it.
+- xz:   one xz stream per block (concatenated streams are plain xz); stream
+  boundaries are found from the stream footers/indexes.
+
+All-zero blocks (holes, DONT_CARE/zero FILL regions of the build) are never
+read or compressed: a cached member is emitted, and decompression writes
+them back as holes.
+
+Usage:
+    python parallel_compress.py compress super.img [--format xz] [-j 8]
+    python parallel_compress.py decompress super.img.gz super.img
+"""
+import os
+import sys
+import gzip
+import lzma
+import zlib
+import bisect
+import struct
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Callable, Tuple
+
+from buffer_pool import get_default_pool
+
+MB = 1024 * 1024
+
+FORMAT_GZIP = 'gzip'
+FORMAT_XZ = 'xz'
+EXTENSIONS = {FORMAT_GZIP: '.gz', FORMAT_XZ: '.xz'}
+
+DEFAULT_BLOCK_SIZE = 4 * MB
+
+# gzip member header: magic, CM=deflate, FLG=FEXTRA, MTIME=0, XFL=0, OS=unknown,
+# XLEN=12, subfield 'QF' (len 8): total member size, uncompressed size
+GZIP_HEADER_FORMAT = '<BBBBIBBH2sHII'
+GZIP_HEADER_SIZE = struct.calcsize(GZIP_HEADER_FORMAT)
+GZIP_TRAILER_SIZE = 8
+
+# Streams larger than this are decompressed sequentially instead of in memory
+MAX_PARALLEL_MEMBER = 64 * MB
+
+@dataclass
+class CompressStats:
+    """Result of a compress/decompress run"""
+    bytes_in: int = 0
+    bytes_out: int = 0
+    blocks: int = 0
+    zero_blocks: int = 0
+
+# --- Block codecs ---
+
+def _gzip_member(data: bytes, level: int) -> bytes:
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = comp.compress(data) + comp.flush()
+    total = GZIP_HEADER_SIZE + len(body) + GZIP_TRAILER_SIZE
+    header = struct.pack(GZIP_HEADER_FORMAT, 0x1F, 0x8B, 8, 0x04, 0, 0, 255,
+                         12, b'QF', 8, total, len(data))
+    return header + body + struct.pack('<II', zlib.crc32(data), len(data) & 0xFFFFFFFF)
+
+def _xz_stream(data: bytes, level: int) -> bytes:
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+def _compress_block(fmt: str, data: bytes, level: int) -> bytes:
+    return _gzip_member(data, level) if fmt == FORMAT_GZIP else _xz_stream(data, level)
+
+def _decompress_gzip_member(member: bytes) -> bytes:
+    body = member[GZIP_HEADER_SIZE:-GZIP_TRAILER_SIZE]
+    crc, isize = struct.unpack('<II', member[-GZIP_TRAILER_SIZE:])
+    data = zlib.decompress(body, -15)
+    if zlib.crc32(data) != crc or len(data) & 0xFFFFFFFF != isize:
+        raise IOError("gzip member CRC mismatch")
+    return data
+
+# --- Zero / hole detection ---
+
+def _data_ranges(f, size: int) -> Optional[List[Tuple[int, int]]]:
+    """Allocated (start, end) ranges via SEEK_DATA/SEEK_HOLE, None if unsupported"""
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    fd = f.fileno()
+    ranges = []
+    pos = 0
+    try:
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError:
+                break  # ENXIO: only a hole remains
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            ranges.append((start, end))
+            pos = end
+    except OSError:
+        return None
+    finally:
+        f.seek(0)
+    return ranges
+
+def _is_skipped(start: int, end: int, data_ranges: Optional[List[Tuple[int, int]]],
+                zero_ranges: List[Tuple[int, int]]) -> bool:
+    """True when [start, end) is known to be zero without reading it"""
+    for z_start, z_len in zero_ranges:
+        if z_start <= start and end <= z_start + z_len:
+            return True
+    if data_ranges is None:
+        return False
+    # First allocated range ending after start; ranges are sorted and disjoint
+    i = bisect.bisect_right(data_ranges, (start, start))
+    if i > 0 and data_ranges[i - 1][1] > start:
+        return False
+    return i == len(data_ranges) or data_ranges[i][0] >= end
+
+# --- Compression ---
+
+def compress_file(
+    src_path: Path,
+    dst_path: Path,
+    fmt: str = FORMAT_GZIP,
+    level: Optional[int] = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    workers: Optional[int] = None,
+    zero_ranges: Optional[List[Tuple[int, int]]] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+) -> CompressStats:
+    """Compress src in independent blocks on a thread pool
+
+    zero_ranges: (offset, length) regions the caller knows are zero (e.g.
+    DONT_CARE extents); holes in a sparse source are detected automatically.
+    """
+    if fmt not in EXTENSIONS:
+        raise ValueError(f"Unknown format: {fmt}")
+    if level is None:
+        level = 6
+    workers = workers or os.cpu_count() or 1
+    total = src_path.stat().st_size
+    stats = CompressStats(bytes_in=total)
+    zero_members = {}
+
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        data_ranges = _data_ranges(src, total)
+        pending = deque()
+
+        def drain(limit: int):
+            while len(pending) > limit:
+                out = pending.popleft().result()
+                dst.write(out)
+                stats.bytes_out += len(out)
+
+        offset = 0
+        while offset < total:
+            length = min(block_size, total - offset)
+            data = None
+            if not _is_skipped(offset, offset + length, data_ranges, zero_ranges or []):
+                src.seek(offset)
+                data = src.read(length)
+                if data.count(0) == length:
+                    data = None
+            if data is None:
+                # Same member for every zero block of this length: compress it once
+                member = zero_members.get(length)
+                if member is None:
+                    member = zero_members[length] = _compress_block(fmt, bytes(length), level)
+                future = Future()
+                future.set_result(member)
+                stats.zero_blocks += 1
+            else:
+                future = pool.submit(_compress_block, fmt, data, level)
+            pending.append(future)
+            stats.blocks += 1
+            offset += length
+            # Bound memory: at most two blocks in flight per worker
+            drain(workers * 2)
+            if progress_callback:
+                progress_callback(offset, total)
+        drain(0)
+    return stats
+
+# --- Decompression ---
+
+def _gzip_members(f, size: int) -> Optional[List[Tuple[int, int]]]:
+    """(offset, length) of each 'QF' gzip member, None if the file isn't ours"""
+    members = []
+    pos = 0
+    while pos < size:
+        f.seek(pos)
+        header = f.read(GZIP_HEADER_SIZE)
+        if len(header) < GZIP_HEADER_SIZE:
+            return None
+        fields = struct.unpack(GZIP_HEADER_FORMAT, header)
+        if fields[:4] != (0x1F, 0x8B, 8, 0x04) or fields[8] != b'QF' or fields[9] != 8:
+            return None
+        total, isize = fields[10], fields[11]
+        if isize > MAX_PARALLEL_MEMBER:
+            return None
+        members.append((pos, total))
+        pos += total
+    f.seek(0)
+    return members
+
+def _read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def _xz_streams(f, size: int) -> Optional[List[Tuple[int, int]]]:
+    """(offset, length) of each concatenated xz stream, walking footers backwards"""
+    streams = []
+    pos = size
+    try:
+        while pos > 0:
+            # Stream padding is null bytes in multiples of 4
+            f.seek(pos - 4)
+            while pos >= 4 and f.read(4) == b'\x00\x00\x00\x00':
+                pos -= 4
+                f.seek(pos - 4)
+            f.seek(pos - 12)
+            footer = f.read(12)
+            if footer[10:12] != b'YZ':
+                return None
+            backward_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+            index_start = pos - 12 - backward_size
+            f.seek(index_start)
+            index = f.read(backward_size)
+            if index[0] != 0:
+                return None
+            count, p = _read_varint(index, 1)
+            blocks = uncompressed = 0
+            for _ in range(count):
+                unpadded, p = _read_varint(index, p)
+                size_out, p = _read_varint(index, p)
+                blocks += (unpadded + 3) // 4 * 4
+                uncompressed += size_out
+            if uncompressed > MAX_PARALLEL_MEMBER:
+                return None
+            start = index_start - blocks - 12
+            if start < 0:
+                return None
+            streams.append((start, pos - start))
+            pos = start
+    except (OSError, IndexError, struct.error):
+        return None
+    finally:
+        f.seek(0)
+    streams.reverse()
+    return streams
+
+def _write_block(dst, data: bytes):
+    """Write a decompressed block, turning all-zero blocks into holes"""
+    if data.count(0) == len(data):
+        dst.seek(len(data), os.SEEK_CUR)
+    else:
+        dst.write(data)
+
+def decompress_file(
+    src_path: Path,
+    dst_path: Path,
+    workers: Optional[int] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+) -> CompressStats:
+    """Decompress a .gz/.xz file, in parallel when it was written block-wise"""
+    workers = workers or os.cpu_count() or 1
+    size = src_path.stat().st_size
+    stats = CompressStats(bytes_in=size)
+    with open(src_path, 'rb') as src:
+        magic = src.read(6)
+        src.seek(0)
+        if magic[:2] == b'\x1f\x8b':
+            units, decode, opener = _gzip_members(src, size), _decompress_gzip_member, gzip.open
+        elif magic == b'\xfd7zXZ\x00':
+            units, decode, opener = _xz_streams(src, size), lzma.decompress, lzma.open
+        else:
+            raise ValueError(f"{src_path.name} is neither gzip nor xz")
+
+        with open(dst_path, 'wb') as dst:
+            if units is None:
+                # Foreign single-stream file: stream it sequentially
+                with opener(src_path, 'rb') as stream, get_default_pool().buffer() as buf:
+                    while True:
+                        n = stream.readinto(buf)
+                        if not n:
+                            break
+                        _write_block(dst, bytes(buf[:n]))
+                        stats.bytes_out += n
+                        stats.blocks += 1
+                dst.truncate(stats.bytes_out)
+                return stats
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+
+                def drain(limit: int):
+                    while len(pending) > limit:
+                        data = pending.popleft().result()
+                        if data.count(0) == len(data):
+                            stats.zero_blocks += 1
+                        _write_block(dst, data)
+                        stats.bytes_out += len(data)
+
+                for offset, length in units:
+                    src.seek(offset)
+                    pending.append(pool.submit(decode, src.read(length)))
+                    stats.blocks += 1
+                    drain(workers * 2)
+                    if progress_callback:
+                        progress_callback(offset + length, size)
+                drain(0)
+            dst.truncate(stats.bytes_out)
+    return stats
+
+def archive_path(path: Path, fmt: str) -> Path:
+    """super.img -> super.img.gz / super.img.xz"""
+    return path.with_name(path.name + EXTENSIONS[fmt])
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Block-parallel gzip/xz for super and partition images')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('compress', help='compress one or more images')
+    p.add_argument('inputs', nargs='+', type=Path)
+    p.add_argument('--format', '-f', choices=sorted(EXTENSIONS), default=FORMAT_GZIP)
+    p.add_argument('--level', '-l', type=int)
+    p.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE)
+    p.add_argument('-j', '--jobs', type=int)
+    p = sub.add_parser('decompress', help='decompress an archive')
+    p.add_argument('input', type=Path)
+    p.add_argument('output', type=Path)
+    p.add_argument('-j', '--jobs', type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == 'compress':
+        for path in args.inputs:
+            out = archive_path(path, args.format)
+            stats = compress_file(path, out, args.format, args.level, args.block_size, args.jobs)
+            ratio = stats.bytes_out / stats.bytes_in if stats.bytes_in else 0
+            print(f"{path.name} -> {out.name}: {stats.bytes_out / MB:.1f} MB ({ratio:.1%}), "
+                  f"{stats.zero_blocks}/{stats.blocks} zero blocks")
+    else:
+        stats = decompress_file(args.input, args.output, args.jobs)
+        print(f"{args.input.name} -> {args.output.name}: {stats.bytes_out / MB:.1f} MB")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
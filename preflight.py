@@ -0,0 +1,265 @@
+"""
+OPlus ROM Converter - Integrity Preflight
+Checks every image referenced by the rawprogram XMLs and super_def files
+before a build or flash: the file exists, fits its partition, is sparse
+exactly when it should be, and is not truncated. Only headers are read
+(sparse chunk tables, ext4/EROFS superblocks), so a full ROM takes seconds.
+
+Usage:
+    python preflight.py ROM_FOLDER [--json report.json]
+"""
+import sys
+import json
+import time
+import struct
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import List, Dict, Optional, Callable
+
+from converter import (
+    find_rawprogram_xmls, parse_rawprogram_xml, find_all_super_defs,
+    SuperConfig, RawprogramEntry
+)
+from fs_size import read_filesystem_info
+from sparse_image import (
+    SPARSE_HEADER_MAGIC, SPARSE_HEADER_FORMAT, SPARSE_HEADER_SIZE,
+    CHUNK_HEADER_FORMAT, CHUNK_HEADER_SIZE, CHUNK_TYPE_RAW, CHUNK_TYPE_FILL,
+    CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32
+)
+from tracing import traced
+
+PREFLIGHT_WORKERS = 8
+REPORT_VERSION = 1
+
+SEVERITY_ERROR = 'error'
+SEVERITY_WARNING = 'warning'
+
+@dataclass
+class ImageCheck:
+    """Header-level facts about one image file"""
+    path: str
+    exists: bool
+    file_size: int = 0
+    is_sparse: bool = False
+    raw_size: int = 0       # Decoded size (file size for raw images)
+    fs_type: Optional[str] = None
+    problem: Optional[str] = None  # Structural damage (truncation etc.)
+
+@dataclass
+class Issue:
+    """One preflight finding"""
+    severity: str
+    source: str     # rawprogram XML or super_def file name
+    target: str     # partition label / name
+    message: str
+
+@dataclass
+class PreflightReport:
+    """Machine-readable preflight result"""
+    rom_folder: str
+    images: Dict[str, ImageCheck] = field(default_factory=dict)
+    issues: List[Issue] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def errors(self) -> List[Issue]:
+        return [i for i in self.issues if i.severity == SEVERITY_ERROR]
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def to_dict(self) -> Dict:
+        return {
+            'version': REPORT_VERSION,
+            'rom_folder': self.rom_folder,
+            'ok': self.ok,
+            'elapsed': round(self.elapsed, 3),
+            'error_count': len(self.errors),
+            'warning_count': len(self.issues) - len(self.errors),
+            'issues': [asdict(i) for i in self.issues],
+            'images': {k: asdict(v) for k, v in sorted(self.images.items())},
+        }
+
+def _walk_sparse(f, file_size: int) -> Optional[str]:
+    """Walk the chunk headers of a sparse image, describe damage if any"""
+    header = f.read(SPARSE_HEADER_SIZE)
+    (_magic, _major, _minor, file_hdr_sz, chunk_hdr_sz,
+     block_size, total_blocks, total_chunks, _checksum) = struct.unpack(SPARSE_HEADER_FORMAT, header)
+    pos = file_hdr_sz
+    blocks = 0
+    for i in range(total_chunks):
+        if pos + CHUNK_HEADER_SIZE > file_size:
+            return f"truncated at chunk {i}/{total_chunks}"
+        f.seek(pos)
+        chunk_type, _reserved, chunk_blocks, total_sz = struct.unpack(CHUNK_HEADER_FORMAT, f.read(CHUNK_HEADER_SIZE))
+        if chunk_type == CHUNK_TYPE_RAW:
+            expected = chunk_hdr_sz + chunk_blocks * block_size
+        elif chunk_type == CHUNK_TYPE_FILL or chunk_type == CHUNK_TYPE_CRC32:
+            expected = chunk_hdr_sz + 4
+        elif chunk_type == CHUNK_TYPE_DONT_CARE:
+            expected = chunk_hdr_sz
+        else:
+            return f"unknown chunk type 0x{chunk_type:04X} at chunk {i}"
+        if total_sz != expected:
+            return f"bad size for chunk {i}"
+        if chunk_type != CHUNK_TYPE_CRC32:
+            blocks += chunk_blocks
+        pos += total_sz
+        if pos > file_size:
+            return f"truncated in chunk {i}/{total_chunks} ({file_size} of {pos} bytes)"
+    if blocks != total_blocks:
+        return f"chunks cover {blocks} of {total_blocks} blocks"
+    return None
+
+def check_image(path: Path) -> ImageCheck:
+    """Stat an image and validate its headers without reading its data"""
+    try:
+        st = path.stat()
+    except OSError:
+        return ImageCheck(path=str(path), exists=False)
+    check = ImageCheck(path=str(path), exists=True, file_size=st.st_size, raw_size=st.st_size)
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(SPARSE_HEADER_SIZE)
+            if len(header) >= 4 and struct.unpack('<I', header[:4])[0] == SPARSE_HEADER_MAGIC:
+                check.is_sparse = True
+                if len(header) < SPARSE_HEADER_SIZE:
+                    check.problem = "truncated sparse header"
+                    return check
+                fields = struct.unpack(SPARSE_HEADER_FORMAT, header)
+                check.raw_size = fields[5] * fields[6]
+                f.seek(0)
+                check.problem = _walk_sparse(f, st.st_size)
+                return check
+        info = read_filesystem_info(path)
+        if info:
+            check.fs_type = info.fs_type
+            if info.size > st.st_size:
+                check.problem = f"{info.fs_type} needs {info.size} bytes, file has {st.st_size}"
+    except (OSError, struct.error) as e:
+        check.problem = f"unreadable: {e}"
+    return check
+
+def _rawprogram_issues(xml_path: Path, entries: List[RawprogramEntry],
+                       images: Dict[str, ImageCheck]) -> List[Issue]:
+    issues = []
+    for entry in entries:
+        check = images[str(xml_path.parent / entry.filename)]
+        label = entry.label or entry.filename
+        if not check.exists:
+            issues.append(Issue(SEVERITY_ERROR, xml_path.name, label, f"{entry.filename} missing"))
+            continue
+        if check.problem:
+            issues.append(Issue(SEVERITY_ERROR, xml_path.name, label, f"{entry.filename}: {check.problem}"))
+        if check.is_sparse != entry.sparse:
+            expected = 'sparse' if entry.sparse else 'raw'
+            actual = 'sparse' if check.is_sparse else 'raw'
+            issues.append(Issue(SEVERITY_ERROR, xml_path.name, label,
+                                f"{entry.filename} is {actual} but XML says {expected}"))
+        capacity = entry.num_sectors * entry.sector_size
+        # num_partition_sectors 0 means "rest of the disk"
+        if capacity and check.raw_size > capacity:
+            issues.append(Issue(SEVERITY_ERROR, xml_path.name, label,
+                                f"{entry.filename} needs {check.raw_size} bytes, partition has {capacity}"))
+    return issues
+
+def _super_def_issues(config: SuperConfig, rom_folder: Path, images: Dict[str, ImageCheck]) -> List[Issue]:
+    source = Path(config.config_file).name
+    issues = []
+    group_sizes: Dict[str, int] = {}
+    for partition in config.partitions:
+        group_sizes[partition.group_name] = group_sizes.get(partition.group_name, 0) + partition.size
+        if not partition.path:
+            continue
+        check = images[str(rom_folder / partition.path)]
+        if not check.exists:
+            issues.append(Issue(SEVERITY_ERROR, source, partition.name, f"{partition.path} missing"))
+            continue
+        if check.problem:
+            issues.append(Issue(SEVERITY_ERROR, source, partition.name, f"{partition.path}: {check.problem}"))
+        if check.raw_size > partition.size:
+            issues.append(Issue(SEVERITY_ERROR, source, partition.name,
+                                f"{partition.path} needs {check.raw_size} bytes, partition has {partition.size}"))
+    for group in config.groups:
+        name = group.get('name', '')
+        limit = int(group.get('maximum_size', 0) or 0)
+        if limit and group_sizes.get(name, 0) > limit:
+            issues.append(Issue(SEVERITY_ERROR, source, name,
+                                f"group needs {group_sizes[name]} bytes, maximum_size is {limit}"))
+    total = sum(group_sizes.values())
+    if config.super_size and total > config.super_size:
+        issues.append(Issue(SEVERITY_WARNING, source, 'super',
+                            f"partitions total {total} bytes, super is {config.super_size}"))
+    return issues
+
+@traced('preflight')
+def run_preflight(
+    rom_folder: Path,
+    configs: Optional[List[SuperConfig]] = None,
+    check_rawprogram: bool = True,
+    log_callback: Optional[Callable[[str], None]] = None
+) -> PreflightReport:
+    """Validate a ROM folder
+
+    configs limits the super_def check to the given regions (default: all
+    super_def files in META); check_rawprogram adds the rawprogram XMLs.
+    """
+    start = time.perf_counter()
+    report = PreflightReport(rom_folder=str(rom_folder))
+    if configs is None:
+        configs = [r.config for r in find_all_super_defs(rom_folder) if r.config]
+    xml_entries: Dict[Path, List[RawprogramEntry]] = {}
+    for xml_path in (find_rawprogram_xmls(rom_folder) if check_rawprogram else []):
+        try:
+            xml_entries[xml_path] = parse_rawprogram_xml(xml_path)
+        except Exception as e:
+            report.issues.append(Issue(SEVERITY_ERROR, xml_path.name, '', f"cannot parse: {e}"))
+
+    # Collect every referenced image once (regions share most of them)
+    paths = set()
+    for config in configs:
+        paths.update(str(rom_folder / p.path) for p in config.partitions if p.path)
+    for xml_path, entries in xml_entries.items():
+        paths.update(str(xml_path.parent / e.filename) for e in entries)
+
+    if paths:
+        with ThreadPoolExecutor(max_workers=min(PREFLIGHT_WORKERS, len(paths))) as pool:
+            for check in pool.map(check_image, [Path(p) for p in sorted(paths)]):
+                report.images[check.path] = check
+
+    for xml_path, entries in xml_entries.items():
+        report.issues.extend(_rawprogram_issues(xml_path, entries, report.images))
+    for config in configs:
+        report.issues.extend(_super_def_issues(config, rom_folder, report.images))
+    report.elapsed = time.perf_counter() - start
+
+    if log_callback:
+        log_callback(f"Preflight: {len(report.images)} images, {len(report.errors)} errors, "
+                     f"{len(report.issues) - len(report.errors)} warnings ({report.elapsed:.1f}s)")
+        for issue in report.issues:
+            prefix = "ERROR" if issue.severity == SEVERITY_ERROR else "WARNING"
+            log_callback(f"{prefix}: [{issue.source}] {issue.target}: {issue.message}")
+    return report
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Validate ROM images against rawprogram XMLs and super_def files')
+    parser.add_argument('rom_folder', type=Path)
+    parser.add_argument('--json', type=Path, help='write the report here ("-" for stdout)')
+    parser.add_argument('--no-rawprogram', action='store_true', help='only check super_def files')
+    args = parser.parse_args(argv)
+
+    report = run_preflight(args.rom_folder, check_rawprogram=not args.no_rawprogram,
+                           log_callback=None if args.json == Path('-') else print)
+    if args.json:
+        data = json.dumps(report.to_dict(), indent=2)
+        if args.json == Path('-'):
+            print(data)
+        else:
+            args.json.write_text(data, encoding='utf-8')
+    return 0 if report.ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
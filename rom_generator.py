@@ -0,0 +1,306 @@
+"""
+OPlus ROM Converter - Synthetic ROM Generator
+Builds a fake ROM tree (META/super_def.*.json, IMAGES/*.img, rawprogram XMLs)
+in the layout the converter expects, for testing and benchmarking without
+real firmware. Images are streamed, so sizes scale from MB to tens of GB.
+
+Usage:
+    python rom_generator.py OUT_DIR --partition-size 512M --regions 4 --zip
+"""
+import os
+import sys
+import json
+import random
+import struct
+import zipfile
+import argparse
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
+
+from converter import (
+    SPARSE_HEADER_MAGIC, SPARSE_HEADER_FORMAT, CHUNK_HEADER_FORMAT,
+    CHUNK_TYPE_RAW, CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE
+)
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# Size of the random pool RAW chunks are cut from
+DATA_POOL_SIZE = 4 * MB
+
+@dataclass
+class GeneratorConfig:
+    """What to generate"""
+    partition_size: int = 64 * MB
+    dynamic_partitions: List[str] = field(default_factory=lambda: [
+        'system', 'system_ext', 'product', 'vendor', 'odm', 'my_product'])
+    # One small image per region, e.g. IMAGES/my_region.10010111.img
+    region_partitions: List[str] = field(default_factory=lambda: ['my_region'])
+    region_partition_size: int = 4 * MB
+    # Non-dynamic images referenced from rawprogram XMLs
+    firmware_partitions: List[str] = field(default_factory=lambda: [
+        'boot', 'vendor_boot', 'dtbo', 'vbmeta'])
+    firmware_size: int = 1 * MB
+    regions: int = 3
+    # Fraction of dynamic images written in sparse form (rest are raw)
+    sparse_ratio: float = 1.0
+    # Relative weights of RAW / FILL / DONT_CARE chunks
+    chunk_mix: Tuple[float, float, float] = (0.6, 0.2, 0.2)
+    # Chunk length range in blocks
+    chunk_blocks: Tuple[int, int] = (64, 1024)
+    block_size: int = 4096
+    sector_size: int = 4096
+    seed: int = 0
+
+@dataclass
+class ChunkSpec:
+    """One chunk of a generated image"""
+    chunk_type: int
+    blocks: int
+    fill: bytes = b'\x00\x00\x00\x00'
+
+def plan_chunks(rng: random.Random, total_blocks: int, config: GeneratorConfig) -> List[ChunkSpec]:
+    """Split an image into a random RAW/FILL/DONT_CARE chunk layout"""
+    types = [CHUNK_TYPE_RAW, CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE]
+    chunks = []
+    block = 0
+    lo, hi = config.chunk_blocks
+    while block < total_blocks:
+        n = min(rng.randint(lo, hi), total_blocks - block)
+        chunk_type = rng.choices(types, weights=config.chunk_mix)[0]
+        fill = b'\x00\x00\x00\x00'
+        if chunk_type == CHUNK_TYPE_FILL and rng.random() < 0.5:
+            fill = struct.pack('<I', rng.getrandbits(32))
+        # Merge with the previous chunk when identical, like img2simg would
+        if chunks and chunks[-1].chunk_type == chunk_type and chunk_type != CHUNK_TYPE_RAW \
+                and chunks[-1].fill == fill:
+            chunks[-1].blocks += n
+        else:
+            chunks.append(ChunkSpec(chunk_type, n, fill))
+        block += n
+    return chunks
+
+def _iter_data(pool: bytes, rng: random.Random, length: int):
+    """Yield `length` bytes of pseudo-random data cut from the pool"""
+    pool = memoryview(pool)
+    while length > 0:
+        offset = rng.randrange(0, len(pool) // 2)
+        piece = pool[offset:offset + min(length, len(pool) - offset)]
+        yield piece
+        length -= len(piece)
+
+def _iter_fill(pattern: bytes, length: int):
+    block = pattern * (min(MB, length) // 4)
+    while length > 0:
+        n = min(len(block), length)
+        yield block[:n]
+        length -= n
+
+def write_sparse_image(path: Path, chunks: List[ChunkSpec], block_size: int,
+                       pool: bytes, rng: random.Random):
+    """Write chunks as an Android sparse image"""
+    total_blocks = sum(c.blocks for c in chunks)
+    hdr = struct.calcsize(CHUNK_HEADER_FORMAT)
+    with open(path, 'wb') as f:
+        f.write(struct.pack(SPARSE_HEADER_FORMAT, SPARSE_HEADER_MAGIC, 1, 0,
+                            struct.calcsize(SPARSE_HEADER_FORMAT), hdr,
+                            block_size, total_blocks, len(chunks), 0))
+        for c in chunks:
+            length = c.blocks * block_size
+            if c.chunk_type == CHUNK_TYPE_RAW:
+                f.write(struct.pack(CHUNK_HEADER_FORMAT, c.chunk_type, 0, c.blocks, hdr + length))
+                for piece in _iter_data(pool, rng, length):
+                    f.write(piece)
+            elif c.chunk_type == CHUNK_TYPE_FILL:
+                f.write(struct.pack(CHUNK_HEADER_FORMAT, c.chunk_type, 0, c.blocks, hdr + 4))
+                f.write(c.fill)
+            else:
+                f.write(struct.pack(CHUNK_HEADER_FORMAT, c.chunk_type, 0, c.blocks, hdr))
+
+def write_raw_image(path: Path, chunks: List[ChunkSpec], block_size: int,
+                    pool: bytes, rng: random.Random):
+    """Write chunks as a raw image (zero runs become filesystem holes)"""
+    with open(path, 'wb') as f:
+        for c in chunks:
+            length = c.blocks * block_size
+            if c.chunk_type == CHUNK_TYPE_RAW:
+                for piece in _iter_data(pool, rng, length):
+                    f.write(piece)
+            elif c.chunk_type == CHUNK_TYPE_FILL and c.fill != b'\x00\x00\x00\x00':
+                for piece in _iter_fill(c.fill, length):
+                    f.write(piece)
+            else:
+                f.seek(length, os.SEEK_CUR)
+        f.truncate(sum(c.blocks for c in chunks) * block_size)
+
+def _write_image(path: Path, size: int, sparse: bool, config: GeneratorConfig,
+                 pool: bytes, rng: random.Random):
+    chunks = plan_chunks(rng, size // config.block_size, config)
+    if sparse:
+        write_sparse_image(path, chunks, config.block_size, pool, rng)
+    else:
+        write_raw_image(path, chunks, config.block_size, pool, rng)
+
+def _align(value: int, alignment: int) -> int:
+    return (value + alignment - 1) // alignment * alignment
+
+def _super_def(config: GeneratorConfig, nv_id: str, nv_text: str,
+               partitions: List[Dict]) -> Dict:
+    used = sum(int(p['size']) for p in partitions if p.get('path'))
+    group_max = _align(used + 256 * MB, MB)
+    super_size = _align(group_max * 2 + 16 * MB, MB)
+    groups = [{'name': 'default', 'maximum_size': '0'}]
+    for slot in ('_a', '_b'):
+        groups.append({'name': f'qti_dynamic_partitions{slot}', 'maximum_size': str(group_max)})
+    return {
+        'nv_id': nv_id,
+        'nv_text': nv_text,
+        'super_device': {'total_size': str(super_size), 'used_size': str(used)},
+        'block_devices': [{'name': 'super', 'block_size': str(config.block_size),
+                           'alignment': '1048576', 'size': str(super_size)}],
+        'groups': groups,
+        'partitions': partitions,
+    }
+
+def _write_rawprogram(path: Path, entries: List[Dict], sector_size: int):
+    root = ET.Element('data')
+    start = 6
+    for e in entries:
+        sectors = e['size'] // sector_size
+        ET.SubElement(root, 'program', {
+            'SECTOR_SIZE_IN_BYTES': str(sector_size),
+            'file_sector_offset': '0',
+            'filename': e['filename'],
+            'label': e['label'],
+            'num_partition_sectors': str(sectors),
+            'partofsingleimage': 'false',
+            'physical_partition_number': str(e.get('lun', 0)),
+            'readbackverify': 'false',
+            'size_in_KB': f"{e['size'] / 1024:.1f}",
+            'sparse': 'true' if e.get('sparse') else 'false',
+            'start_byte_hex': hex(start * sector_size),
+            'start_sector': str(start),
+        })
+        start += sectors
+    ET.ElementTree(root).write(path, encoding='utf-8', xml_declaration=True)
+
+def generate_rom(out_dir: Path, config: GeneratorConfig,
+                 progress_callback=None) -> Path:
+    """Generate a complete ROM tree under out_dir and return it"""
+    rng = random.Random(config.seed)
+    pool = rng.getrandbits(DATA_POOL_SIZE * 8).to_bytes(DATA_POOL_SIZE, 'little')
+    meta = out_dir / 'META'
+    images = out_dir / 'IMAGES'
+    meta.mkdir(parents=True, exist_ok=True)
+    images.mkdir(parents=True, exist_ok=True)
+
+    nv_ids = [str(10010000 + 111 * i) for i in range(config.regions)]
+    # Partition sizes must be whole blocks
+    part_size = config.partition_size - config.partition_size % config.block_size
+    region_size = config.region_partition_size - config.region_partition_size % config.block_size
+    jobs = [(f'{name}.img', part_size) for name in config.dynamic_partitions]
+    jobs += [(f'{name}.{nv}.img', region_size)
+             for nv in nv_ids for name in config.region_partitions]
+    total = len(jobs) + len(config.firmware_partitions)
+
+    # Dynamic images: the first sparse_ratio share is sparse, the rest raw
+    sparse_count = round(len(jobs) * config.sparse_ratio)
+    for i, (filename, size) in enumerate(jobs):
+        _write_image(images / filename, size, i < sparse_count, config, pool, rng)
+        if progress_callback:
+            progress_callback(i + 1, total)
+
+    for nv_index, nv in enumerate(nv_ids):
+        partitions = []
+        for slot in ('_a', '_b'):
+            group = f'qti_dynamic_partitions{slot}'
+            for name in config.dynamic_partitions:
+                has_data = slot == '_a'
+                partitions.append({
+                    'name': f'{name}{slot}',
+                    'path': f'IMAGES/{name}.img' if has_data else None,
+                    'size': str(part_size if has_data else 0),
+                    'group_name': group, 'is_dynamic': True})
+            for name in config.region_partitions:
+                has_data = slot == '_a'
+                partitions.append({
+                    'name': f'{name}{slot}',
+                    'path': f'IMAGES/{name}.{nv}.img' if has_data else None,
+                    'size': str(region_size if has_data else 0),
+                    'group_name': group, 'is_dynamic': True})
+        data = _super_def(config, nv, f'REGION{nv_index}', partitions)
+        with open(meta / f'super_def.{nv}.json', 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+
+    # Firmware images + rawprogram XMLs (one per LUN, plus the skipped variants)
+    entries = []
+    for i, name in enumerate(config.firmware_partitions):
+        filename = f'{name}.img'
+        _write_image(images / filename, config.firmware_size, False, config, pool, rng)
+        entries.append({'label': f'{name}_a', 'filename': filename,
+                        'size': config.firmware_size, 'lun': 4})
+        if progress_callback:
+            progress_callback(len(jobs) + i + 1, total)
+    entries.append({'label': 'super', 'filename': '', 'size': part_size, 'lun': 0})
+    _write_rawprogram(images / 'rawprogram0.xml',
+                      [e for e in entries if e['lun'] == 0], config.sector_size)
+    _write_rawprogram(images / 'rawprogram4.xml',
+                      [e for e in entries if e['lun'] == 4], config.sector_size)
+    _write_rawprogram(images / 'rawprogram0_BLANK_GPT.xml', [], config.sector_size)
+    _write_rawprogram(images / 'rawprogram0_WIPE_PARTITIONS.xml', [], config.sector_size)
+
+    return out_dir
+
+def write_rom_zip(rom_dir: Path, zip_path: Path, compression: int = zipfile.ZIP_DEFLATED,
+                  compresslevel: Optional[int] = 1) -> Path:
+    """Pack a ROM tree into a ZIP with the same relative layout"""
+    with zipfile.ZipFile(zip_path, 'w', compression, compresslevel=compresslevel) as zf:
+        for f in sorted(rom_dir.rglob('*')):
+            if f.is_file():
+                zf.write(f, f.relative_to(rom_dir).as_posix())
+    return zip_path
+
+def parse_size(text: str) -> int:
+    """Parse sizes like 512M, 20G, 4096"""
+    text = text.strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': MB, 'G': GB, 'T': 1024 * GB}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Generate a synthetic OPlus ROM tree')
+    parser.add_argument('out_dir', type=Path)
+    parser.add_argument('--partition-size', type=parse_size, default=64 * MB,
+                        help='size of each dynamic partition image (e.g. 512M, 8G)')
+    parser.add_argument('--partitions', type=int, help='number of dynamic partitions')
+    parser.add_argument('--regions', type=int, default=3)
+    parser.add_argument('--sparse-ratio', type=float, default=1.0)
+    parser.add_argument('--mix', default='60,20,20',
+                        help='RAW,FILL,DONT_CARE chunk weights (default 60,20,20)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--zip', action='store_true', help='also write OUT_DIR.zip')
+    parser.add_argument('--store', action='store_true', help='store ZIP members uncompressed')
+    args = parser.parse_args(argv)
+
+    config = GeneratorConfig(partition_size=args.partition_size, regions=args.regions,
+                             sparse_ratio=args.sparse_ratio, seed=args.seed,
+                             chunk_mix=tuple(float(x) for x in args.mix.split(',')))
+    if args.partitions:
+        names = [f'part{i}' for i in range(args.partitions)]
+        config.dynamic_partitions = names
+
+    generate_rom(args.out_dir, config,
+                 lambda cur, tot: print(f"[{cur}/{tot}] images written"))
+    print(f"ROM tree written to {args.out_dir}")
+    if args.zip:
+        zip_path = args.out_dir.with_suffix('.zip')
+        write_rom_zip(args.out_dir, zip_path,
+                      zipfile.ZIP_STORED if args.store else zipfile.ZIP_DEFLATED)
+        print(f"ZIP written to {zip_path}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
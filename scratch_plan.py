@@ -0,0 +1,143 @@
+"""
+OPlus ROM Converter - Scratch Space Planning
+Works out, before a build starts, how many bytes the decoded raw files and
+the output will take and where they fit: the preferred scratch volume while
+it has room, then the next candidates. A build that cannot fit anywhere
+fails up front instead of with ENOSPC mid-way.
+"""
+import os
+import shutil
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Dict, Optional
+
+from sparse_image import SparseReader, is_sparse_file, SEGMENT_HOLE
+
+MB = 1024 * 1024
+
+# Free space left untouched on every volume
+DEFAULT_RESERVE = 256 * MB
+
+# Only partitions up to this size go to RAM-backed volumes (tmpfs)
+MEMORY_FS_PARTITION_LIMIT = 512 * MB
+
+MEMORY_FS_TYPES = ('tmpfs', 'ramfs')
+
+@dataclass
+class ScratchNeed:
+    """Bytes one decoded partition will occupy"""
+    name: str
+    source: Path
+    raw_size: int
+    allocated: int  # Without holes (what the disk actually has to hold)
+
+@dataclass
+class ScratchPlan:
+    """Where each partition is decoded to, or why the build can't fit"""
+    ok: bool
+    placements: Dict[str, Path] = field(default_factory=dict)  # partition -> scratch dir
+    scratch_bytes: int = 0
+    output_bytes: int = 0
+    message: str = ''
+
+def _mount_type(path: Path) -> Optional[str]:
+    """Filesystem type of the mount holding path (Linux), None if unknown"""
+    try:
+        with open('/proc/mounts', 'r', encoding='utf-8') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path_str = str(path.resolve())
+    best, best_type = '', None
+    for mount_point, fs_type in mounts:
+        mount_point = mount_point.replace('\\040', ' ')
+        if (path_str == mount_point or path_str.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > len(best):
+            best, best_type = mount_point, fs_type
+    return best_type
+
+def _existing_parent(path: Path) -> Path:
+    path = path.absolute()
+    while not path.exists() and path.parent != path:
+        path = path.parent
+    return path
+
+def estimate_need(name: str, img_path: Path, holes: bool) -> Optional[ScratchNeed]:
+    """Decoded size of a sparse image from its chunk table, None for raw images (used in place)"""
+    if not is_sparse_file(img_path):
+        return None
+    with SparseReader(img_path) as reader:
+        hole_bytes = sum(n for kind, _off, n, _src in reader.segments(0, reader.size) if kind == SEGMENT_HOLE)
+        size = reader.size
+    return ScratchNeed(name, img_path, size, size - hole_bytes if holes else size)
+
+class _Volume:
+    def __init__(self, path: Path, reserve: int):
+        probe = _existing_parent(path)
+        self.path = path
+        self.device = os.stat(probe).st_dev
+        self.free = max(0, shutil.disk_usage(probe).free - reserve)
+        self.memory = _mount_type(probe) in MEMORY_FS_TYPES
+
+def plan_scratch(
+    needs: List[ScratchNeed],
+    output_dir: Path,
+    output_bytes: int,
+    scratch_dirs: Optional[List[Path]] = None,
+    reserve: int = DEFAULT_RESERVE
+) -> ScratchPlan:
+    """Place decoded partitions on scratch_dirs (in order of preference), then output_dir
+
+    Volumes on the same device share one free-space budget. Partitions are
+    placed largest-first on the most preferred volume that still has room,
+    so a fast scratch disk is filled before spilling to the next one.
+    """
+    scratch_bytes = sum(n.allocated for n in needs)
+    plan = ScratchPlan(ok=False, scratch_bytes=scratch_bytes, output_bytes=output_bytes)
+    candidates = [Path(d) for d in (scratch_dirs or [])] + [Path(output_dir)]
+
+    volumes: List[_Volume] = []
+    budgets: Dict[int, int] = {}
+    for path in candidates:
+        try:
+            volume = _Volume(path, reserve)
+        except OSError:
+            continue  # Missing drive / unreadable scratch dir: skip it
+        volumes.append(volume)
+        budgets.setdefault(volume.device, volume.free)
+
+    output_volume = next((v for v in volumes if v.path == Path(output_dir)), None)
+    if output_volume is None:
+        plan.message = f"Output folder {output_dir} is not accessible"
+        return plan
+    if budgets[output_volume.device] < output_bytes:
+        plan.message = (f"Not enough space for the output: need {output_bytes / MB:.0f} MB, "
+                        f"{budgets[output_volume.device] / MB:.0f} MB free on {output_dir}")
+        return plan
+    budgets[output_volume.device] -= output_bytes
+
+    def fits(volume: _Volume, need: ScratchNeed) -> bool:
+        if volume.memory and need.allocated > MEMORY_FS_PARTITION_LIMIT:
+            return False
+        return budgets[volume.device] >= need.allocated
+
+    # Biggest partitions first, each to the most preferred volume with room
+    for need in sorted(needs, key=lambda n: n.allocated, reverse=True):
+        volume = next((v for v in volumes if fits(v, need)), None)
+        if volume is None:
+            total_free = sum(budgets.values())
+            plan.message = (f"Not enough scratch space: need {scratch_bytes / MB:.0f} MB "
+                            f"(largest {need.name} {need.allocated / MB:.0f} MB), "
+                            f"{total_free / MB:.0f} MB free across {len(budgets)} volume(s)")
+            plan.placements = {}
+            return plan
+        budgets[volume.device] -= need.allocated
+        plan.placements[need.name] = volume.path
+    used = list(dict.fromkeys(str(v.path) for v in volumes if v.path in plan.placements.values()))
+    plan.ok = True
+    plan.message = f"Scratch on {', '.join(used)} ({scratch_bytes / MB:.0f} MB)"
+    return plan
+
+def scratch_dirs_from_env() -> List[Path]:
+    """QFF_SCRATCH_DIRS: scratch folders in order of preference (os.pathsep separated)"""
+    value = os.environ.get('QFF_SCRATCH_DIRS', '')
+    return [Path(p) for p in value.split(os.pathsep) if p]
@@ -0,0 +1,430 @@
+"""
+OPlus ROM Converter - Sparse Image Access
+Android sparse format constants, random-access reads of a sparse image
+without expanding it, and a raw -> sparse encoder (img2simg replacement).
+
+Usage:
+    python sparse_image.py system.raw system.img
+"""
+import io
+import os
+import sys
+import struct
+import bisect
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Iterator, Tuple, Callable
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from buffer_pool import get_default_pool
+
+# Sparse image magic
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+
+# Sparse image layout (see AOSP libsparse sparse_format.h)
+SPARSE_HEADER_FORMAT = '<IHHHHIIII'
+CHUNK_HEADER_FORMAT = '<HHII'
+SPARSE_HEADER_SIZE = struct.calcsize(SPARSE_HEADER_FORMAT)
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER_FORMAT)
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+# Segment kinds returned by SparseReader.segments()
+SEGMENT_DATA = 'data'
+SEGMENT_FILL = 'fill'
+SEGMENT_HOLE = 'hole'
+
+def is_sparse_file(path: Path) -> bool:
+    """True if the file starts with the sparse magic"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(4)
+    except OSError:
+        return False
+    return len(head) == 4 and struct.unpack('<I', head)[0] == SPARSE_HEADER_MAGIC
+
+@dataclass
+class _Chunk:
+    start: int          # offset in the expanded image
+    length: int
+    kind: str
+    source: int = 0     # file offset of the data (SEGMENT_DATA)
+    pattern: bytes = b''  # 4-byte fill value (SEGMENT_FILL)
+
+class SparseReader:
+    """Read ranges of a sparse image as if it were raw (chunk index built once)"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._f = open(self.path, 'rb')
+        try:
+            self._index()
+        except Exception:
+            self._f.close()
+            raise
+
+    def _index(self):
+        header = self._f.read(SPARSE_HEADER_SIZE)
+        if len(header) < SPARSE_HEADER_SIZE:
+            raise ValueError(f"{self.path.name}: truncated sparse header")
+        (magic, _major, _minor, file_hdr_sz, chunk_hdr_sz,
+         self.block_size, total_blocks, total_chunks, _checksum) = struct.unpack(SPARSE_HEADER_FORMAT, header)
+        if magic != SPARSE_HEADER_MAGIC:
+            raise ValueError(f"{self.path.name}: not a sparse image")
+        if file_hdr_sz < SPARSE_HEADER_SIZE or chunk_hdr_sz < CHUNK_HEADER_SIZE:
+            raise ValueError(f"{self.path.name}: bad sparse header sizes")
+        self.size = self.block_size * total_blocks
+        file_size = os.fstat(self._f.fileno()).st_size
+        self._chunks: List[_Chunk] = []
+        pos = file_hdr_sz
+        out = 0
+        for index in range(total_chunks):
+            self._f.seek(pos)
+            chunk_header = self._f.read(CHUNK_HEADER_SIZE)
+            if len(chunk_header) < CHUNK_HEADER_SIZE:
+                raise ValueError(f"{self.path.name}: truncated at chunk {index} of {total_chunks}")
+            chunk_type, _reserved, chunk_blocks, total_sz = struct.unpack(CHUNK_HEADER_FORMAT, chunk_header)
+            if total_sz < chunk_hdr_sz:
+                raise ValueError(f"{self.path.name}: bad size in chunk {index}")
+            length = chunk_blocks * self.block_size
+            data_pos = pos + chunk_hdr_sz
+            if chunk_type == CHUNK_TYPE_RAW:
+                if total_sz - chunk_hdr_sz != length or data_pos + length > file_size:
+                    raise ValueError(f"{self.path.name}: raw chunk {index} runs past the end of the file")
+                self._chunks.append(_Chunk(out, length, SEGMENT_DATA, source=data_pos))
+            elif chunk_type == CHUNK_TYPE_FILL:
+                self._f.seek(data_pos)
+                pattern = self._f.read(4)
+                if len(pattern) < 4:
+                    raise ValueError(f"{self.path.name}: truncated fill chunk {index}")
+                kind = SEGMENT_HOLE if pattern == b'\x00' * 4 else SEGMENT_FILL
+                self._chunks.append(_Chunk(out, length, kind, pattern=pattern))
+            elif chunk_type == CHUNK_TYPE_DONT_CARE:
+                self._chunks.append(_Chunk(out, length, SEGMENT_HOLE))
+            elif chunk_type != CHUNK_TYPE_CRC32:
+                raise ValueError(f"{self.path.name}: unknown chunk type 0x{chunk_type:04X}")
+            out += length
+            pos += total_sz
+        if out != self.size:
+            raise ValueError(f"{self.path.name}: chunks cover {out} of {self.size} bytes")
+        self._starts = [c.start for c in self._chunks]
+
+    def segments(self, offset: int, length: int) -> Iterator[Tuple[str, int, int, object]]:
+        """Yield (kind, offset, length, source) pieces covering [offset, offset+length)
+
+        source is the file offset for data, the 4-byte pattern for fill, None for holes.
+        """
+        end = min(offset + length, self.size)
+        i = max(0, bisect.bisect_right(self._starts, offset) - 1)
+        while offset < end and i < len(self._chunks):
+            chunk = self._chunks[i]
+            n = min(end, chunk.start + chunk.length) - offset
+            if n > 0:
+                if chunk.kind == SEGMENT_DATA:
+                    yield SEGMENT_DATA, offset, n, chunk.source + (offset - chunk.start)
+                elif chunk.kind == SEGMENT_FILL:
+                    # Keep the pattern phase when starting mid-chunk
+                    shift = (offset - chunk.start) % 4
+                    yield SEGMENT_FILL, offset, n, chunk.pattern[shift:] + chunk.pattern[:shift]
+                else:
+                    yield SEGMENT_HOLE, offset, n, None
+                offset += n
+            i += 1
+
+    def fileno(self) -> int:
+        return self._f.fileno()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SparseFile(io.RawIOBase):
+    """Sequential read-only file over the expanded content of a sparse image"""
+
+    def __init__(self, path: Path):
+        super().__init__()
+        self._reader = SparseReader(path)
+        self.size = self._reader.size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast('B')
+        done = 0
+        for kind, _offset, n, source in self._reader.segments(self._pos, len(view)):
+            dst = view[done:done + n]
+            if kind == SEGMENT_DATA:
+                self._reader._f.seek(source)
+                if self._reader._f.readinto(dst) != n:
+                    raise ValueError(f"{self._reader.path.name}: truncated chunk data")
+            elif kind == SEGMENT_FILL:
+                dst[:] = (source * (n // 4 + 1))[:n]
+            else:
+                dst[:] = bytes(n)
+            done += n
+        self._pos += done
+        return done
+
+    def close(self):
+        self._reader.close()
+        super().close()
+
+class SparseWriter:
+    """Sequential sparse image writer
+
+    Adjacent runs of the same kind are merged into one chunk (raw chunk
+    headers are patched in place), and the header is written on close.
+    """
+
+    def __init__(self, f, block_size: int = 4096):
+        self.f = f
+        self.block_size = block_size
+        self.total_blocks = 0
+        self.total_chunks = 0
+        # Open run: (CHUNK_TYPE_*, blocks, fill pattern or raw chunk header offset)
+        self._run: Optional[list] = None
+        self._start = f.tell()
+        f.write(bytes(SPARSE_HEADER_SIZE))
+
+    def _flush(self):
+        if self._run is None:
+            return
+        chunk_type, blocks, extra = self._run
+        if chunk_type == CHUNK_TYPE_RAW:
+            end = self.f.tell()
+            self.f.seek(extra)
+            self.f.write(self._chunk_header(CHUNK_TYPE_RAW, blocks, blocks * self.block_size))
+            self.f.seek(end)
+        elif chunk_type == CHUNK_TYPE_FILL:
+            self.f.write(self._chunk_header(CHUNK_TYPE_FILL, blocks, 4))
+            self.f.write(extra)
+        else:
+            self.f.write(self._chunk_header(CHUNK_TYPE_DONT_CARE, blocks, 0))
+        self.total_blocks += blocks
+        self.total_chunks += 1
+        self._run = None
+
+    @staticmethod
+    def _chunk_header(chunk_type: int, blocks: int, payload_size: int) -> bytes:
+        return struct.pack(CHUNK_HEADER_FORMAT, chunk_type, 0, blocks, CHUNK_HEADER_SIZE + payload_size)
+
+    def _extend(self, chunk_type: int, blocks: int, extra=None) -> bool:
+        run = self._run
+        if run is not None and run[0] == chunk_type and (chunk_type != CHUNK_TYPE_FILL or run[2] == extra):
+            run[1] += blocks
+            return True
+        self._flush()
+        return False
+
+    def write_raw(self, data):
+        """Append whole blocks of data"""
+        if not len(data):
+            return
+        if len(data) % self.block_size:
+            raise ValueError("Raw chunk must be a whole number of blocks")
+        blocks = len(data) // self.block_size
+        if not self._extend(CHUNK_TYPE_RAW, blocks):
+            # Placeholder header, patched with the final length when the run ends
+            self._run = [CHUNK_TYPE_RAW, blocks, self.f.tell()]
+            self.f.write(bytes(CHUNK_HEADER_SIZE))
+        self.f.write(data)
+
+    def write_fill(self, pattern: bytes, blocks: int):
+        """Append blocks filled with a 4-byte pattern"""
+        if blocks and not self._extend(CHUNK_TYPE_FILL, blocks, pattern):
+            self._run = [CHUNK_TYPE_FILL, blocks, bytes(pattern)]
+
+    def skip(self, blocks: int):
+        """Append don't-care blocks"""
+        if blocks and not self._extend(CHUNK_TYPE_DONT_CARE, blocks):
+            self._run = [CHUNK_TYPE_DONT_CARE, blocks, None]
+
+    def close(self):
+        self._flush()
+        end = self.f.tell()
+        self.f.seek(self._start)
+        self.f.write(struct.pack(SPARSE_HEADER_FORMAT, SPARSE_HEADER_MAGIC, 1, 0,
+                                 SPARSE_HEADER_SIZE, CHUNK_HEADER_SIZE, self.block_size,
+                                 self.total_blocks, self.total_chunks, 0))
+        self.f.seek(end)
+
+# --- Block classification (zero / constant fill / data) ---
+
+def _classify_numpy(data, block_size: int) -> Iterator[Tuple[str, int, int, bytes]]:
+    words = np.frombuffer(data, dtype='<u4', count=len(data) // block_size * block_size // 4)
+    words = words.reshape(-1, block_size // 4)
+    first = words[:, 0]
+    constant = (words == first[:, None]).all(axis=1)
+    # Run key per block: 0 hole, 1 fill (split on pattern), 2 data
+    kind = np.where(constant, np.where(first == 0, 0, 1), 2)
+    pattern = np.where(kind == 1, first, 0)
+    change = np.flatnonzero((kind[1:] != kind[:-1]) | (pattern[1:] != pattern[:-1])) + 1
+    starts = np.concatenate(([0], change)).tolist()
+    ends = starts[1:] + [len(kind)]
+    names = (SEGMENT_HOLE, SEGMENT_FILL, SEGMENT_DATA)
+    for start, end in zip(starts, ends):
+        k = int(kind[start])
+        fill = int(first[start]).to_bytes(4, 'little') if k == 1 else b''
+        yield names[k], start, end - start, fill
+
+def _classify_python(data, block_size: int) -> Iterator[Tuple[str, int, int, bytes]]:
+    view = memoryview(data)
+    repeat = block_size // 4
+    blocks = len(view) // block_size
+    run_kind, run_start, run_pattern = None, 0, b''
+    for i in range(blocks):
+        offset = i * block_size
+        head = view[offset:offset + 4].tobytes()
+        # Cheap reject first: data blocks almost never repeat their first word.
+        # (Comparing bytes is much faster than comparing memoryviews.)
+        if head == view[offset + 4:offset + 8].tobytes() and \
+                view[offset:offset + block_size].tobytes() == head * repeat:
+            kind = SEGMENT_FILL if any(head) else SEGMENT_HOLE
+        else:
+            kind = SEGMENT_DATA
+        if kind != SEGMENT_FILL:
+            head = b''
+        if kind != run_kind or head != run_pattern:
+            if run_kind is not None:
+                yield run_kind, run_start, i - run_start, run_pattern
+            run_kind, run_start, run_pattern = kind, i, head
+    if run_kind is not None:
+        yield run_kind, run_start, blocks - run_start, run_pattern
+
+def classify_blocks(data, block_size: int) -> Iterator[Tuple[str, int, int, bytes]]:
+    """Split whole blocks of data into runs of (kind, first block, count, fill pattern)
+
+    Vectorized with NumPy when it is installed, pure Python otherwise.
+    """
+    if np is not None and block_size % 4 == 0:
+        return _classify_numpy(data, block_size)
+    return _classify_python(data, block_size)
+
+# --- Raw -> sparse encoder ---
+
+@dataclass
+class EncodeStats:
+    """Block counts of an encoded image"""
+    raw_size: int = 0
+    sparse_size: int = 0
+    data_blocks: int = 0
+    fill_blocks: int = 0
+    hole_blocks: int = 0
+    chunks: int = 0
+
+def _data_ranges(f, size: int) -> Optional[List[Tuple[int, int]]]:
+    """Allocated (start, end) ranges via SEEK_DATA/SEEK_HOLE, None if unsupported"""
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    ranges = []
+    pos = 0
+    try:
+        while pos < size:
+            try:
+                start = os.lseek(f.fileno(), pos, os.SEEK_DATA)
+            except OSError:
+                break  # ENXIO: only a hole remains
+            end = min(os.lseek(f.fileno(), start, os.SEEK_HOLE), size)
+            ranges.append((start, end))
+            pos = end
+    except OSError:
+        return None
+    return ranges
+
+def encode_raw_to_sparse(
+    raw_path: Path,
+    sparse_path: Path,
+    block_size: int = 4096,
+    read_size: int = 0,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+) -> EncodeStats:
+    """Write raw_path as a sparse image (img2simg equivalent)
+
+    Filesystem holes are skipped without reading; everything else is read
+    in large buffers and classified per block. A trailing partial block is
+    zero-padded, as img2simg does.
+    """
+    pool = get_default_pool()
+    raw_size = Path(raw_path).stat().st_size
+    stats = EncodeStats(raw_size=raw_size)
+    with pool.buffer() as buf, open(raw_path, 'rb') as src, open(sparse_path, 'wb') as dst:
+        usable = read_size or len(buf)
+        usable = min(usable, len(buf)) // block_size * block_size
+        if usable == 0:
+            raise ValueError(f"Buffer smaller than block size {block_size}")
+        writer = SparseWriter(dst, block_size)
+        ranges = _data_ranges(src, raw_size)
+        if ranges is None:
+            ranges = [(0, raw_size)]
+        pos = 0
+        for start, end in ranges:
+            # Ranges are byte-exact; widen them to whole blocks
+            start = start // block_size * block_size
+            end = min(-(-end // block_size) * block_size, -(-raw_size // block_size) * block_size)
+            if start < pos:
+                start = pos
+            if start > pos:
+                writer.skip((start - pos) // block_size)
+                stats.hole_blocks += (start - pos) // block_size
+            src.seek(start)
+            pos = start
+            while pos < end:
+                step = min(usable, end - pos)
+                view = buf[:step]
+                n = src.readinto(view)
+                if n < step:
+                    view[n:step] = bytes(step - n)  # zero-pad the last partial block
+                for kind, first, count, pattern in classify_blocks(view, block_size):
+                    if kind == SEGMENT_HOLE:
+                        writer.skip(count)
+                        stats.hole_blocks += count
+                    elif kind == SEGMENT_FILL:
+                        writer.write_fill(pattern, count)
+                        stats.fill_blocks += count
+                    else:
+                        writer.write_raw(view[first * block_size:(first + count) * block_size])
+                        stats.data_blocks += count
+                pos += step
+                if progress_callback:
+                    progress_callback(min(pos, raw_size), raw_size)
+        total = -(-raw_size // block_size) * block_size
+        if pos < total:
+            writer.skip((total - pos) // block_size)
+            stats.hole_blocks += (total - pos) // block_size
+        writer.close()
+        stats.chunks = writer.total_chunks
+        stats.sparse_size = dst.tell()
+    return stats
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Convert a raw image to Android sparse format')
+    parser.add_argument('raw_image', type=Path)
+    parser.add_argument('sparse_image', type=Path)
+    parser.add_argument('-b', '--block-size', type=int, default=4096)
+    args = parser.parse_args(argv)
+    try:
+        stats = encode_raw_to_sparse(args.raw_image, args.sparse_image, args.block_size)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        return 1
+    print(f"{args.sparse_image.name}: {stats.chunks} chunks, {stats.data_blocks} data / "
+          f"{stats.fill_blocks} fill / {stats.hole_blocks} empty blocks, "
+          f"{stats.sparse_size / (1024**2):.1f} MB")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import sys
+import hashlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from build_cache import BuildCache, METHOD_HARDLINK
+from converter import create_super_image, find_all_super_defs
+from rom_generator import GeneratorConfig, generate_rom
+
+KB = 1024
+MB = 1024 * KB
+
+def _sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+def _build(region, rom: Path, output: Path, cache=None) -> bool:
+    return create_super_image(region.config, rom, output, build_cache=cache,
+                              decoder='native', assembler='native')
+
+def test_rebuild_after_fetch_leaves_the_entry_alone(tmp_path):
+    config = GeneratorConfig(partition_size=MB, dynamic_partitions=['system', 'vendor'],
+                             region_partition_size=256 * KB, firmware_partitions=['boot'],
+                             firmware_size=64 * KB, regions=1, sparse_ratio=0.0, chunk_blocks=(8, 32))
+    rom = generate_rom(tmp_path / 'rom', config)
+    region = find_all_super_defs(rom)[0]
+    cache = BuildCache(tmp_path / 'cache')
+
+    assert _build(region, rom, tmp_path / 'first' / 'super.img', cache)
+    [entry] = cache.entries()
+    cached_image = tmp_path / 'cache' / 'entries' / f'{entry.key}.img'
+    before = _sha256(cached_image)
+
+    output = tmp_path / 'second' / 'super.img'
+    method = cache.fetch(entry.key, output)
+    assert method is not None
+    if method == METHOD_HARDLINK:
+        assert output.stat().st_ino == cached_image.stat().st_ino
+
+    # A changed source forces a different image into the fetched output
+    system = rom / 'IMAGES' / 'system.img'
+    data = bytearray(system.read_bytes())
+    data[:4 * KB] = b'\xee' * (4 * KB)
+    system.write_bytes(bytes(data))
+    assert _build(region, rom, output)
+
+    assert _sha256(output) != before
+    assert _sha256(cached_image) == before
+    assert cache.get(entry.key) is not None
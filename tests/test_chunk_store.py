@@ -0,0 +1,53 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from chunk_store import ChunkStore, CHUNKING_FIXED, CHUNKING_CDC
+from sparse_image import SparseWriter
+
+KB = 1024
+BLOCK = 4096
+
+def _store(root: Path, chunking: str) -> ChunkStore:
+    return ChunkStore(root, chunking, chunk_size=16 * KB, min_chunk=8 * KB, max_chunk=64 * KB)
+
+@pytest.mark.parametrize('chunking', [CHUNKING_FIXED, CHUNKING_CDC])
+def test_put_restore_round_trip(tmp_path, chunking):
+    store = _store(tmp_path / 'store', chunking)
+    content = os.urandom(100 * KB) + bytes(48 * KB) + os.urandom(7 * KB + 5)
+    (tmp_path / 'system.raw').write_bytes(content)
+
+    manifest, stats = store.put(tmp_path / 'system.raw', 'rom1/system', source={'size': len(content)})
+    assert manifest.size == stats.logical_bytes == len(content)
+    assert stats.new_chunks > 0
+    assert store.restore('rom1/system', tmp_path / 'restored.raw')
+    assert (tmp_path / 'restored.raw').read_bytes() == content
+
+    # The same content under another name adds nothing
+    _manifest, again = store.put(tmp_path / 'system.raw', 'rom2/system')
+    assert again.new_chunks == 0 and again.new_bytes == 0
+    assert store.lookup('rom1/system', {'size': len(content)}) is not None
+    assert store.lookup('rom1/system', {'size': 0}) is None
+
+def test_sparse_image_is_stored_expanded(tmp_path):
+    store = _store(tmp_path / 'store', CHUNKING_FIXED)
+    data = os.urandom(6 * BLOCK)
+    with open(tmp_path / 'vendor.img', 'wb') as f:
+        writer = SparseWriter(f, BLOCK)
+        writer.write_raw(data)
+        writer.write_fill(b'\xff\x00\xff\x00', 3)
+        writer.skip(9)
+        writer.close()
+    expected = data + b'\xff\x00\xff\x00' * (3 * BLOCK // 4) + bytes(9 * BLOCK)
+
+    manifest, _stats = store.put(tmp_path / 'vendor.img', 'vendor')
+    assert manifest.size == len(expected)
+    assert store.restore('vendor', tmp_path / 'vendor.raw')
+    assert (tmp_path / 'vendor.raw').read_bytes() == expected
+
+def test_restore_of_unknown_name_fails(tmp_path):
+    assert not _store(tmp_path / 'store', CHUNKING_FIXED).restore('missing', tmp_path / 'out.raw')
@@ -0,0 +1,56 @@
+import os
+import sys
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from converter import extract_rom_zip
+from extract_index import ExtractIndex, DEDUP_MIN_SIZE
+
+MEMBER = 'IMAGES/system.img'
+
+def _rom_zip(path: Path, image: bytes, compression: int, note: str) -> Path:
+    with zipfile.ZipFile(path, 'w', compression) as zf:
+        zf.writestr(MEMBER, image)
+        zf.writestr('META/note.txt', note)
+    return path
+
+def _extract(zip_path: Path, out_dir: Path, index: ExtractIndex) -> list:
+    log = []
+    assert extract_rom_zip(zip_path, out_dir, log.append, index=index)
+    return log
+
+def test_known_member_is_linked_not_extracted(tmp_path):
+    image = os.urandom(DEDUP_MIN_SIZE) + bytes(DEDUP_MIN_SIZE)
+    index = ExtractIndex(tmp_path / 'index.sqlite')
+    first = _rom_zip(tmp_path / 'a.zip', image, zipfile.ZIP_DEFLATED, 'a')
+    # Stored instead of deflated: confirmed by content hash, not compressed bytes
+    second = _rom_zip(tmp_path / 'b.zip', image, zipfile.ZIP_STORED, 'b')
+
+    assert not any('Linked' in line for line in _extract(first, tmp_path / 'a', index))
+    assert any('Linked 1 known members' in line for line in _extract(second, tmp_path / 'b', index))
+    assert (tmp_path / 'b' / MEMBER).read_bytes() == image
+    assert (tmp_path / 'b' / 'META' / 'note.txt').read_text() == 'b'
+
+def test_rewriting_a_linked_member_leaves_the_other_copy(tmp_path):
+    image = os.urandom(DEDUP_MIN_SIZE)
+    index = ExtractIndex(tmp_path / 'index.sqlite')
+    _extract(_rom_zip(tmp_path / 'a.zip', image, zipfile.ZIP_DEFLATED, 'a'), tmp_path / 'a', index)
+    _extract(_rom_zip(tmp_path / 'b.zip', image, zipfile.ZIP_DEFLATED, 'b'), tmp_path / 'b', index)
+
+    changed = os.urandom(DEDUP_MIN_SIZE)
+    _extract(_rom_zip(tmp_path / 'c.zip', changed, zipfile.ZIP_DEFLATED, 'c'), tmp_path / 'b', index)
+    assert (tmp_path / 'b' / MEMBER).read_bytes() == changed
+    assert (tmp_path / 'a' / MEMBER).read_bytes() == image
+
+def test_changed_source_file_is_not_linked(tmp_path):
+    image = os.urandom(DEDUP_MIN_SIZE)
+    index = ExtractIndex(tmp_path / 'index.sqlite')
+    _extract(_rom_zip(tmp_path / 'a.zip', image, zipfile.ZIP_DEFLATED, 'a'), tmp_path / 'a', index)
+    # Same size, different content after it was indexed
+    (tmp_path / 'a' / MEMBER).write_bytes(os.urandom(DEDUP_MIN_SIZE))
+
+    log = _extract(_rom_zip(tmp_path / 'b.zip', image, zipfile.ZIP_DEFLATED, 'b'), tmp_path / 'b', index)
+    assert not any('Linked' in line for line in log)
+    assert (tmp_path / 'b' / MEMBER).read_bytes() == image
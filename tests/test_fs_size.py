@@ -0,0 +1,38 @@
+import struct
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fs_size import (
+    trimmed_size, has_avb_footer, SUPERBLOCK_OFFSET, EXT4_MAGIC, EXT4_MAGIC_OFFSET,
+    EXT4_BLOCKS_COUNT_LO_OFFSET, EXT4_LOG_BLOCK_SIZE_OFFSET, AVB_FOOTER_MAGIC, AVB_FOOTER_SIZE
+)
+
+MB = 1024 * 1024
+FS_BLOCKS = 256          # 1 MB of 4 KB blocks
+IMAGE_SIZE = 4 * MB
+
+def _ext4_image(path: Path, avb_footer: bool) -> Path:
+    image = bytearray(IMAGE_SIZE)
+    sb = SUPERBLOCK_OFFSET
+    struct.pack_into('<H', image, sb + EXT4_MAGIC_OFFSET, EXT4_MAGIC)
+    struct.pack_into('<I', image, sb + EXT4_BLOCKS_COUNT_LO_OFFSET, FS_BLOCKS)
+    struct.pack_into('<I', image, sb + EXT4_LOG_BLOCK_SIZE_OFFSET, 2)
+    if avb_footer:
+        # Hashtree and vbmeta after the filesystem, footer in the last 64 bytes
+        image[MB:MB + 4096] = b'\xa5' * 4096
+        struct.pack_into('>4s2L3Q', image, IMAGE_SIZE - AVB_FOOTER_SIZE,
+                         AVB_FOOTER_MAGIC, 1, 0, MB, MB + 4096, 2048)
+    path.write_bytes(bytes(image))
+    return path
+
+def test_plain_ext4_is_trimmed(tmp_path):
+    img = _ext4_image(tmp_path / 'system.img', avb_footer=False)
+    assert not has_avb_footer(img)
+    assert trimmed_size(img, 4096) == FS_BLOCKS * 4096
+
+def test_avb_footer_image_is_not_trimmed(tmp_path):
+    img = _ext4_image(tmp_path / 'system.img', avb_footer=True)
+    assert has_avb_footer(img)
+    assert trimmed_size(img, 4096) is None
@@ -0,0 +1,76 @@
+import json
+import sys
+import threading
+import http.client
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from job_server import create_server, STATUS_DONE, FINAL_STATUSES
+from rom_generator import GeneratorConfig, generate_rom
+
+MB = 1024 * 1024
+
+@pytest.fixture
+def server():
+    server = create_server('127.0.0.1', 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    server.manager.close()
+
+def _request(server, method: str, path: str, body=None):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=60)
+    conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                 headers={'Content-Type': 'application/json'})
+    return conn, conn.getresponse()
+
+def _read_events(response):
+    events, event = [], {}
+    for raw in response:
+        line = raw.decode('utf-8').rstrip('\n')
+        if not line:
+            if event:
+                events.append(event)
+            event = {}
+        elif line.startswith('event: '):
+            event['event'] = line[7:]
+        elif line.startswith('data: '):
+            event['data'] = json.loads(line[6:])
+    return events
+
+def test_build_stream_ends_with_final_status(server, tmp_path):
+    config = GeneratorConfig(partition_size=2 * MB, dynamic_partitions=['system', 'vendor'],
+                             region_partition_size=MB, firmware_partitions=['boot'],
+                             firmware_size=64 * 1024, regions=1, chunk_blocks=(8, 64))
+    rom = generate_rom(tmp_path / 'rom', config)
+    region = json.loads(next((rom / 'META').glob('super_def.*.json')).read_text())['nv_id']
+    output = tmp_path / 'super.img'
+
+    conn, response = _request(server, 'POST', '/api/jobs', {
+        'type': 'build', 'rom': str(rom), 'region': region, 'output': str(output),
+        'decoder': 'native', 'assembler': 'native', 'use_cache': False})
+    assert response.status == 202
+    job_id = json.loads(response.read())['id']
+    conn.close()
+
+    conn, response = _request(server, 'GET', f'/api/jobs/{job_id}/events')
+    assert response.status == 200
+    events = _read_events(response)
+    conn.close()
+
+    final = events[-1]
+    assert final['event'] == 'status'
+    assert final['data']['status'] in FINAL_STATUSES
+    assert final['data']['status'] == STATUS_DONE, final['data']
+    assert final['data']['result'] == {'output': str(output)}
+    assert output.is_file()
+
+def test_unknown_job_type_is_rejected(server):
+    conn, response = _request(server, 'POST', '/api/jobs', {'type': 'format', 'rom': '.'})
+    assert response.status == 400
+    conn.close()
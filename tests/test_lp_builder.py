@@ -0,0 +1,57 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from io_schedule import SCHEDULE_PARALLEL, SCHEDULE_SEQUENTIAL
+from lp_builder import plan_super_layout, write_super_image
+from lp_metadata import LpMetadataError
+from lp_unpack import unpack_super, read_super_metadata
+from sparse_image import SparseWriter
+
+BLOCK = 4096
+MB = 1024 * 1024
+GROUP = 'qti_dynamic_partitions_a'
+
+def _images(tmp_path: Path):
+    """A raw and a sparse source image; returns {name: (path, expanded content)}"""
+    system = os.urandom(40 * BLOCK) + bytes(8 * BLOCK) + os.urandom(3 * BLOCK)
+    (tmp_path / 'system.img').write_bytes(system)
+
+    data = os.urandom(16 * BLOCK)
+    with open(tmp_path / 'vendor.img', 'wb') as f:
+        writer = SparseWriter(f, BLOCK)
+        writer.write_raw(data)
+        writer.write_fill(b'\x12\x34\x56\x78', 5)
+        writer.skip(7)
+        writer.write_raw(data[:BLOCK])
+        writer.close()
+    vendor = data + b'\x12\x34\x56\x78' * (5 * BLOCK // 4) + bytes(7 * BLOCK) + data[:BLOCK]
+    return {'system_a': (tmp_path / 'system.img', system), 'vendor_a': (tmp_path / 'vendor.img', vendor)}
+
+@pytest.mark.parametrize('schedule', [SCHEDULE_PARALLEL, SCHEDULE_SEQUENTIAL])
+def test_written_partitions_unpack_identically(tmp_path, schedule):
+    images = _images(tmp_path)
+    partitions = [(name, GROUP, len(content)) for name, (_path, content) in images.items()]
+    partitions.append(('system_b', 'qti_dynamic_partitions_b', 0))
+    metadata = plan_super_layout(8 * MB, MB, BLOCK, [(GROUP, 4 * MB), ('qti_dynamic_partitions_b', 4 * MB)],
+                                 partitions)
+    super_path = tmp_path / 'super.img'
+    write_super_image(metadata, {name: path for name, (path, _content) in images.items()}, super_path,
+                      workers=2, schedule=schedule)
+
+    read_back = read_super_metadata(super_path)
+    assert [p.name for p in read_back.partitions] == ['system_a', 'vendor_a', 'system_b']
+    assert [g.name for g in read_back.groups] == [g.name for g in metadata.groups]
+
+    outputs = unpack_super(super_path, tmp_path / 'out')
+    assert sorted(p.name for p in outputs) == ['system_a.img', 'vendor_a.img']
+    for name, (_path, content) in images.items():
+        assert (tmp_path / 'out' / f'{name}.img').read_bytes() == content
+
+def test_partition_larger_than_device_is_rejected():
+    with pytest.raises(LpMetadataError):
+        plan_super_layout(4 * MB, MB, BLOCK, [(GROUP, 0)], [('system_a', GROUP, 4 * MB)])
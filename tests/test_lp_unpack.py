@@ -0,0 +1,55 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lp_builder import plan_super_layout, write_super_image
+from lp_unpack import unpack_super
+from sparse_image import SparseFile, SparseReader, SparseWriter, encode_raw_to_sparse
+
+BLOCK = 4096
+MB = 1024 * 1024
+GROUP = 'qti_dynamic_partitions_a'
+
+@pytest.fixture
+def super_image(tmp_path):
+    """Raw super.img with two partitions; returns (path, {name: content})"""
+    contents = {'system_a': os.urandom(24 * BLOCK) + bytes(16 * BLOCK) + b'\xab' * (4 * BLOCK),
+                'odm_a': os.urandom(5 * BLOCK)}
+    sources = {}
+    for name, content in contents.items():
+        sources[name] = tmp_path / f'{name}.src'
+        sources[name].write_bytes(content)
+    metadata = plan_super_layout(8 * MB, MB, BLOCK, [(GROUP, 0)],
+                                 [(name, GROUP, len(content)) for name, content in contents.items()])
+    write_super_image(metadata, sources, tmp_path / 'super.img')
+    return tmp_path / 'super.img', contents
+
+def test_sparse_output_expands_to_the_partitions(super_image, tmp_path):
+    super_path, contents = super_image
+    unpack_super(super_path, tmp_path / 'out', sparse_output=True)
+    for name, content in contents.items():
+        with SparseFile(tmp_path / 'out' / f'{name}.img') as f:
+            assert f.size == len(content)
+            assert f.read() == content
+
+def test_sparse_super_unpacks_like_raw(super_image, tmp_path):
+    super_path, contents = super_image
+    encode_raw_to_sparse(super_path, tmp_path / 'super.sparse.img')
+    unpack_super(tmp_path / 'super.sparse.img', tmp_path / 'out', partitions=['odm_a'])
+    assert (tmp_path / 'out' / 'odm_a.img').read_bytes() == contents['odm_a']
+
+def test_truncated_sparse_image_raises_value_error(tmp_path):
+    path = tmp_path / 'system.img'
+    with open(path, 'wb') as f:
+        writer = SparseWriter(f, BLOCK)
+        writer.write_raw(os.urandom(8 * BLOCK))
+        writer.close()
+    data = path.read_bytes()
+    for cut in (10, len(data) - BLOCK):
+        path.write_bytes(data[:cut])
+        with pytest.raises(ValueError):
+            SparseReader(path)
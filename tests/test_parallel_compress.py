@@ -0,0 +1,51 @@
+import os
+import sys
+import gzip
+import lzma
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from parallel_compress import compress_file, decompress_file, FORMAT_GZIP, FORMAT_XZ
+
+KB = 1024
+BLOCK = 64 * KB
+
+DECOMPRESS = {FORMAT_GZIP: gzip.decompress, FORMAT_XZ: lzma.decompress}
+
+def _source(path: Path) -> bytes:
+    """Random and zero blocks with a short last block"""
+    content = os.urandom(3 * BLOCK) + bytes(4 * BLOCK) + b'\x5a' * BLOCK + os.urandom(BLOCK // 3)
+    path.write_bytes(content)
+    return content
+
+@pytest.mark.parametrize('fmt', [FORMAT_GZIP, FORMAT_XZ])
+def test_output_opens_with_the_standard_library(tmp_path, fmt):
+    content = _source(tmp_path / 'super.img')
+    stats = compress_file(tmp_path / 'super.img', tmp_path / 'super.img.z', fmt, level=1,
+                          block_size=BLOCK, workers=3)
+    assert stats.blocks == 9
+    assert stats.zero_blocks == 4
+    assert DECOMPRESS[fmt]((tmp_path / 'super.img.z').read_bytes()) == content
+
+@pytest.mark.parametrize('fmt', [FORMAT_GZIP, FORMAT_XZ])
+def test_block_parallel_round_trip(tmp_path, fmt):
+    content = _source(tmp_path / 'super.img')
+    compress_file(tmp_path / 'super.img', tmp_path / 'super.img.z', fmt, level=1, block_size=BLOCK, workers=3)
+    decompress_file(tmp_path / 'super.img.z', tmp_path / 'restored.img', workers=3)
+    assert (tmp_path / 'restored.img').read_bytes() == content
+
+def test_known_zero_ranges_are_not_read(tmp_path):
+    # A range the caller declares zero is archived as zeros whatever the file holds
+    content = _source(tmp_path / 'super.img')
+    compress_file(tmp_path / 'super.img', tmp_path / 'super.img.gz', FORMAT_GZIP, level=1,
+                  block_size=BLOCK, workers=2, zero_ranges=[(0, BLOCK)])
+    assert gzip.decompress((tmp_path / 'super.img.gz').read_bytes()) == bytes(BLOCK) + content[BLOCK:]
+
+def test_foreign_gzip_is_decompressed(tmp_path):
+    content = os.urandom(100 * KB)
+    (tmp_path / 'other.gz').write_bytes(gzip.compress(content))
+    decompress_file(tmp_path / 'other.gz', tmp_path / 'other.img')
+    assert (tmp_path / 'other.img').read_bytes() == content
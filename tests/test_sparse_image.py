@@ -0,0 +1,46 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sparse_image
+from sparse_image import SparseFile, SparseReader, encode_raw_to_sparse, SEGMENT_DATA, SEGMENT_FILL, SEGMENT_HOLE
+
+BLOCK = 4096
+
+def _raw_image(path: Path) -> bytes:
+    """Data, fill and zero runs, a filesystem hole and a partial last block"""
+    content = (os.urandom(10 * BLOCK) + b'\x01\x02\x03\x04' * (3 * BLOCK // 4) + bytes(5 * BLOCK)
+               + os.urandom(2 * BLOCK))
+    with open(path, 'wb') as f:
+        f.write(content)
+        f.seek(6 * BLOCK, os.SEEK_CUR)  # Left as a hole where the filesystem supports it
+        tail = os.urandom(BLOCK // 2 + 123)
+        f.write(tail)
+    return content + bytes(6 * BLOCK) + tail
+
+@pytest.mark.parametrize('numpy', [True, False])
+def test_encode_round_trip(tmp_path, monkeypatch, numpy):
+    if numpy and sparse_image.np is None:
+        pytest.skip('numpy not installed')
+    if not numpy:
+        monkeypatch.setattr(sparse_image, 'np', None)
+    raw = _raw_image(tmp_path / 'system.raw')
+    assert len(raw) % BLOCK
+
+    stats = encode_raw_to_sparse(tmp_path / 'system.raw', tmp_path / 'system.img', BLOCK, read_size=4 * BLOCK)
+    padded = raw + bytes(-len(raw) % BLOCK)
+    assert stats.raw_size == len(raw)
+    assert (stats.data_blocks + stats.fill_blocks + stats.hole_blocks) * BLOCK == len(padded)
+    assert stats.fill_blocks == 3
+    assert stats.hole_blocks >= 11
+
+    with SparseReader(tmp_path / 'system.img') as reader:
+        assert reader.size == len(padded)
+        kinds = {kind for kind, _offset, _n, _source in reader.segments(0, reader.size)}
+        assert kinds == {SEGMENT_DATA, SEGMENT_FILL, SEGMENT_HOLE}
+    with SparseFile(tmp_path / 'system.img') as f:
+        assert f.read() == padded
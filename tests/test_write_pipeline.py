@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backends import convert_sparse_to_raw_native
+from buffer_pool import BufferPool
+from sparse_image import SparseWriter
+from write_pipeline import PipelineOptions, WriteBehindPipeline
+
+BLOCK = 4096
+KB = 1024
+
+def _sparse_image(path: Path, seed: int) -> bytes:
+    """Sparse image of data, fill and hole runs; returns the expected raw bytes"""
+    data = os.urandom(64 * BLOCK)
+    raw = bytearray()
+    with open(path, 'wb') as f:
+        writer = SparseWriter(f, BLOCK)
+        for i in range(8):
+            writer.write_raw(data[i * 8 * BLOCK:(i + 1) * 8 * BLOCK])
+            raw += data[i * 8 * BLOCK:(i + 1) * 8 * BLOCK]
+            writer.write_fill(bytes([seed, i, 0, 1]), 4)
+            raw += bytes([seed, i, 0, 1]) * (4 * BLOCK // 4)
+            writer.skip(2)
+            raw += bytes(2 * BLOCK)
+        writer.close()
+    return bytes(raw)
+
+def test_pipeline_has_its_own_pool():
+    shared = BufferPool(2 * 64 * KB, 64 * KB)
+    with WriteBehindPipeline(PipelineOptions(queue_depth=2)) as pipeline:
+        assert pipeline.pool is not shared
+        assert pipeline.pool.capacity == 4
+
+def test_two_decodes_on_a_small_pool_make_progress(tmp_path):
+    # Each decoder holds one of the two shared buffers for its whole run;
+    # the write-behind copies must not wait on that same pool
+    shared = BufferPool(2 * 64 * KB, 64 * KB)
+    names = ('system', 'vendor')
+    expected = {name: _sparse_image(tmp_path / f'{name}.img', seed) for seed, name in enumerate(names)}
+    results = {}
+    holding = threading.Barrier(len(names))
+
+    class HoldingPool:
+        """Shared pool whose buffer() returns only once every decoder holds one"""
+        @contextmanager
+        def buffer(self):
+            with shared.buffer() as buf:
+                holding.wait(timeout=10)
+                yield buf
+
+    def decode(name: str):
+        with WriteBehindPipeline(PipelineOptions(queue_depth=1)) as pipeline:
+            results[name] = convert_sparse_to_raw_native(
+                tmp_path / f'{name}.img', tmp_path / f'{name}.raw', pool=HoldingPool(), pipeline=pipeline)
+
+    threads = [threading.Thread(target=decode, args=(name,), daemon=True) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+        assert not thread.is_alive(), "decode stalled waiting for a buffer"
+
+    assert results == {'system': True, 'vendor': True}
+    for name, raw in expected.items():
+        assert (tmp_path / f'{name}.raw').read_bytes() == raw
+    assert shared.in_use == 0
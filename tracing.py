@@ -0,0 +1,307 @@
+"""
+OPlus ROM Converter - Tracing and Profiling
+Named spans and byte counters for the build stages, with optional cProfile
+and tracemalloc capture, exported as Chrome trace-event JSON (open it in
+chrome://tracing or https://ui.perfetto.dev).
+
+Tracing is process-wide and off by default; span() and count() then cost
+one global lookup. collect() adds a private, thread-scoped collector on top
+(used by the build history); worker threads started through propagate()
+report to the collectors of the thread that started them. Switch tracing on
+around a build:
+
+    start_tracing(profile=True)
+    create_super_image(...)
+    tracer = stop_tracing()
+    tracer.write_chrome_trace(Path('build.trace.json'))
+
+Usage:
+    python tracing.py build.trace.json      # summary of a saved trace
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import threading
+import contextlib
+from pathlib import Path
+from typing import List, Dict, Optional, Callable, Any, Tuple
+
+# Counter names used across the modules
+BYTES_READ = 'bytes_read'
+BYTES_WRITTEN = 'bytes_written'
+CACHE_HIT = 'cache_hit'
+
+# Lines of cProfile / tracemalloc output kept in the summary
+TOP_ENTRIES = 15
+
+_NULL_SPAN = contextlib.nullcontext()
+
+# Thread whose collectors a worker reports to (set by propagate)
+_local = threading.local()
+
+def _owner() -> int:
+    return getattr(_local, 'owner', None) or threading.get_ident()
+
+class Tracer:
+    """Collects span and counter events of one tracing session"""
+
+    def __init__(self, profile: bool = False, memory: bool = False, thread: Optional[int] = None):
+        self.thread = thread  # Only record events of this thread ident (None: all threads)
+        self.events: List[Dict[str, Any]] = []
+        self.counters: Dict[str, int] = {}
+        self.threads: Dict[int, str] = {}
+        self.profiler = None
+        self.memory = memory
+        self.memory_peak = 0
+        self.memory_top: List[str] = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def _now_us(self) -> float:
+        return (time.perf_counter_ns() - self._origin) / 1000.0
+
+    def _tid(self) -> int:
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        return tid
+
+    def add_span(self, name: str, start_ns: int, end_ns: int, **args):
+        """Record a span measured elsewhere (perf_counter_ns timestamps)"""
+        if self.thread is not None and _owner() != self.thread:
+            return
+        event = {'name': name, 'cat': name.split(':', 1)[0], 'ph': 'X',
+                 'ts': (start_ns - self._origin) / 1000.0, 'dur': (end_ns - start_ns) / 1000.0,
+                 'pid': os.getpid(), 'tid': self._tid()}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def count(self, name: str, value: int = 1):
+        if self.thread is not None and _owner() != self.thread:
+            return
+        with self._lock:
+            total = self.counters.get(name, 0) + value
+            self.counters[name] = total
+        self.events.append({'name': name, 'ph': 'C', 'ts': self._now_us(), 'pid': os.getpid(),
+                            'tid': self._tid(), 'args': {name: total}})
+
+    def start(self):
+        if self.profiler:
+            self.profiler.enable()
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+
+    def stop(self):
+        if self.profiler:
+            self.profiler.disable()
+        if self.memory:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                self.memory_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                self.memory_top = [str(s) for s in snapshot.statistics('lineno')[:TOP_ENTRIES]]
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """Trace-event JSON object (spans as complete events, counters as counter events)"""
+        pid = os.getpid()
+        meta = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                for tid, name in self.threads.items()]
+        other = {'counters': dict(self.counters)}
+        if self.memory:
+            other['memory_peak'] = self.memory_peak
+            other['memory_top'] = self.memory_top
+        return {'traceEvents': meta + sorted(self.events, key=lambda e: e['ts']),
+                'displayTimeUnit': 'ms', 'otherData': other}
+
+    def write_chrome_trace(self, path: Path) -> List[Path]:
+        """Write the trace (and PATH.prof with cProfile stats), return the files written"""
+        path = Path(path)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f)
+        written = [path]
+        if self.profiler:
+            prof_path = path.with_suffix('.prof')
+            self.profiler.dump_stats(str(prof_path))
+            written.append(prof_path)
+        return written
+
+    def summary(self) -> List[str]:
+        """Human-readable totals: time per span name, counters, top profile/memory entries"""
+        return summarize(self.chrome_trace(), self._profile_top())
+
+    def _profile_top(self) -> List[str]:
+        if not self.profiler:
+            return []
+        import io
+        import pstats
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(TOP_ENTRIES)
+        return [line for line in out.getvalue().splitlines() if line.strip()]
+
+def summarize(trace: Dict[str, Any], profile_top: Optional[List[str]] = None) -> List[str]:
+    totals: Dict[str, List[float]] = {}
+    for event in trace.get('traceEvents', []):
+        if event.get('ph') == 'X':
+            entry = totals.setdefault(event['name'], [0, 0.0])
+            entry[0] += 1
+            entry[1] += event['dur']
+    lines = ["Trace summary (time per span):"]
+    for name, (calls, dur) in sorted(totals.items(), key=lambda kv: kv[1][1], reverse=True):
+        lines.append(f"  {dur / 1e6:9.3f}s  {calls:5d}x  {name}")
+    other = trace.get('otherData', {})
+    for name, value in sorted(other.get('counters', {}).items()):
+        lines.append(f"  {name}: {value / (1024**2):.1f} MB" if name.startswith('bytes') else f"  {name}: {value}")
+    if other.get('memory_peak'):
+        lines.append(f"  memory peak: {other['memory_peak'] / (1024**2):.1f} MB")
+        lines.extend(f"    {s}" for s in other.get('memory_top', []))
+    lines.extend(f"  {line}" for line in (profile_top or []))
+    return lines
+
+# Every tracer that receives events: the main session (if any) plus collectors
+_active: Tuple[Tracer, ...] = ()
+_session: Optional[Tracer] = None
+_active_lock = threading.Lock()
+
+def start_tracing(profile: bool = False, memory: bool = False) -> Tracer:
+    """Enable tracing process-wide (no-op if already on); cProfile covers the calling thread"""
+    global _active, _session
+    with _active_lock:
+        if _session is None:
+            tracer = Tracer(profile, memory)
+            tracer.start()
+            _session = tracer
+            _active = _active + (tracer,)
+        return _session
+
+def stop_tracing() -> Optional[Tracer]:
+    """Disable tracing and return the finished session"""
+    global _active, _session
+    with _active_lock:
+        tracer, _session = _session, None
+        _active = tuple(t for t in _active if t is not tracer)
+    if tracer:
+        tracer.stop()
+    return tracer
+
+def current_session() -> Optional[Tracer]:
+    """The session started by start_tracing(), None when tracing is off"""
+    return _session
+
+def is_tracing() -> bool:
+    """True while anything (session or collector) records events"""
+    return bool(_active)
+
+@contextlib.contextmanager
+def collect(current_thread_only: bool = True):
+    """Record spans/counters of the enclosed block into a private Tracer
+
+    Independent of start_tracing(): works whether or not a session runs,
+    and concurrent collectors don't see each other's threads.
+    """
+    global _active
+    tracer = Tracer(thread=_owner() if current_thread_only else None)
+    with _active_lock:
+        _active = _active + (tracer,)
+    try:
+        yield tracer
+    finally:
+        with _active_lock:
+            _active = tuple(t for t in _active if t is not tracer)
+
+def propagate(func: Callable) -> Callable:
+    """Wrap func so the thread that runs it reports to the calling thread's collectors"""
+    owner = _owner()
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'owner', None)
+        _local.owner = owner
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.owner = previous
+    return wrapper
+
+@contextlib.contextmanager
+def _span(tracers: Tuple[Tracer, ...], name: str, args: Dict[str, Any]):
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        end = time.perf_counter_ns()
+        for tracer in tracers:
+            tracer.add_span(name, start, end, **args)
+
+def span(name: str, **args):
+    """Context manager timing a named stage ("stage:detail" groups by category)"""
+    tracers = _active
+    if not tracers:
+        return _NULL_SPAN
+    return _span(tracers, name, args)
+
+def traced(name: str):
+    """Decorator: run the function inside span(name)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracers = _active
+            if not tracers:
+                return func(*args, **kwargs)
+            with _span(tracers, name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def add_span(name: str, start_ns: int, end_ns: int, **args):
+    """Record an already measured span (time.perf_counter_ns values)"""
+    for tracer in _active:
+        tracer.add_span(name, start_ns, end_ns, **args)
+
+def count(name: str, value: int = 1):
+    """Add to a named counter (bytes_read, bytes_written, ...)"""
+    for tracer in _active:
+        tracer.count(name, value)
+
+def add_trace_arguments(parser: argparse.ArgumentParser):
+    """--trace/--profile/--trace-memory for the command-line tools"""
+    parser.add_argument('--trace', type=Path, default=None, help='write a Chrome trace-event JSON here')
+    parser.add_argument('--profile', action='store_true', help='with --trace: also capture cProfile stats (.prof)')
+    parser.add_argument('--trace-memory', action='store_true', help='with --trace: also track allocations')
+
+@contextlib.contextmanager
+def traced_from_args(args: argparse.Namespace, log_callback: Optional[Callable[[str], None]] = None):
+    """Trace the enclosed block when --trace was given, write the file on exit"""
+    if not getattr(args, 'trace', None):
+        yield
+        return
+    start_tracing(profile=args.profile, memory=args.trace_memory)
+    try:
+        yield
+    finally:
+        tracer = stop_tracing()
+        if tracer:
+            written = tracer.write_chrome_trace(args.trace)
+            if log_callback:
+                for line in tracer.summary():
+                    log_callback(line)
+                log_callback(f"Trace: {', '.join(str(p) for p in written)}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Summarize a Chrome trace written by a build')
+    parser.add_argument('trace', type=Path)
+    args = parser.parse_args(argv)
+    with open(args.trace, 'r', encoding='utf-8') as f:
+        trace = json.load(f)
+    print('\n'.join(summarize(trace)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,370 @@
+"""
+OPlus ROM Converter - Watch-Folder Service
+Headless ingestion: ROM ZIPs (or encrypted OZIP/OFP packages) dropped into an
+inbox are picked up once they have finished copying, extracted, preflighted
+and built for the configured regions. Outputs, a build log and a JSON report
+land in the results folder.
+
+Usage:
+    python watch_folder.py INBOX RESULTS [--regions 10010000,10010111] [--jobs 1]
+"""
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import List, Dict, Optional, Callable, Tuple
+
+from converter import (
+    find_all_super_defs, create_super_image, RegionInfo
+)
+from write_pipeline import PipelineOptions
+from preflight import run_preflight
+from tracing import traced, add_trace_arguments, traced_from_args
+from build_cache import BuildCache, build_cache_from_env, GB
+from build_history import BuildHistory, default_history
+from io_throttle import add_background_arguments, background_from_args
+from io_schedule import SCHEDULES, SCHEDULE_AUTO
+from backends import AUTO, add_backend_arguments
+from zip_verify import verify_zip
+from firmware_decrypt import extract_firmware, FIRMWARE_SUFFIXES
+from extract_index import ExtractIndex, default_index_path, extract_index_from_env
+
+STATE_FILE_NAME = '.watch_state.json'
+STATE_VERSION = 1
+
+@dataclass
+class WatchConfig:
+    """Watch-folder settings"""
+    inbox: Path
+    results: Path
+    work_dir: Optional[Path] = None     # Extraction area (default: RESULTS/_work)
+    regions: List[str] = field(default_factory=list)  # NV IDs to build, empty = all
+    max_jobs: int = 1
+    poll_interval: float = 5.0
+    stable_seconds: float = 10.0        # Size/mtime must not change for this long
+    keep_extracted: bool = False
+    native_decode: bool = True          # In-process sparse decoding (no simg2img.exe)
+    scratch_dirs: List[Path] = field(default_factory=list)  # Decoded raw files (default: results)
+    build_cache: Optional[BuildCache] = None  # Reuse identical outputs across archives and runs
+    history: Optional[BuildHistory] = None    # Record build timings
+    extract_index: Optional[ExtractIndex] = None  # Link members already extracted (with keep_extracted)
+    decoder: str = AUTO                 # Backend names (see backends), auto = fastest here
+    assembler: str = AUTO
+    verify_zip: bool = False            # CRC-check archives, starting while they are still copied
+    io_schedule: str = SCHEDULE_AUTO    # 'sequential' for hard disks (auto: detect)
+
+@dataclass
+class JobResult:
+    """Outcome of one archive"""
+    archive: str
+    ok: bool
+    started: float
+    finished: float = 0.0
+    stage: str = 'queued'
+    outputs: List[str] = field(default_factory=list)
+    failed_regions: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+def _find_rom_root(folder: Path) -> Optional[Path]:
+    """Extraction folder, or its single subfolder, that contains META/"""
+    if (folder / 'META').is_dir():
+        return folder
+    subdirs = [d for d in folder.iterdir() if d.is_dir()]
+    if len(subdirs) == 1 and (subdirs[0] / 'META').is_dir():
+        return subdirs[0]
+    return None
+
+def _is_readable(path: Path) -> bool:
+    # On Windows a file still being copied can't be opened
+    try:
+        with open(path, 'rb'):
+            return True
+    except OSError:
+        return False
+
+class WatchFolder:
+    """Polls the inbox and runs a bounded number of build jobs"""
+
+    def __init__(self, config: WatchConfig, log_callback: Optional[Callable[[str], None]] = None):
+        self.config = config
+        self.log_callback = log_callback
+        self.work_dir = config.work_dir or config.results / '_work'
+        self._seen: Dict[str, Tuple[int, int, float]] = {}  # path -> (size, mtime_ns, stable since)
+        self._jobs: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, config.max_jobs), thread_name_prefix='watch-job')
+        self._state = self._load_state()
+
+    # --- State (which archives are done) ---
+
+    def _state_path(self) -> Path:
+        return self.config.results / STATE_FILE_NAME
+
+    def _load_state(self) -> Dict[str, Dict]:
+        try:
+            with open(self._state_path(), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == STATE_VERSION:
+                return data.get('processed', {})
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def _save_state(self):
+        self.config.results.mkdir(parents=True, exist_ok=True)
+        tmp = self._state_path().with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': STATE_VERSION, 'processed': self._state}, f, indent=2)
+        tmp.replace(self._state_path())
+
+    @staticmethod
+    def _fingerprint(size: int, mtime_ns: int) -> str:
+        return f"{size}:{mtime_ns}"
+
+    def _log(self, msg: str):
+        if self.log_callback:
+            self.log_callback(msg)
+
+    # --- Polling ---
+
+    def poll_once(self, now: Optional[float] = None) -> List[Path]:
+        """Scan the inbox once, queue archives that are complete, return them"""
+        now = time.monotonic() if now is None else now
+        queued = []
+        try:
+            candidates = sorted(p for p in self.config.inbox.iterdir() if p.suffix.lower() in FIRMWARE_SUFFIXES)
+        except OSError:
+            return queued
+        present = set()
+        for path in candidates:
+            key = str(path)
+            present.add(key)
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            with self._lock:
+                if key in self._jobs:
+                    continue
+                fingerprint = self._fingerprint(st.st_size, st.st_mtime_ns)
+                if self._state.get(path.name, {}).get('fingerprint') == fingerprint:
+                    continue
+                # Verified archives are followed while they copy instead of waiting for them to settle
+                follow = self.config.verify_zip and path.suffix.lower() == '.zip' and _is_readable(path)
+                seen = self._seen.get(key)
+                if not follow:
+                    if seen is None or seen[:2] != (st.st_size, st.st_mtime_ns):
+                        self._seen[key] = (st.st_size, st.st_mtime_ns, now)
+                        continue
+                    if now - seen[2] < self.config.stable_seconds or not _is_readable(path):
+                        continue
+                self._seen.pop(key, None)
+                self._jobs[key] = self._executor.submit(self._run_job, path, fingerprint, follow)
+            queued.append(path)
+            self._log(f"Queued {path.name}")
+        # Forget files that disappeared before they settled
+        with self._lock:
+            for key in list(self._seen):
+                if key not in present:
+                    del self._seen[key]
+        return queued
+
+    def active_jobs(self) -> int:
+        with self._lock:
+            return sum(1 for f in self._jobs.values() if not f.done())
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Block until every queued job has finished"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.active_jobs():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def run(self, stop_event: Optional[threading.Event] = None):
+        """Poll until stop_event is set (or forever)"""
+        stop_event = stop_event or threading.Event()
+        self._log(f"Watching {self.config.inbox} -> {self.config.results}")
+        while not stop_event.is_set():
+            self.poll_once()
+            stop_event.wait(self.config.poll_interval)
+
+    def close(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    # --- Jobs ---
+
+    def _select_regions(self, regions: List[RegionInfo]) -> List[RegionInfo]:
+        if not self.config.regions:
+            return regions
+        wanted = set(self.config.regions)
+        return [r for r in regions if r.nv_id in wanted]
+
+    @traced('watch:job')
+    def _run_job(self, zip_path: Path, fingerprint: str, follow: bool = False) -> JobResult:
+        result = JobResult(archive=zip_path.name, ok=False, started=time.time())
+        # Keyed by the full name like the state: ROM.zip and ROM.ofp must not share folders
+        out_dir = self.config.results / zip_path.name
+        out_dir.mkdir(parents=True, exist_ok=True)
+        extract_dir = self.work_dir / zip_path.name
+        log_lines: List[str] = []
+        lock = threading.Lock()
+
+        def job_log(msg: str):
+            with lock:
+                log_lines.append(f"{time.strftime('%H:%M:%S')} {msg}")
+            self._log(f"[{zip_path.name}] {msg}")
+
+        try:
+            if self.config.verify_zip and zip_path.suffix.lower() == '.zip':
+                result.stage = 'verify'
+                verified = verify_zip(zip_path, follow=follow, log_callback=job_log)
+                if follow:
+                    st = zip_path.stat()  # The archive was still growing when queued
+                    fingerprint = self._fingerprint(st.st_size, st.st_mtime_ns)
+                if not verified.ok:
+                    raise RuntimeError(f"damaged archive: {verified.bad_member or verified.problem}")
+
+            result.stage = 'extract'
+            job_log(f"Extracting {zip_path.name}")
+            if extract_dir.exists():
+                shutil.rmtree(extract_dir, ignore_errors=True)
+            extract_dir.mkdir(parents=True, exist_ok=True)
+            index = self.config.extract_index if self.config.keep_extracted else None
+            if not extract_firmware(zip_path, extract_dir, job_log, index=index):
+                raise RuntimeError("extraction failed")
+            rom_folder = _find_rom_root(extract_dir)
+            if rom_folder is None:
+                raise RuntimeError("no META folder in archive")
+
+            result.stage = 'scan'
+            regions = self._select_regions(find_all_super_defs(rom_folder))
+            if not regions:
+                raise RuntimeError("no matching super_def regions")
+
+            result.stage = 'preflight'
+            report = run_preflight(rom_folder, [r.config for r in regions], log_callback=job_log)
+            with open(out_dir / 'preflight.json', 'w', encoding='utf-8') as f:
+                json.dump(report.to_dict(), f, indent=2)
+            failed_configs = {i.source for i in report.errors}
+
+            result.stage = 'build'
+            for region in regions:
+                if region.config_path.name in failed_configs:
+                    job_log(f"Skipping {region.nv_id}: preflight errors")
+                    result.failed_regions.append(region.nv_id)
+                    continue
+                output = out_dir / f'super.{region.nv_id}.img'
+                job_log(f"Building {region.nv_text} ({region.nv_id})")
+                pipeline_options = PipelineOptions() if self.config.native_decode else None
+                if create_super_image(region.config, rom_folder, output, job_log,
+                                      pipeline_options=pipeline_options,
+                                      scratch_dirs=self.config.scratch_dirs or None,
+                                      build_cache=self.config.build_cache,
+                                      history=self.config.history,
+                                      decoder=self.config.decoder,
+                                      assembler=self.config.assembler,
+                                      io_schedule=self.config.io_schedule):
+                    result.outputs.append(str(output))
+                else:
+                    result.failed_regions.append(region.nv_id)
+            result.ok = not result.failed_regions
+            result.stage = 'done'
+        except Exception as e:
+            result.error = str(e)
+            job_log(f"ERROR: {e}")
+        finally:
+            if not self.config.keep_extracted:
+                shutil.rmtree(extract_dir, ignore_errors=True)
+            result.finished = time.time()
+            job_log(f"{'Finished' if result.ok else 'FAILED'} in {result.finished - result.started:.0f}s")
+            try:
+                with open(out_dir / 'build.log', 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(log_lines) + '\n')
+                with open(out_dir / 'report.json', 'w', encoding='utf-8') as f:
+                    json.dump(asdict(result), f, indent=2)
+            except OSError:
+                pass
+            with self._lock:
+                # Recorded even on failure: a fixed archive arrives with a new size/mtime
+                self._state[zip_path.name] = {'fingerprint': fingerprint, 'ok': result.ok,
+                                              'finished': result.finished}
+                self._save_state()
+                self._jobs.pop(str(zip_path), None)
+        return result
+
+def _extract_index(args) -> Optional[ExtractIndex]:
+    """Extract index for --dedup; extractions that are deleted after each job can't be linked to"""
+    if not args.keep_extracted:
+        if args.dedup:
+            print("WARNING: --dedup needs --keep-extracted, ignoring it")
+        return None
+    return ExtractIndex(default_index_path()) if args.dedup else extract_index_from_env()
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Build super images for ROM ZIPs dropped into a folder')
+    parser.add_argument('inbox', type=Path)
+    parser.add_argument('results', type=Path)
+    parser.add_argument('--work-dir', type=Path, default=None, help='extraction area (default RESULTS/_work)')
+    parser.add_argument('--regions', default='', help='comma-separated NV IDs (default: all)')
+    parser.add_argument('--jobs', type=int, default=1, help='concurrent builds')
+    parser.add_argument('--interval', type=float, default=5.0, help='poll interval (s)')
+    parser.add_argument('--stable', type=float, default=10.0, help='seconds a file must stay unchanged')
+    parser.add_argument('--keep-extracted', action='store_true')
+    parser.add_argument('--simg2img', action='store_true', help='decode with simg2img.exe instead of in-process')
+    parser.add_argument('--scratch', type=Path, action='append', default=[],
+                        help='scratch folder for decoded images, in order of preference (repeatable)')
+    parser.add_argument('--io-schedule', choices=SCHEDULES, default=SCHEDULE_AUTO,
+                        help='I/O order: sequential for hard disks (default: detect)')
+    parser.add_argument('--once', action='store_true', help='process what is there, then exit')
+    parser.add_argument('--cache', type=Path, default=None, help='build cache folder (default QFF_BUILD_CACHE)')
+    parser.add_argument('--cache-gb', type=float, default=100.0, help='build cache size limit')
+    add_trace_arguments(parser)
+    add_background_arguments(parser)
+    add_backend_arguments(parser)
+    parser.add_argument('--verify-zip', action='store_true',
+                        help='CRC-check archives before extracting (starts while they are still copied)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='link members already extracted from other archives (default: QFF_EXTRACT_INDEX)')
+    args = parser.parse_args(argv)
+    background_from_args(args)
+
+    config = WatchConfig(
+        inbox=args.inbox, results=args.results, work_dir=args.work_dir,
+        regions=[r for r in args.regions.split(',') if r], max_jobs=args.jobs,
+        poll_interval=args.interval, stable_seconds=args.stable, keep_extracted=args.keep_extracted,
+        native_decode=not args.simg2img,
+        scratch_dirs=args.scratch,
+        build_cache=BuildCache(args.cache, int(args.cache_gb * GB)) if args.cache else build_cache_from_env(),
+        history=default_history(),
+        extract_index=_extract_index(args),
+        decoder=args.decoder or ('simg2img' if args.simg2img else AUTO),
+        assembler=args.assembler or AUTO,
+        verify_zip=args.verify_zip,
+        io_schedule=args.io_schedule
+    )
+    watcher = WatchFolder(config, log_callback=print)
+    with traced_from_args(args, print):
+        try:
+            if args.once:
+                # Two polls, stable_seconds apart, settle anything that is not being written
+                watcher.poll_once()
+                time.sleep(config.stable_seconds)
+                watcher.poll_once()
+                watcher.wait_idle()
+            else:
+                watcher.run()
+        except KeyboardInterrupt:
+            print("Stopping...")
+        finally:
+            watcher.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
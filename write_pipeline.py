@@ -0,0 +1,189 @@
+"""
+OPlus ROM Converter - Write-Behind Pipeline
+Lets the calling thread read and decode while a background thread flushes
+buffers to the outputs, so source and destination disks stay busy at the
+same time. Each pipeline has its own small buffer pool (queue depth + 2
+buffers), so a reader holding a buffer of the shared pool never waits on
+that pool for a second one.
+"""
+import os
+import queue
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+from buffer_pool import BufferPool, get_default_pool
+from tracing import span, is_tracing, propagate
+
+# fsync policies
+FSYNC_NONE = 'none'
+FSYNC_PARTITION = 'partition'   # fsync each output as it is closed
+FSYNC_BUILD = 'build'           # fsync all outputs once, at the end
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_PARTITION, FSYNC_BUILD)
+
+@dataclass
+class PipelineOptions:
+    """Write-behind settings"""
+    queue_depth: int = 4
+    fsync_policy: str = FSYNC_NONE
+    fadvise: bool = False
+
+def fadvise(f, advice_name: str, offset: int = 0, length: int = 0):
+    """posix_fadvise hint on an open file (or descriptor), silently ignored where unsupported"""
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(f if isinstance(f, int) else f.fileno(), offset, length, advice)
+    except OSError:
+        pass
+
+def pipeline_budget(options: Optional[PipelineOptions] = None) -> int:
+    """Bytes a pipeline's own pool preallocates: queued buffers + the one being written + the one being filled"""
+    options = options or PipelineOptions()
+    return (max(1, options.queue_depth) + 2) * get_default_pool().buffer_size
+
+class WriteBehindFile:
+    """Write-only file proxy: every write is copied into a pool buffer and queued"""
+
+    def __init__(self, pipeline: 'WriteBehindPipeline', path: Path, mode: str = 'wb'):
+        self.pipeline = pipeline
+        self.path = Path(path)
+        self._pos = 0
+        self._size = 0
+        self.closed = False
+        pipeline._submit(('open', self, mode))
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast('B')
+        done = 0
+        while done < len(data):
+            buf = self.pipeline.pool.acquire()
+            n = min(len(buf), len(data) - done)
+            buf[:n] = data[done:done + n]
+            self.pipeline._submit(('write', self, self._pos, buf, n))
+            self._pos += n
+            done += n
+        self._size = max(self._size, self._pos)
+        return done
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        size = self._pos if size is None else size
+        self._size = size
+        self.pipeline._submit(('truncate', self, size))
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pipeline._submit(('close', self))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class WriteBehindPipeline:
+    """Single background writer shared by all outputs of a build"""
+
+    def __init__(self, options: Optional[PipelineOptions] = None, pool: Optional[BufferPool] = None):
+        self.options = options or PipelineOptions()
+        if self.options.fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {self.options.fsync_policy}")
+        self.pool = pool or BufferPool(pipeline_budget(self.options), get_default_pool().buffer_size)
+        self.bytes_written = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, self.options.queue_depth))
+        self._files = {}
+        self._written: List[Path] = []
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=propagate(self._run), name='write-behind', daemon=True)
+        self._thread.start()
+
+    def open(self, path: Path, mode: str = 'wb') -> WriteBehindFile:
+        """Open an output; the real file is created by the writer thread"""
+        return WriteBehindFile(self, path, mode)
+
+    def _submit(self, op):
+        if self._error is not None:
+            if op[0] == 'write':
+                self.pool.release(op[3])
+            raise IOError(f"Write-behind failed: {self._error}")
+        if self._queue.full() and is_tracing():
+            # The reader is ahead of the disk: make the stall visible
+            with span('write-behind:wait'):
+                self._queue.put(op)
+            return
+        self._queue.put(op)
+
+    def _run(self):
+        while True:
+            op = self._queue.get()
+            if op is None:
+                return
+            try:
+                if self._error is None:
+                    self._execute(op)
+            except BaseException as e:
+                self._error = e
+            finally:
+                if op[0] == 'write':
+                    self.pool.release(op[3])
+
+    def _execute(self, op):
+        kind, proxy = op[0], op[1]
+        if kind == 'open':
+            self._files[proxy] = open(proxy.path, op[2])
+        elif kind == 'write':
+            f = self._files[proxy]
+            offset, buf, n = op[2], op[3], op[4]
+            if f.tell() != offset:
+                f.seek(offset)
+            f.write(buf[:n])
+            self.bytes_written += n
+        elif kind == 'truncate':
+            self._files[proxy].truncate(op[2])
+        elif kind == 'close':
+            f = self._files.pop(proxy)
+            f.flush()
+            if self.options.fsync_policy == FSYNC_PARTITION:
+                with span(f'fsync:{proxy.path.name}'):
+                    os.fsync(f.fileno())
+            if self.options.fadvise:
+                # Output is not read back by us, don't let it crowd the page cache
+                fadvise(f, 'POSIX_FADV_DONTNEED')
+            f.close()
+            self._written.append(proxy.path)
+
+    def close(self):
+        """Drain the queue, apply the end-of-build fsync policy, raise on writer errors"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+        if self._error is not None:
+            raise IOError(f"Write-behind failed: {self._error}")
+        if self.options.fsync_policy == FSYNC_BUILD:
+            for path in self._written:
+                with open(path, 'r+b') as f, span(f'fsync:{path.name}'):
+                    os.fsync(f.fileno())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,425 @@
+"""
+OPlus ROM Converter - ZIP Verification
+A damaged or half-downloaded ROM ZIP used to surface only when extraction
+failed part way, after gigabytes had been written. verify_zip checks the
+central directory first (present, consistent with the file size), then
+CRC-checks the members concurrently, largest first, each worker with its
+own file handle, and stops at the first bad member.
+
+With follow, verification starts while the ZIP is still being copied:
+members are checked from their local headers as soon as their data has
+arrived; the central directory and anything left over are checked once
+the copy has finished.
+
+Usage:
+    python zip_verify.py ROM.zip [-j 4] [--follow]
+"""
+import os
+import sys
+import time
+import zlib
+import json
+import struct
+import zipfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import List, Dict, Optional, Callable, Tuple
+
+from io_schedule import SCHEDULE_AUTO, SCHEDULE_SEQUENTIAL, SCHEDULES, resolve_schedule
+from io_throttle import throttle
+from tracing import span, count, traced, BYTES_READ
+
+MB = 1024 * 1024
+
+VERIFY_WORKERS = 4
+VERIFY_CHUNK = 1 * MB
+
+# Follow mode: how often the growing file is polled, and how long it may
+# stay unchanged before the copy counts as stalled
+FOLLOW_POLL_SECONDS = 0.5
+FOLLOW_IDLE_TIMEOUT = 60.0
+
+LOCAL_HEADER_FORMAT = '<4s2B4HL2L2H'  # sig, version, os, flags, method, time, date, crc, csize, usize, name/extra len
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+LOCAL_HEADER_MAGIC = b'PK\x03\x04'
+CENTRAL_DIR_MAGICS = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+ZIP64_EXTRA_ID = 0x0001
+
+class ZipVerifyError(Exception):
+    """The archive can't be verified (no central directory, stalled copy...)"""
+    pass
+
+@dataclass
+class ZipVerifyResult:
+    """Outcome of verify_zip"""
+    path: str
+    ok: bool = False
+    members: int = 0                # Members CRC-checked
+    bytes: int = 0                  # Uncompressed bytes checked
+    bad_member: Optional[str] = None
+    problem: Optional[str] = None
+    elapsed: float = 0.0
+
+@dataclass
+class _LocalMember:
+    """A member found by walking local headers (follow mode)"""
+    name: str
+    header_offset: int
+    data_offset: int
+    method: int
+    crc: int
+    compress_size: int
+    file_size: int
+
+def read_central_directory(zip_path: Path) -> List[zipfile.ZipInfo]:
+    """Members from the central directory; raises ZipVerifyError if it is missing or inconsistent"""
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            infos = zf.infolist()
+            start_dir = getattr(zf, 'start_dir', None)
+    except zipfile.BadZipFile as e:
+        raise ZipVerifyError(f"no valid central directory ({e}); incomplete download?")
+    if start_dir is None:
+        start_dir = Path(zip_path).stat().st_size
+    names = set()
+    for info in infos:
+        if info.filename in names:
+            raise ZipVerifyError(f"duplicate member {info.filename}")
+        names.add(info.filename)
+        if info.flag_bits & FLAG_ENCRYPTED:
+            raise ZipVerifyError(f"{info.filename} is encrypted")
+        if info.header_offset + LOCAL_HEADER_SIZE + info.compress_size > start_dir:
+            raise ZipVerifyError(f"{info.filename} extends past the central directory; truncated?")
+    return infos
+
+def _check_member(zf: zipfile.ZipFile, info: zipfile.ZipInfo, abort: threading.Event,
+                  on_bytes: Callable[[int], None]) -> Optional[str]:
+    """Read a member to its end (ZipExtFile checks the CRC there), describe damage if any"""
+    try:
+        with zf.open(info) as src:
+            while not abort.is_set():
+                data = src.read(VERIFY_CHUNK)
+                if not data:
+                    return None
+                throttle(len(data))
+                on_bytes(len(data))
+    except (zipfile.BadZipFile, zlib.error, EOFError, OSError, RuntimeError, NotImplementedError) as e:
+        return str(e) or type(e).__name__
+    return None  # Aborted: another member failed
+
+def _check_local(zip_path: Path, member: _LocalMember, abort: threading.Event,
+                 on_bytes: Callable[[int], None]) -> Optional[str]:
+    """CRC-check a stored or deflated member straight from its local header data"""
+    decompressor = zlib.decompressobj(-15) if member.method == zipfile.ZIP_DEFLATED else None
+    crc = 0
+    size = 0
+    left = member.compress_size
+    try:
+        with open(zip_path, 'rb') as f:
+            f.seek(member.data_offset)
+            while left and not abort.is_set():
+                data = f.read(min(VERIFY_CHUNK, left))
+                if not data:
+                    return "truncated"
+                left -= len(data)
+                throttle(len(data))
+                if decompressor:
+                    data = decompressor.decompress(data)
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                on_bytes(len(data))
+            if abort.is_set():
+                return None
+            if decompressor:
+                tail = decompressor.flush()
+                crc = zlib.crc32(tail, crc)
+                size += len(tail)
+                if not decompressor.eof:
+                    return "deflate stream ends early"
+    except (OSError, zlib.error) as e:
+        return str(e) or type(e).__name__
+    if size != member.file_size:
+        return f"size {size}, expected {member.file_size}"
+    if crc != member.crc:
+        return f"Bad CRC-32 (0x{crc:08x}, expected 0x{member.crc:08x})"
+    return None
+
+class _GrowingFile:
+    """Read access to a file that is still being written; waits for data"""
+
+    def __init__(self, path: Path, idle_timeout: float, abort: threading.Event):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.abort = abort
+        self.f = open(path, 'rb', buffering=0)  # Unbuffered: re-reads must see new data
+        self._state = None
+        self._changed = time.monotonic()
+
+    def close(self):
+        self.f.close()
+
+    def poll(self) -> int:
+        """Current size; raises ZipVerifyError once the file stopped changing for idle_timeout"""
+        st = os.stat(self.path)
+        state = (st.st_size, st.st_mtime_ns)
+        now = time.monotonic()
+        if state != self._state:
+            self._state = state
+            self._changed = now
+        elif now - self._changed > self.idle_timeout:
+            raise ZipVerifyError(f"copy stalled at {st.st_size} bytes; incomplete download?")
+        return st.st_size
+
+    def wait(self):
+        if self.abort.wait(FOLLOW_POLL_SECONDS):
+            raise ZipVerifyError("aborted")
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        """length bytes at offset once they are there (all-zero data counts as not yet written)"""
+        while True:
+            if self.poll() >= offset + length:
+                self.f.seek(offset)
+                data = self.f.read(length)
+                # Some copiers preallocate the whole file: zeros mean "not written yet"
+                if len(data) == length and data.strip(b'\0'):
+                    return data
+            self.wait()
+
+    def wait_for(self, offset: int):
+        while self.poll() < offset:
+            self.wait()
+
+def _parse_zip64(extra: bytes, file_size: int, compress_size: int) -> Tuple[int, int]:
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, length = struct.unpack_from('<HH', extra, pos)
+        if tag == ZIP64_EXTRA_ID:
+            values = list(struct.unpack_from(f'<{min(length, 16) // 8}Q', extra, pos + 4))
+            if file_size == 0xFFFFFFFF and values:
+                file_size = values.pop(0)
+            if compress_size == 0xFFFFFFFF and values:
+                compress_size = values.pop(0)
+            break
+        pos += 4 + length
+    return file_size, compress_size
+
+def _follow_local_headers(growing: _GrowingFile, submit: Callable[[_LocalMember], None],
+                          log_callback: Optional[Callable[[str], None]]) -> None:
+    """Walk the local headers as the copy progresses, submitting each member once its data is in"""
+    pos = 0
+    while True:
+        header = growing.read_at(pos, 4)
+        if header in CENTRAL_DIR_MAGICS:
+            return
+        if header != LOCAL_HEADER_MAGIC:
+            # Damaged, or a prefix we can't walk: the central directory pass decides
+            if log_callback:
+                log_callback(f"No local header at offset {pos}, finishing after the copy")
+            return
+        # Re-read until the member's data is in: a preallocating copier may not have
+        # written the whole header yet when its signature shows up. Copies are
+        # sequential, so a complete name (never empty, never ending in NUL)
+        # means everything before it is there too.
+        while True:
+            (_sig, _version, _os, flags, method, _time, _date, crc, compress_size, file_size,
+             name_len, extra_len) = struct.unpack(LOCAL_HEADER_FORMAT, growing.read_at(pos, LOCAL_HEADER_SIZE))
+            data_offset = pos + LOCAL_HEADER_SIZE + name_len + extra_len
+            growing.wait_for(data_offset)
+            growing.f.seek(pos + LOCAL_HEADER_SIZE)
+            raw_name = growing.f.read(name_len)
+            extra = growing.f.read(extra_len)
+            if not raw_name.rstrip(b'\0') or raw_name.endswith(b'\0'):
+                growing.wait()
+                continue
+            name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437', 'replace')
+            if flags & FLAG_DATA_DESCRIPTOR:
+                # Sizes only follow the data: the rest waits for the central directory
+                if log_callback:
+                    log_callback(f"{name} has no sizes in its local header, finishing after the copy")
+                return
+            file_size, compress_size = _parse_zip64(extra, file_size, compress_size)
+            if growing.poll() >= data_offset + compress_size:
+                break
+            growing.wait()
+        if method in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) and not flags & FLAG_ENCRYPTED:
+            submit(_LocalMember(name, pos, data_offset, method, crc, compress_size, file_size))
+        pos = data_offset + compress_size
+
+def _wait_for_central_directory(growing: _GrowingFile) -> List[zipfile.ZipInfo]:
+    """The central directory is written last; retry until the copy has finished"""
+    while True:
+        try:
+            return read_central_directory(growing.path)
+        except ZipVerifyError:
+            growing.poll()
+            growing.wait()
+
+@traced('zip:verify')
+def verify_zip(
+    zip_path: Path,
+    workers: Optional[int] = None,
+    follow: bool = False,
+    idle_timeout: float = FOLLOW_IDLE_TIMEOUT,
+    schedule: str = SCHEDULE_AUTO,
+    log_callback: Optional[Callable[[str], None]] = None,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+) -> ZipVerifyResult:
+    """Check the central directory, then CRC-check every member; stop at the first bad one
+
+    Members are checked largest first by several workers, each with its own
+    file handle. On a rotational disk (schedule auto/sequential) one worker
+    reads them in file order instead. With follow the ZIP may still be
+    growing: see the module docstring. During the copy a failed member is
+    only retried afterwards (it may not have been fully written yet).
+    """
+    zip_path = Path(zip_path)
+    result = ZipVerifyResult(path=str(zip_path))
+    started = time.monotonic()
+    sequential = resolve_schedule(schedule, [zip_path]) == SCHEDULE_SEQUENTIAL
+    workers = 1 if sequential else max(1, workers or min(VERIFY_WORKERS, os.cpu_count() or 1))
+    abort = threading.Event()
+    lock = threading.Lock()
+    done = [0]
+    total = [0]
+    local = threading.local()
+    handles: List[zipfile.ZipFile] = []
+    checked: Dict[str, _LocalMember] = {}
+
+    def on_bytes(n: int):
+        count(BYTES_READ, n)
+        with lock:
+            done[0] += n
+            if progress_callback and total[0]:
+                progress_callback(min(done[0], total[0]), total[0])
+
+    def fail(name: str, problem: str):
+        with lock:
+            if result.bad_member is None:
+                result.bad_member, result.problem = name, problem
+        abort.set()
+
+    def check_info(info: zipfile.ZipInfo):
+        zf = getattr(local, 'zf', None)
+        if zf is None:
+            zf = local.zf = zipfile.ZipFile(zip_path)  # Own file handle per worker
+            with lock:
+                handles.append(zf)
+        with span(f'zip:{info.filename}', size=info.file_size):
+            problem = _check_member(zf, info, abort, on_bytes)
+        if problem:
+            fail(info.filename, problem)
+        elif not abort.is_set():
+            with lock:
+                result.members += 1
+
+    def check_local(member: _LocalMember, copying: List[bool]):
+        with span(f'zip:{member.name}', size=member.file_size, follow=True):
+            problem = _check_local(zip_path, member, abort, on_bytes)
+        if problem is None and not abort.is_set():
+            with lock:
+                checked[member.name] = member
+                result.members += 1
+        elif problem and not copying[0]:
+            fail(member.name, problem)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zip-verify') as executor:
+            futures = []
+            if follow:
+                copying = [True]
+                growing = _GrowingFile(zip_path, idle_timeout, abort)
+                try:
+                    if log_callback:
+                        log_callback(f"Verifying {zip_path.name} while it is copied...")
+                    try:
+                        _follow_local_headers(growing, lambda m: futures.append(executor.submit(check_local, m, copying)),
+                                              log_callback)
+                    except ZipVerifyError as e:
+                        if abort.is_set():
+                            raise
+                        # Idle: done copying but not walkable, or really stalled (then this fails too)
+                        if log_callback:
+                            log_callback(f"Stopped following ({e}), checking the central directory")
+                    infos = _wait_for_central_directory(growing)
+                finally:
+                    copying[0] = False
+                    growing.close()
+                for future in futures:
+                    future.result()
+            else:
+                infos = read_central_directory(zip_path)
+
+            # Whatever follow mode didn't cover (or isn't in the central directory as walked)
+            remaining = []
+            for info in infos:
+                if info.is_dir():
+                    continue
+                seen = checked.get(info.filename)
+                if seen and (seen.header_offset, seen.crc, seen.compress_size) == \
+                        (info.header_offset, info.CRC, info.compress_size):
+                    continue
+                remaining.append(info)
+            if sequential:
+                remaining.sort(key=lambda i: i.header_offset)
+            else:
+                remaining.sort(key=lambda i: i.compress_size, reverse=True)
+            with lock:
+                done[0] = sum(m.file_size for m in checked.values())
+                total[0] = done[0] + sum(i.file_size for i in remaining)
+            if log_callback:
+                log_callback(f"Verifying {zip_path.name}: {len(remaining)} members, "
+                             f"{total[0] / (1024**3):.2f} GB, {workers} workers...")
+            futures = [executor.submit(check_info, info) for info in remaining]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    if abort.is_set():
+                        break
+            finally:
+                for future in futures:
+                    future.cancel()
+    except ZipVerifyError as e:
+        result.problem = str(e)
+    except OSError as e:
+        result.problem = str(e)
+    finally:
+        for zf in handles:
+            zf.close()
+
+    result.bytes = done[0]
+    result.elapsed = time.monotonic() - started
+    result.ok = result.problem is None
+    if log_callback:
+        if result.ok:
+            rate = result.bytes / MB / result.elapsed if result.elapsed else 0
+            log_callback(f"ZIP OK: {result.members} members in {result.elapsed:.1f}s ({rate:.0f} MB/s)")
+        elif result.bad_member:
+            log_callback(f"ERROR: {zip_path.name}: {result.bad_member}: {result.problem}")
+        else:
+            log_callback(f"ERROR: {zip_path.name}: {result.problem}")
+    return result
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Check a ROM ZIP for damage before extracting it')
+    parser.add_argument('zip', type=Path)
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--follow', action='store_true', help='start while the ZIP is still being copied')
+    parser.add_argument('--idle-timeout', type=float, default=FOLLOW_IDLE_TIMEOUT,
+                        help='with --follow: seconds without growth before the copy counts as stalled')
+    parser.add_argument('--schedule', choices=SCHEDULES, default=SCHEDULE_AUTO,
+                        help='sequential for hard disks (auto: detect)')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+    result = verify_zip(args.zip, args.jobs, args.follow, args.idle_timeout, args.schedule,
+                        log_callback=None if args.json else print)
+    if args.json:
+        print(json.dumps(asdict(result), indent=2))
+    return 0 if result.ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())